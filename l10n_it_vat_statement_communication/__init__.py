@@ -1 +1 @@
-from . import models, wizard
+from . import cli, controllers, models, wizard
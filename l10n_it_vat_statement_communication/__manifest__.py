@@ -2,7 +2,7 @@
 {
     "name": "ITA - Comunicazione liquidazione IVA",
     "summary": "Comunicazione liquidazione IVA ed export file XML",
-    "version": "3.0.1.0.0",
+    "version": "3.0.1.0.1",
     "category": "Accounting/Localizations",
     "author": "Openforce di Camilli Alessandro",
     "website": "https://github.com/OCA/l10n-italy",
@@ -17,10 +17,15 @@
         "security/ir.model.access.csv",
         "data/appointment_code_data.xml",
         "views/comunicazione_liquidazione.xml",
+        "views/comunicazione_liquidazione_vp_tax.xml",
         "views/config.xml", 
         "views/account.xml",
         "wizard/export_file_view.xml",
+        "wizard/export_vp_view.xml",
         "wizard/import_wizard_view.xml",
+        "wizard/preflight_view.xml",
+        "wizard/acconto_view.xml",
+        "wizard/anomaly_scan_view.xml",
     ],
     "installable": True,
     "auto_install": False,
@@ -0,0 +1,2 @@
+from . import vat_statement_communication
+from . import benchmark
@@ -0,0 +1,422 @@
+"""Concurrent-load benchmark of VAT statement communications.
+
+Usage from the command line, on a copy of the production database::
+
+    flectra-bin vsc_benchmark -c flectra.conf -d mydb_copy --year 2024 \\
+        --users 16 --sessions 200 --invoices 500
+
+Usage from ``flectra-bin shell``::
+
+    from flectra.addons.l10n_it_vat_statement_communication.cli.\\
+        benchmark import run_benchmark
+    summary = run_benchmark(env.registry, [1], 2024, users=8, sessions=50)
+
+A synthetic dataset (posted customer and vendor invoices and credit notes
+of a benchmark partner, plus one shared communication per company) is
+committed first. Then ``--sessions`` sessions run on ``--users`` threads,
+one cursor each, like accountants working at month end: every session
+creates a new communication (identificativo allocation) or reuses the
+shared one of its company (``--shared-ratio``, contention on the import
+lock and on the unlink/recreate of VP tables), imports all periods from
+invoices and builds the XML file.
+
+Sessions are rolled back unless ``--commit`` is given. Duplicate
+identifiers and serialization failures only show up when concurrent
+transactions commit. A monitor thread samples ``pg_stat_activity`` to
+measure sessions blocked on locks. The dataset is removed at the end
+unless ``--keep-dataset`` is given. A JSON summary is printed on stdout:
+throughput, latency percentiles per phase, lock waits and failures by
+kind.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from lxml import etree
+from psycopg2 import errors
+
+from flectra import SUPERUSER_ID, api
+from flectra.cli import Command
+from flectra.exceptions import ValidationError
+from flectra.modules.registry import Registry
+from flectra.tools import config
+
+_logger = logging.getLogger(__name__)
+
+BENCHMARK_PARTNER_REF = "vsc_benchmark"
+INVOICE_TYPES = ("out_invoice", "out_invoice", "out_refund",
+                 "in_invoice", "in_invoice", "in_refund")
+PHASES = ("create", "import", "export")
+# Esiti delle sessioni, nell'ordine del riepilogo
+OUTCOMES = (
+    "ok",
+    "import_running",
+    "lock_not_available",
+    "serialization_failure",
+    "deadlock",
+    "unique_violation",
+    "validation_error",
+    "error",
+)
+
+
+def _percentiles(values):
+    """Conteggio, media e percentili (nearest rank) in millisecondi"""
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def rank(q):
+        return values[max(math.ceil(q * len(values)) - 1, 0)] * 1000
+
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values) * 1000, 1),
+        "p50": round(rank(0.50), 1),
+        "p95": round(rank(0.95), 1),
+        "p99": round(rank(0.99), 1),
+        "max": round(values[-1] * 1000, 1),
+    }
+
+
+def _classify_error(error):
+    """Esito di una sessione fallita, risalendo la catena delle eccezioni"""
+    kinds = (
+        (errors.LockNotAvailable, "lock_not_available"),
+        (errors.SerializationFailure, "serialization_failure"),
+        (errors.DeadlockDetected, "deadlock"),
+        (errors.UniqueViolation, "unique_violation"),
+        (ValidationError, "validation_error"),
+    )
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        for error_class, kind in kinds:
+            if isinstance(error, error_class):
+                return kind
+        error = error.__cause__ or error.__context__
+    return "error"
+
+
+def _get_companies(env, company_ids):
+    if company_ids:
+        return env["res.company"].browse(company_ids)
+    return env["res.company"].search([])
+
+
+def _create_dataset(registry, company_ids, year, invoices, seed):
+    """Fatture registrate sintetiche e comunicazioni condivise, confermate.
+
+    Restituisce (id partner, {id società: id comunicazione condivisa}).
+    """
+    rng = random.Random(seed)
+    with registry.cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        partner = env["res.partner"].create(
+            {"name": "VAT statement benchmark", "ref": BENCHMARK_PARTNER_REF}
+        )
+        shared = {}
+        for company in _get_companies(env, company_ids):
+            taxes = {
+                use: env["account.tax"].search(
+                    [
+                        ("company_id", "=", company.id),
+                        ("type_tax_use", "=", use),
+                        ("amount_type", "=", "percent"),
+                    ],
+                    limit=1,
+                )
+                for use in ("sale", "purchase")
+            }
+            moves_vals = []
+            for number in range(invoices):
+                move_type = rng.choice(INVOICE_TYPES)
+                tax = taxes["sale" if move_type.startswith("out") else "purchase"]
+                moves_vals.append(
+                    {
+                        "move_type": move_type,
+                        "partner_id": partner.id,
+                        "invoice_date": date(
+                            year, rng.randint(1, 12), rng.randint(1, 28)
+                        ),
+                        "invoice_line_ids": [
+                            (
+                                0,
+                                0,
+                                {
+                                    "name": "Benchmark line %s" % number,
+                                    "quantity": 1,
+                                    "price_unit": round(rng.uniform(10, 5000), 2),
+                                    "tax_ids": [(6, 0, tax.ids)],
+                                },
+                            )
+                        ],
+                    }
+                )
+            if moves_vals:
+                env["account.move"].with_company(company).create(
+                    moves_vals
+                ).action_post()
+            comunicazione_model = env["comunicazione.liquidazione"].with_company(
+                company
+            )
+            shared[company.id] = comunicazione_model.create(
+                comunicazione_model._get_headless_communication_vals(company, year)
+            ).id
+        cr.commit()
+        return partner.id, shared
+
+
+def _remove_dataset(registry, partner_id, comunicazione_ids):
+    with registry.cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        env["comunicazione.liquidazione"].browse(comunicazione_ids).exists().unlink()
+        moves = env["account.move"].search([("partner_id", "=", partner_id)])
+        moves.button_draft()
+        moves.with_context(force_delete=True).unlink()
+        env["res.partner"].browse(partner_id).unlink()
+        cr.commit()
+
+
+def _run_session(registry, company_id, year, period_type, shared_id, commit):
+    """Una sessione utente su un proprio cursore: crea (o riprende) la
+    comunicazione, importa tutti i periodi dalle fatture ed esporta l'XML"""
+    result = {
+        "company_id": company_id,
+        "shared": bool(shared_id),
+        "outcome": "ok",
+        "phases": {},
+        "communication_id": False,
+    }
+    start = time.perf_counter()
+    with registry.cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        company = env["res.company"].browse(company_id)
+        comunicazione_model = env["comunicazione.liquidazione"].with_company(company)
+        try:
+            phase_start = time.perf_counter()
+            if shared_id:
+                comunicazione = comunicazione_model.browse(shared_id)
+            else:
+                comunicazione = comunicazione_model.create(
+                    comunicazione_model._get_headless_communication_vals(company, year)
+                )
+                env.flush_all()
+            result["phases"]["create"] = time.perf_counter() - phase_start
+
+            phase_start = time.perf_counter()
+            action = env["comunicazione.liquidazione.import.wizard"].create(
+                {
+                    "comunicazione_id": comunicazione.id,
+                    "year": year,
+                    "period_type": period_type,
+                    "create_all_periods": True,
+                    "force_overwrite": True,
+                }
+            ).action_import_data()
+            env.flush_all()
+            result["phases"]["import"] = time.perf_counter() - phase_start
+            running = comunicazione_model._import_running_notification()
+            if action["params"]["title"] == running["params"]["title"]:
+                result["outcome"] = "import_running"
+            elif action["params"]["type"] == "warning":
+                result["outcome"] = "error"
+                result["message"] = action["params"]["message"]
+            else:
+                phase_start = time.perf_counter()
+                etree.tostring(comunicazione._build_export_xml(), encoding="utf8")
+                result["phases"]["export"] = time.perf_counter() - phase_start
+
+            if commit:
+                cr.commit()
+                result["communication_id"] = not shared_id and comunicazione.id
+            else:
+                cr.rollback()
+        except Exception as e:
+            cr.rollback()
+            result["outcome"] = _classify_error(e)
+            result["message"] = (str(e).strip().splitlines() or [repr(e)])[0]
+    result["latency"] = time.perf_counter() - start
+    return result
+
+
+class LockMonitor(threading.Thread):
+    """Campiona pg_stat_activity: sessioni del database in attesa di un lock"""
+
+    def __init__(self, registry, interval=0.05):
+        super().__init__(daemon=True)
+        self.registry = registry
+        self.interval = interval
+        self.samples = 0
+        self.blocked_samples = 0
+        self.blocked_seconds = 0.0
+        self.max_blocked = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        with self.registry.cursor() as cr:
+            while not self._stop_event.is_set():
+                cr.execute(
+                    """
+                    SELECT COUNT(*) FROM pg_stat_activity
+                     WHERE datname = current_database()
+                       AND wait_event_type = 'Lock'
+                    """
+                )
+                blocked = cr.fetchone()[0]
+                # Le statistiche sono fissate per transazione: una per campione
+                cr.rollback()
+                self.samples += 1
+                if blocked:
+                    self.blocked_samples += 1
+                    self.blocked_seconds += blocked * self.interval
+                    self.max_blocked = max(self.max_blocked, blocked)
+                self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def summary(self):
+        return {
+            "samples": self.samples,
+            "blocked_samples": self.blocked_samples,
+            "max_blocked_sessions": self.max_blocked,
+            "blocked_session_seconds": round(self.blocked_seconds, 2),
+        }
+
+
+def run_benchmark(registry, company_ids, year, period_type="quarter", users=8,
+                  sessions=100, invoices=200, shared_ratio=0.5, commit=False,
+                  keep_dataset=False, seed=0):
+    """Esegue il carico concorrente e restituisce il riepilogo"""
+    partner_id, shared = _create_dataset(registry, company_ids, year, invoices, seed)
+    rng = random.Random(seed)
+    companies = sorted(shared)
+    plan = [
+        (
+            companies[number % len(companies)],
+            rng.random() < shared_ratio,
+        )
+        for number in range(sessions)
+    ] if companies else []
+
+    _logger.info(
+        "VAT statement benchmark: %s sessions on %s threads, %s companies",
+        len(plan), users, len(companies),
+    )
+    monitor = LockMonitor(registry)
+    monitor.start()
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=max(users, 1)) as executor:
+            futures = [
+                executor.submit(
+                    _run_session, registry, company_id, year, period_type,
+                    shared[company_id] if use_shared else False, commit,
+                )
+                for company_id, use_shared in plan
+            ]
+            results = [future.result() for future in futures]
+    finally:
+        duration = time.perf_counter() - start
+        monitor.stop()
+
+    if not keep_dataset:
+        created = [result["communication_id"] for result in results
+                   if result["communication_id"]]
+        _remove_dataset(registry, partner_id, list(shared.values()) + created)
+
+    outcomes = Counter(result["outcome"] for result in results)
+    messages = {}
+    for result in results:
+        if result.get("message"):
+            messages.setdefault(result["outcome"], [])
+            if len(messages[result["outcome"]]) < 5:
+                messages[result["outcome"]].append(result["message"])
+    return {
+        "year": year,
+        "period_type": period_type,
+        "users": users,
+        "sessions": len(results),
+        "invoices_per_company": invoices,
+        "committed": commit,
+        "duration": round(duration, 3),
+        "throughput": round(outcomes["ok"] / duration, 2) if duration else 0,
+        "outcomes": {outcome: outcomes[outcome] for outcome in OUTCOMES},
+        "latency_ms": dict(
+            [("session", _percentiles([result["latency"] for result in results]))]
+            + [
+                (phase, _percentiles([
+                    result["phases"][phase] for result in results
+                    if phase in result["phases"]
+                ]))
+                for phase in PHASES
+            ]
+        ),
+        "lock_waits": dict(
+            monitor.summary(),
+            import_running=outcomes["import_running"],
+            lock_not_available=outcomes["lock_not_available"],
+        ),
+        "serialization_failures": outcomes["serialization_failure"]
+        + outcomes["deadlock"],
+        "messages": messages,
+    }
+
+
+class VatStatementCommunicationBenchmark(Command):
+    """Concurrent-load benchmark of VAT statement communications"""
+
+    name = "vsc_benchmark"
+
+    def run(self, cmdargs):
+        parser = argparse.ArgumentParser(
+            prog="%s vsc_benchmark" % os.path.basename(sys.argv[0]),
+            description=self.__doc__,
+        )
+        parser.add_argument("--company", type=int, action="append", default=[],
+                            help="Company id, may be repeated (default: all)")
+        parser.add_argument("--year", type=int, required=True)
+        parser.add_argument("--period-type", choices=["month", "quarter"],
+                            default="quarter")
+        parser.add_argument("--users", type=int, default=8,
+                            help="Concurrent sessions, one cursor each")
+        parser.add_argument("--sessions", type=int, default=100)
+        parser.add_argument("--invoices", type=int, default=200,
+                            help="Synthetic invoices per company")
+        parser.add_argument("--shared-ratio", type=float, default=0.5,
+                            help="Share of sessions importing into the shared "
+                                 "communication of the company")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--commit", action="store_true",
+                            help="Commit each session instead of rolling it back")
+        parser.add_argument("--keep-dataset", action="store_true",
+                            help="Keep the synthetic invoices and communications")
+        args, server_args = parser.parse_known_args(cmdargs)
+
+        config.parse_config(server_args)
+        dbname = config["db_name"]
+        if not dbname:
+            parser.error("a database is required (-d)")
+        if args.users + 2 > config["db_maxconn"]:
+            parser.error("--users must be lower than db_maxconn - 1")
+        registry = Registry(dbname)
+        summary = run_benchmark(
+            registry, args.company, args.year, period_type=args.period_type,
+            users=args.users, sessions=args.sessions, invoices=args.invoices,
+            shared_ratio=args.shared_ratio, commit=args.commit,
+            keep_dataset=args.keep_dataset, seed=args.seed,
+        )
+        json.dump(summary, sys.stdout, indent=2, default=str)
+        sys.stdout.write("\n")
@@ -0,0 +1,160 @@
+"""Headless generation of VAT statement communications.
+
+Usage from the command line::
+
+    flectra-bin vsc_export -c flectra.conf -d mydb --year 2024 \\
+        --period-type quarter --periods 3 --company 1 --company 4 \\
+        --output-dir /srv/lipe/2024Q3
+
+Usage from ``flectra-bin shell``::
+
+    from flectra.addons.l10n_it_vat_statement_communication.cli.\\
+        vat_statement_communication import run_headless
+    summary = run_headless(env.registry, [1, 4], 2024, "quarter", [3], "/tmp")
+
+For every company the communication of the year is reused (or created from
+the company data), VP tables are imported from invoices, the communication
+is checked with the pre-flight rules and the XML file is written to the
+output directory. A JSON summary is printed on stdout; the exit status is 1
+when at least one company failed.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from flectra import SUPERUSER_ID, api
+from flectra.cli import Command
+from flectra.modules.registry import Registry
+from flectra.tools import config
+
+_logger = logging.getLogger(__name__)
+
+
+def _get_communication_ids(registry, company_ids, year, commit=True):
+    """Comunicazioni da elaborare, create in sequenza per non generare
+    identificativi duplicati tra i thread.
+
+    Senza commit le comunicazioni mancanti non vengono create qui (sarebbero
+    confermate): per quelle società il valore è False e la comunicazione
+    viene creata nella transazione annullata di _process_company.
+    """
+    with registry.cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        comunicazione_model = env["comunicazione.liquidazione"]
+        companies = env["res.company"].browse(company_ids) if company_ids else (
+            env["res.company"].search([])
+        )
+        result = {}
+        for company in companies:
+            if not commit:
+                result[company.id] = comunicazione_model.search(
+                    [("company_id", "=", company.id), ("year", "=", year)],
+                    order="id desc",
+                    limit=1,
+                ).id
+                continue
+            try:
+                with cr.savepoint():
+                    result[company.id] = comunicazione_model.with_company(
+                        company
+                    )._get_headless_communication(company, year).id
+            except Exception as e:
+                result[company.id] = e
+        return result
+
+
+def _process_company(registry, company_id, comunicazione_id, year, period_type,
+                     periods, output_dir, commit):
+    with registry.cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        company = env["res.company"].browse(company_id)
+        comunicazione_model = env["comunicazione.liquidazione"].with_company(company)
+        try:
+            if comunicazione_id:
+                comunicazione = comunicazione_model.browse(comunicazione_id)
+            else:
+                comunicazione = comunicazione_model._get_headless_communication(
+                    company, year
+                )
+            result = comunicazione._headless_run(period_type, periods, output_dir)
+        except Exception as e:
+            _logger.exception("VAT statement communication failed for %s", company.name)
+            cr.rollback()
+            return {"company_id": company_id, "company": company.name, "errors": [str(e)]}
+        if commit:
+            cr.commit()
+        else:
+            cr.rollback()
+        return result
+
+
+def run_headless(registry, company_ids, year, period_type, periods, output_dir,
+                 workers=4, commit=True):
+    """Elabora le società in parallelo, un cursore per thread"""
+    os.makedirs(output_dir, exist_ok=True)
+    communications = _get_communication_ids(registry, company_ids, year, commit)
+    results = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = []
+        for company_id, comunicazione_id in communications.items():
+            if isinstance(comunicazione_id, Exception):
+                results.append({"company_id": company_id, "errors": [str(comunicazione_id)]})
+                continue
+            futures.append(
+                executor.submit(
+                    _process_company, registry, company_id, comunicazione_id,
+                    year, period_type, periods, output_dir, commit,
+                )
+            )
+        results += [future.result() for future in futures]
+    failed = [result for result in results if result.get("errors")]
+    return {
+        "year": year,
+        "period_type": period_type,
+        "periods": periods,
+        "output_dir": output_dir,
+        "processed": len(results),
+        "failed": len(failed),
+        "results": results,
+    }
+
+
+class VatStatementCommunicationExport(Command):
+    """Import, validate and export VAT statement communications"""
+
+    name = "vsc_export"
+
+    def run(self, cmdargs):
+        parser = argparse.ArgumentParser(
+            prog="%s vsc_export" % os.path.basename(sys.argv[0]),
+            description=self.__doc__,
+        )
+        parser.add_argument("--company", type=int, action="append", default=[],
+                            help="Company id, may be repeated (default: all)")
+        parser.add_argument("--year", type=int, required=True)
+        parser.add_argument("--period-type", choices=["month", "quarter"],
+                            default="quarter")
+        parser.add_argument("--periods", type=int, nargs="*", default=[],
+                            help="Months or quarters to import (default: all)")
+        parser.add_argument("--output-dir", required=True)
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Write the files but roll back database changes")
+        args, server_args = parser.parse_known_args(cmdargs)
+
+        config.parse_config(server_args)
+        dbname = config["db_name"]
+        if not dbname:
+            parser.error("a database is required (-d)")
+        registry = Registry(dbname)
+        summary = run_headless(
+            registry, args.company, args.year, args.period_type, args.periods,
+            args.output_dir, workers=args.workers, commit=not args.dry_run,
+        )
+        json.dump(summary, sys.stdout, indent=2, default=str)
+        sys.stdout.write("\n")
+        sys.exit(1 if summary["failed"] else 0)
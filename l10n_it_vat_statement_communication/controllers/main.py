@@ -0,0 +1,115 @@
+import hashlib
+from datetime import timezone
+
+from flectra import http
+from flectra.http import request
+
+VP_SUMMARY_FIELDS = [
+    "comunicazione_id",
+    "period_type",
+    "month",
+    "quarter",
+    "imponibile_operazioni_attive",
+    "imponibile_operazioni_passive",
+    "iva_esigibile",
+    "iva_detratta",
+    "iva_da_versare",
+    "iva_a_credito",
+]
+
+
+class VatStatementCommunicationController(http.Controller):
+    """Riepiloghi VP in JSON per strumenti di BI, con cache condizionale"""
+
+    @http.route(
+        "/l10n_it_vat_statement_communication/vp/<int:comunicazione_id>",
+        type="http",
+        auth="user",
+        methods=["GET"],
+    )
+    def vp_summary(self, comunicazione_id, **kwargs):
+        comunicazioni = request.env["comunicazione.liquidazione"].search(
+            [("id", "=", comunicazione_id)]
+        )
+        if not comunicazioni:
+            return request.not_found()
+        return self._vp_summary_response(comunicazioni)
+
+    @http.route(
+        "/l10n_it_vat_statement_communication/vp/year/<int:year>",
+        type="http",
+        auth="user",
+        methods=["GET"],
+    )
+    def vp_summary_year(self, year, **kwargs):
+        comunicazioni = request.env["comunicazione.liquidazione"].search(
+            [("year", "=", year)], order="company_id, identificativo"
+        )
+        return self._vp_summary_response(comunicazioni)
+
+    def _get_validators(self, comunicazioni):
+        """ETag e Last-Modified dalle date di modifica, senza leggere i record"""
+        vp_model = request.env["comunicazione.liquidazione.vp"]
+        [(comunicazione_date,)] = comunicazioni._read_group(
+            [("id", "in", comunicazioni.ids)], aggregates=["write_date:max"]
+        )
+        [(vp_date, vp_count)] = vp_model._read_group(
+            [("comunicazione_id", "in", comunicazioni.ids)],
+            aggregates=["write_date:max", "__count"],
+        )
+        last_modified = max(filter(None, [comunicazione_date, vp_date]), default=None)
+        key = "%s:%s:%s" % (comunicazioni.ids, last_modified, vp_count)
+        etag = hashlib.sha1(key.encode()).hexdigest()
+        if last_modified:
+            last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+        return etag, last_modified
+
+    def _is_not_modified(self, etag):
+        """Solo l'ETag decide la risposta 304: la data di ultima modifica
+        non cambia quando una comunicazione o un quadro VP viene eliminato,
+        quindi If-Modified-Since da solo restituirebbe dati non aggiornati"""
+        if_none_match = request.httprequest.if_none_match
+        return bool(if_none_match) and if_none_match.contains(etag)
+
+    def _vp_summary_response(self, comunicazioni):
+        etag, last_modified = self._get_validators(comunicazioni)
+        headers = [("ETag", '"%s"' % etag), ("Cache-Control", "private, no-cache")]
+        if last_modified:
+            headers.append(
+                ("Last-Modified", last_modified.strftime("%a, %d %b %Y %H:%M:%S GMT"))
+            )
+        if self._is_not_modified(etag):
+            return request.make_response("", headers=headers, status=304)
+        return request.make_json_response(
+            self._get_vp_summary(comunicazioni), headers=headers
+        )
+
+    def _get_vp_summary(self, comunicazioni):
+        rows = request.env["comunicazione.liquidazione.vp"].search_read(
+            [("comunicazione_id", "in", comunicazioni.ids)],
+            VP_SUMMARY_FIELDS,
+            order="comunicazione_id, period_type, month, quarter",
+        )
+        vp_by_comunicazione = {}
+        for row in rows:
+            vp_by_comunicazione.setdefault(row.pop("comunicazione_id")[0], []).append(
+                [row.pop("id")] + [row[name] for name in VP_SUMMARY_FIELDS[1:]]
+            )
+        result = []
+        for comunicazione in comunicazioni.read(["company_id", "year", "identificativo"]):
+            vp_rows = vp_by_comunicazione.get(comunicazione["id"], [])
+            result.append(
+                {
+                    "id": comunicazione["id"],
+                    "company_id": comunicazione["company_id"][0],
+                    "year": comunicazione["year"],
+                    "identificativo": comunicazione["identificativo"],
+                    "vp": vp_rows,
+                    "totals": {
+                        name: round(sum(row[index] for row in vp_rows), 2)
+                        for index, name in enumerate(VP_SUMMARY_FIELDS[1:], start=1)
+                        if index > 3
+                    },
+                }
+            )
+        return {"columns": ["id"] + VP_SUMMARY_FIELDS[1:], "communications": result}
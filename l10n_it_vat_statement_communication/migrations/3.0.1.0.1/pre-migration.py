@@ -0,0 +1,30 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    # Il vincolo period_unique non può essere creato se esistono quadri VP
+    # duplicati: per ogni periodo resta il primo quadro, come in
+    # _sync_vp_rows (dettagli per società e per imposta eliminati a cascata)
+    cr.execute(
+        """
+        DELETE FROM comunicazione_liquidazione_vp vp
+         USING (
+                SELECT id,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY comunicazione_id, period_type, month, quarter
+                           ORDER BY id
+                       ) AS position
+                  FROM comunicazione_liquidazione_vp
+               ) ranked
+         WHERE ranked.id = vp.id
+           AND ranked.position > 1
+        """
+    )
+    if cr.rowcount:
+        _logger.info("Removed %s duplicate VP tables", cr.rowcount)
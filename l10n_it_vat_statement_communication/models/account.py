@@ -1,4 +1,5 @@
-from flectra import fields, models
+from flectra import api, fields, models
+from flectra.tools.sql import column_exists, create_column, create_index
 
 class AccountTax(models.Model):
     _inherit = "account.tax"
@@ -8,8 +9,64 @@ class AccountTax(models.Model):
     )
     vsc_exclude_vat = fields.Boolean(string="Exclude from VAT payable / deducted")
 
+    def write(self, vals):
+        flags = [
+            name for name in ("vsc_exclude_operation", "vsc_exclude_vat") if name in vals
+        ]
+        changed = self.filtered(
+            lambda tax: any(tax[name] != bool(vals[name]) for name in flags)
+        ) if flags else self.browse()
+        res = super().write(vals)
+        if changed:
+            self.env["comunicazione.liquidazione"]._mark_stale_periods(changed)
+        return res
+
 class ResPartner(models.Model):
     """Aggiungiamo codice fiscale al partner se non esiste"""
     _inherit = "res.partner"
     
-    fiscalcode = fields.Char("Fiscal Code", size=16)
\ No newline at end of file
+    fiscalcode = fields.Char("Fiscal Code", size=16)
+
+
+class AccountMove(models.Model):
+    _inherit = "account.move"
+
+    # Chiave del periodo IVA (AAAAMM della data fattura), coperta
+    # dall'indice composito account_move_vsc_period_index
+    vsc_period_key = fields.Integer(
+        string="VAT period key",
+        compute="_compute_vsc_period_key",
+        store=True,
+        help="Year and month of the invoice date (YYYYMM)",
+    )
+
+    @api.depends("invoice_date")
+    def _compute_vsc_period_key(self):
+        for move in self:
+            invoice_date = move.invoice_date
+            move.vsc_period_key = (
+                invoice_date.year * 100 + invoice_date.month if invoice_date else 0
+            )
+
+    def _auto_init(self):
+        # Su tabelle grandi la colonna viene popolata in SQL, non dall'ORM
+        cr = self.env.cr
+        if not column_exists(cr, "account_move", "vsc_period_key"):
+            create_column(cr, "account_move", "vsc_period_key", "int4")
+            cr.execute(
+                """
+                UPDATE account_move
+                   SET vsc_period_key = COALESCE(
+                       EXTRACT(YEAR FROM invoice_date)::integer * 100
+                       + EXTRACT(MONTH FROM invoice_date)::integer, 0)
+                """
+            )
+        res = super()._auto_init()
+        create_index(
+            cr,
+            "account_move_vsc_period_index",
+            "account_move",
+            ["company_id", "vsc_period_key", "move_type"],
+            where="state = 'posted'",
+        )
+        return res
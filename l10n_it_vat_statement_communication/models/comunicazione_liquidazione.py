@@ -1,6 +1,20 @@
+import os
+from datetime import date
+
 from lxml import etree
+from psycopg2.errors import LockNotAvailable, SerializationFailure
+
 from flectra import _, api, fields, models
-from flectra.exceptions import ValidationError, UserError
+from flectra.exceptions import AccessError, ValidationError, UserError
+
+from ..tools import (
+    acconto,
+    fiscalcode,
+    invoice_snapshot,
+    settlement,
+    xml_export,
+    xml_schema,
+)
 
 NS_IV = "urn:www.agenziaentrate.gov.it:specificheTecniche:sco:ivp"
 NS_XSI = "http://www.w3.org/2001/XMLSchema-instance"
@@ -11,6 +25,42 @@ NS_MAP = {
 }
 etree.register_namespace("vi", NS_IV)
 
+# Importi dei quadri VP calcolati dalle fatture
+VP_AMOUNT_FIELDS = (
+    "imponibile_operazioni_attive",
+    "imponibile_operazioni_passive",
+    "iva_esigibile",
+    "iva_detratta",
+)
+
+# Flag di esclusione delle imposte delle righe di una fattura di acquisto
+# (alias m): usato dalle CTE delle fatture
+INVOICE_TAX_FLAGS_JOIN = """LEFT JOIN LATERAL (
+                        SELECT BOOL_OR(COALESCE(tax.vsc_exclude_operation, FALSE))
+                                   AS exclude_operation,
+                               BOOL_OR(COALESCE(tax.vsc_exclude_vat, FALSE))
+                                   AS exclude_vat
+                          FROM account_move_line aml
+                          JOIN account_move_line_account_tax_rel rel
+                            ON rel.account_move_line_id = aml.id
+                          JOIN account_tax tax ON tax.id = rel.account_tax_id
+                         WHERE aml.move_id = m.id
+                           AND aml.display_type = 'product'
+                  ) flags ON m.move_type IN ('in_invoice', 'in_refund')"""
+
+# Riporti e interessi dei quadri VP presi dalle liquidazioni periodiche IVA
+# (account_vat_period_end_statement): campo VP -> campo della liquidazione.
+# I riporti vengono dalla prima liquidazione del periodo, interessi e
+# acconto sono sommati.
+VP_STATEMENT_CARRY_OVER_FIELDS = {
+    "debito_periodo_precedente": "previous_debit_vat_amount",
+    "credito_periodo_precedente": "previous_credit_vat_amount",
+}
+VP_STATEMENT_SUM_FIELDS = {
+    "interessi_dovuti": "interests_debit_vat_amount",
+    "accounto_dovuto": "advance_amount",
+}
+
 class ComunicazioneLiquidazione(models.Model):
     _inherit = ["mail.thread"]
     _name = "comunicazione.liquidazione"
@@ -56,6 +106,11 @@ class ComunicazioneLiquidazione(models.Model):
         for record in self:
             record.vp_count = len(record.quadri_vp_ids)
 
+    @api.depends("quadri_vp_ids.is_stale")
+    def _compute_stale_vp_count(self):
+        for record in self:
+            record.stale_vp_count = len(record.quadri_vp_ids.filtered("is_stale"))
+
     def _get_identificativo(self):
         dichiarazioni = self.search([])
         if dichiarazioni:
@@ -72,6 +127,21 @@ class ComunicazioneLiquidazione(models.Model):
     year = fields.Integer(required=True)
     last_month = fields.Integer(string="Last month")
     liquidazione_del_gruppo = fields.Boolean(string="Group's statement")
+    vat_cash_basis = fields.Boolean(
+        string="Cash basis VAT",
+        help="IVA per cassa: the VAT of invoices is counted in the period of their "
+        "payments, in proportion to the amount reconciled in the period; taxable "
+        "amounts stay in the period of the invoice date",
+    )
+    group_company_ids = fields.Many2many(
+        "res.company",
+        "comunicazione_liquidazione_group_company_rel",
+        "comunicazione_id",
+        "company_id",
+        string="Controlled companies",
+        help="Companies whose VAT data are consolidated in the group's statement "
+        "together with the controlling company",
+    )
     taxpayer_vat = fields.Char(string="Vat", required=True)
     controller_vat = fields.Char(string="Controller TIN")
     taxpayer_fiscalcode = fields.Char(string="Taxpayer Fiscalcode")
@@ -101,6 +171,15 @@ class ComunicazioneLiquidazione(models.Model):
     
     # NUOVO: Campo conteggio per la vista
     vp_count = fields.Integer(string="VP Count", compute="_compute_vp_count")
+    stale_vp_count = fields.Integer(
+        string="Stale VP tables", compute="_compute_stale_vp_count"
+    )
+
+    # Snapshot del database su cui è stata eseguita l'ultima importazione
+    import_snapshot = fields.Char(string="Import snapshot", readonly=True, copy=False)
+    import_snapshot_date = fields.Datetime(
+        string="Import snapshot date", readonly=True, copy=False
+    )
 
     @api.model_create_multi
     def create(self, vals_list):
@@ -115,6 +194,31 @@ class ComunicazioneLiquidazione(models.Model):
             communication._validate()
         return True
 
+    def _get_vat_company_ids(self):
+        """Società i cui dati IVA confluiscono nella comunicazione.
+
+        Per la liquidazione di gruppo: la controllante e le controllate.
+        I dati vengono letti in SQL, senza le regole multi-società: l'utente
+        deve avere accesso a tutte le società.
+        """
+        self.ensure_one()
+        companies = self.company_id
+        if self.liquidazione_del_gruppo:
+            companies |= self.group_company_ids
+        if not self.env.su:
+            forbidden = companies - self.env.user.company_ids
+            if forbidden:
+                raise AccessError(
+                    _("You are not allowed to access the VAT data of %s")
+                    % ", ".join(forbidden.mapped("name"))
+                )
+        return companies.ids
+
+    @api.onchange("liquidazione_del_gruppo")
+    def onchange_liquidazione_del_gruppo(self):
+        if not self.liquidazione_del_gruppo:
+            self.group_company_ids = False
+
     @api.onchange("company_id")
     def onchange_company_id(self):
         if self.company_id:
@@ -135,7 +239,7 @@ class ComunicazioneLiquidazione(models.Model):
         
         # Verifica che ci siano fatture
         invoice_count = self.env['account.move'].search_count([
-            ('company_id', '=', self.company_id.id),
+            ('company_id', 'in', self._get_vat_company_ids()),
             ('state', '=', 'posted')
         ])
         
@@ -158,6 +262,86 @@ class ComunicazioneLiquidazione(models.Model):
             }
         }
 
+    @api.model
+    def _get_headless_communication(self, company, year):
+        """Comunicazione dell'anno per la società, creata se non esiste"""
+        comunicazione = self.search(
+            [("company_id", "=", company.id), ("year", "=", year)],
+            order="id desc",
+            limit=1,
+        )
+        if not comunicazione:
+            comunicazione = self.create(
+                self._get_headless_communication_vals(company, year)
+            )
+        return comunicazione
+
+    @api.model
+    def _get_headless_communication_vals(self, company, year):
+        partner = company.partner_id
+        return {
+            "company_id": company.id,
+            "year": year,
+            "taxpayer_vat": (partner.vat or "")[2:],
+            "taxpayer_fiscalcode": partner.fiscalcode,
+        }
+
+    def _headless_run(self, period_type, periods, output_dir):
+        """Importa, valida ed esporta la comunicazione senza interfaccia.
+
+        periods: numeri di mese o trimestre da importare (tutti se vuoto).
+        Il file XML viene scritto direttamente in output_dir. Restituisce
+        un dizionario serializzabile in JSON con l'esito.
+        """
+        self.ensure_one()
+        prefix = "month" if period_type == "month" else "quarter"
+        wizard_vals = {
+            "comunicazione_id": self.id,
+            "year": self.year,
+            "period_type": period_type,
+            "create_all_periods": not periods,
+        }
+        for number in range(1, 13 if prefix == "month" else 5):
+            wizard_vals[f"{prefix}_{number}"] = number in periods
+        action = self.env["comunicazione.liquidazione.import.wizard"].create(
+            wizard_vals
+        ).action_import_data()
+        if action["params"]["type"] == "warning":
+            return {
+                "company_id": self.company_id.id,
+                "company": self.company_id.name,
+                "communication_id": self.id,
+                "errors": [action["params"]["message"]],
+            }
+
+        result = {
+            "company_id": self.company_id.id,
+            "company": self.company_id.name,
+            "communication_id": self.id,
+            "identificativo": self.identificativo,
+            "periods": len(self.quadri_vp_ids),
+            "errors": self.get_preflight_errors()[self.id],
+            "file": False,
+        }
+        if result["errors"]:
+            return result
+
+        path = os.path.join(output_dir, self._get_export_filename())
+        with open(path + ".part", "wb") as xml_file:
+            etree.ElementTree(self._build_export_xml()).write(
+                xml_file, encoding="utf8", pretty_print=True
+            )
+        os.replace(path + ".part", path)
+        result["file"] = path
+        return result
+
+    def _get_export_filename(self):
+        self.ensure_one()
+        return "{}_LI_{}.xml".format(
+            self.declarant_fiscalcode,
+            str(self.identificativo).rjust(5, "0"),
+        )
+
     def action_view_vp_summary(self):
         """VISUALIZZA RIASSUNTO VP"""
         return {
@@ -169,45 +353,994 @@ class ComunicazioneLiquidazione(models.Model):
             'context': {'default_comunicazione_id': self.id}
         }
 
-    def get_export_xml(self):
-        """Esporta XML secondo specifiche Agenzia Entrate"""
-        self._validate()
-        x1_Fornitura = self._export_xml_get_fornitura()
-        x1_1_Intestazione = self._export_xml_get_intestazione()
+    def _lock_for_import(self):
+        """Blocca la comunicazione per la durata della transazione di import.
 
-        attrs = {"identificativo": str(self.identificativo).zfill(5)}
-        x1_2_Comunicazione = etree.Element(etree.QName(NS_IV, "Comunicazione"), attrs)
-        x1_2_1_Frontespizio = self._export_xml_get_frontespizio()
-        x1_2_Comunicazione.append(x1_2_1_Frontespizio)
+        Il lock di riga viene richiesto senza attesa: se un'altra
+        importazione (manuale o da cron) sta già elaborando la stessa
+        comunicazione, oppure l'ha appena conclusa dopo l'inizio di questa
+        transazione, restituisce False invece di bloccarsi o di riscrivere
+        gli stessi quadri VP.
+        """
+        self.ensure_one()
+        try:
+            with self.env.cr.savepoint(flush=False):
+                self.env.cr.execute(
+                    """
+                    SELECT id FROM comunicazione_liquidazione
+                     WHERE id = %s
+                       FOR NO KEY UPDATE NOWAIT
+                    """,
+                    [self.id],
+                )
+        except (LockNotAvailable, SerializationFailure):
+            return False
+        return True
 
-        x1_2_2_DatiContabili = etree.Element(etree.QName(NS_IV, "DatiContabili"))
-        nr_modulo = 0
-        for quadro in self.quadri_vp_ids:
-            nr_modulo += 1
-            modulo = self.with_context(nr_modulo=nr_modulo)._export_xml_get_dati_modulo(
-                quadro
+    @api.model
+    def _import_running_notification(self):
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("Import already running"),
+                "message": _(
+                    "Another import is running or has just completed for this "
+                    "communication. Please reload it."
+                ),
+                "type": "warning",
+            },
+        }
+
+    def _record_import_snapshot(self):
+        """Registra lo snapshot MVCC su cui vengono lette le fatture.
+
+        Il cursore lavora in REPEATABLE READ: tutte le letture della
+        transazione (fatture di vendita, di acquisto, conteggi, per ogni
+        periodo) vedono lo stesso snapshot, senza lock che blocchino la
+        registrazione di fatture da parte di altri utenti. Lo snapshot e
+        l'istante di inizio transazione vengono salvati sulla comunicazione
+        così che i totali siano riferibili a un momento preciso.
+        """
+        self.env.cr.execute("SHOW transaction_isolation")
+        isolation = self.env.cr.fetchone()[0]
+        if isolation not in ("repeatable read", "serializable"):
+            raise UserError(
+                _(
+                    "VAT data must be imported in a repeatable read transaction, "
+                    "current isolation level is %s"
+                )
+                % isolation
             )
-            x1_2_2_DatiContabili.append(modulo)
-        x1_2_Comunicazione.append(x1_2_2_DatiContabili)
-        
-        # Composizione struttura xml
-        x1_Fornitura.append(x1_1_Intestazione)
-        x1_Fornitura.append(x1_2_Comunicazione)
+        self.env.cr.execute(
+            "SELECT txid_current_snapshot()::text, now() AT TIME ZONE 'UTC'"
+        )
+        snapshot, snapshot_date = self.env.cr.fetchone()
+        # Scrittura diretta: non serve rivalidare la comunicazione
+        super(ComunicazioneLiquidazione, self).write(
+            {"import_snapshot": snapshot, "import_snapshot_date": snapshot_date}
+        )
+        return snapshot
+
+    @api.model
+    def _get_vp_period_key(self, period_type, month, quarter):
+        """Chiave univoca di un periodo VP: (tipo, mese, trimestre).
+
+        Il trimestre 5 (quarto trimestre dei contribuenti trimestrali) ha la
+        chiave del quarto: copre gli stessi mesi (settlement.period_months),
+        quindi gli stessi totali, dettagli e istantanee.
+        """
+        if period_type == "month":
+            return ("month", month or 0, 0)
+        return ("quarter", 0, min(quarter or 0, 4))
+
+    def _get_invoice_moves_cte(self):
+        """CTE "moves" con le fatture registrate che formano i periodi dell'anno.
+
+        Ogni riga riporta fattura, società, mese, segno (note di credito in
+        negativo), quote dell'imponibile e dell'imposta della fattura
+        attribuite al mese (base_share, tax_share), imponibile e imposta già
+        ridotti alle quote e i flag di esclusione delle imposte delle righe:
+        è la base comune dei totali VP e del dettaglio per imposta. I
+        parametri sono quelli di _get_invoice_moves_params.
+        """
+        self.ensure_one()
+        if self.vat_cash_basis:
+            return self._get_invoice_moves_cash_basis_cte()
+        return self._get_invoices_cte() + """,
+            moves AS (
+                SELECT id, company_id, move_type, month, sign,
+                       1 AS base_share,
+                       1 AS tax_share,
+                       amount_untaxed AS base,
+                       amount_tax AS tax,
+                       exclude_operation,
+                       exclude_vat
+                  FROM invoices
+            )
+        """
+
+    def _get_invoices_cte(self):
+        """CTE "invoices": fatture dell'anno per data fattura"""
+        return """
+            invoices AS (
+                SELECT m.id,
+                       m.company_id,
+                       m.move_type,
+                       m.vsc_period_key %% 100 AS month,
+                       CASE WHEN m.move_type IN ('out_invoice', 'in_invoice')
+                            THEN 1 ELSE -1 END AS sign,
+                       COALESCE(m.amount_untaxed, 0) AS amount_untaxed,
+                       COALESCE(m.amount_tax, 0) AS amount_tax,
+                       COALESCE(flags.exclude_operation, FALSE) AS exclude_operation,
+                       COALESCE(flags.exclude_vat, FALSE) AS exclude_vat
+                  FROM account_move m
+                  """ + INVOICE_TAX_FLAGS_JOIN + """
+                 WHERE m.company_id = ANY(%(company_ids)s)
+                   AND m.state = 'posted'
+                   AND m.vsc_period_key BETWEEN %(key_from)s AND %(key_to)s
+                   AND m.move_type IN ('out_invoice', 'out_refund',
+                                       'in_invoice', 'in_refund')
+            )"""
+
+    def _get_invoice_moves_cash_basis_cte(self):
+        """CTE "moves" per l'IVA per cassa.
+
+        L'imponibile delle operazioni resta nel mese della fattura, mentre
+        l'imposta diventa esigibile (o detraibile) nel mese del pagamento:
+        per ogni fattura e mese la quota dell'imposta è il totale delle
+        riconciliazioni parziali datate nel mese (max_date) sulle righe di
+        credito / debito della fattura, diviso per il totale della fattura.
+        Un'unica query su account_partial_reconcile e account_move_line per
+        tutto l'anno.
+        """
+        return self._get_invoices_cte() + """,
+            partials AS (
+                SELECT apr.debit_move_id AS line_id, apr.amount, apr.max_date
+                  FROM account_partial_reconcile apr
+                 WHERE apr.max_date BETWEEN %(date_from)s AND %(date_to)s
+                UNION ALL
+                SELECT apr.credit_move_id AS line_id, apr.amount, apr.max_date
+                  FROM account_partial_reconcile apr
+                 WHERE apr.max_date BETWEEN %(date_from)s AND %(date_to)s
+            ),
+            payments AS (
+                SELECT aml.move_id,
+                       EXTRACT(MONTH FROM p.max_date)::integer AS month,
+                       SUM(p.amount) AS paid
+                  FROM partials p
+                  JOIN account_move_line aml ON aml.id = p.line_id
+                  JOIN account_account account ON account.id = aml.account_id
+                 WHERE aml.company_id = ANY(%(company_ids)s)
+                   AND aml.parent_state = 'posted'
+                   AND account.account_type IN ('asset_receivable', 'liability_payable')
+                 GROUP BY aml.move_id, 2
+            ),
+            moves AS (
+                SELECT id, company_id, move_type, month, sign,
+                       1 AS base_share,
+                       0 AS tax_share,
+                       amount_untaxed AS base,
+                       0 AS tax,
+                       exclude_operation,
+                       exclude_vat
+                  FROM invoices
+                UNION ALL
+                SELECT m.id,
+                       m.company_id,
+                       m.move_type,
+                       p.month,
+                       CASE WHEN m.move_type IN ('out_invoice', 'in_invoice')
+                            THEN 1 ELSE -1 END AS sign,
+                       0 AS base_share,
+                       paid.share AS tax_share,
+                       0 AS base,
+                       COALESCE(m.amount_tax, 0) * paid.share AS tax,
+                       COALESCE(flags.exclude_operation, FALSE) AS exclude_operation,
+                       COALESCE(flags.exclude_vat, FALSE) AS exclude_vat
+                  FROM payments p
+                  JOIN account_move m ON m.id = p.move_id
+                 CROSS JOIN LATERAL (
+                        SELECT LEAST(
+                                   p.paid / NULLIF(ABS(m.amount_total_signed), 0), 1
+                               ) AS share
+                  ) paid
+                  """ + INVOICE_TAX_FLAGS_JOIN + """
+                 WHERE m.state = 'posted'
+                   AND paid.share IS NOT NULL
+                   AND m.move_type IN ('out_invoice', 'out_refund',
+                                       'in_invoice', 'in_refund')
+            )
+        """
+
+    def _flush_invoice_moves(self):
+        self.env["account.move"].flush_model(
+            ["move_type", "state", "company_id", "vsc_period_key",
+             "amount_untaxed", "amount_tax", "amount_total_signed"]
+        )
+        self.env["account.move.line"].flush_model(
+            ["move_id", "display_type", "tax_ids", "company_id", "account_id",
+             "parent_state"]
+        )
+        self.env["account.tax"].flush_model(["vsc_exclude_operation", "vsc_exclude_vat"])
+        if self.vat_cash_basis:
+            self.env["account.partial.reconcile"].flush_model(
+                ["debit_move_id", "credit_move_id", "amount", "max_date"]
+            )
+            self.env["account.account"].flush_model(["account_type"])
+
+    def _get_invoice_moves_params(self, period_type=None, period=None):
+        """Parametri della CTE "moves": tutto l'anno, o il solo mese /
+        trimestre period se indicato"""
+        self.ensure_one()
+        if period:
+            months = settlement.period_months(period_type, period)
+            date_from, date_to = settlement.period_dates(self.year, period_type, period)
+        else:
+            months = [1, 12]
+            date_from, date_to = date(self.year, 1, 1), date(self.year, 12, 31)
+        return {
+            "company_ids": self._get_vat_company_ids(),
+            "key_from": self.year * 100 + months[0],
+            "key_to": self.year * 100 + months[-1],
+            "date_from": date_from,
+            "date_to": date_to,
+        }
+
+    def _get_invoice_vat_totals(
+        self, period_type, breakdown=None, tax_breakdown=None, period=None
+    ):
+        """Totali VP dalle fatture per tutti i periodi dell'anno (o per il
+        solo mese / trimestre period).
+
+        Un'unica query raggruppata per società e mese su account.move, con le
+        stesse regole dell'importazione per singolo periodo (note di credito
+        in negativo, esclusione delle fatture di acquisto con imposte
+        escluse). Per la liquidazione di gruppo la query comprende tutte le
+        società del gruppo. Restituisce {chiave periodo: valori VP}; se
+        breakdown è un dizionario viene riempito con il dettaglio
+        {chiave periodo: {id società: valori VP}}, se tax_breakdown lo è con
+        il dettaglio {chiave periodo: {id imposta: imponibile e imposta}}.
+        """
+        self.ensure_one()
+        self._flush_invoice_moves()
+        self.env.cr.execute(
+            "WITH "
+            + self._get_invoice_moves_cte()
+            + """,
+            contributions AS (
+                SELECT id,
+                       company_id,
+                       month,
+                       move_type IN ('out_invoice', 'out_refund') AS is_sale,
+                       move_type IN ('out_invoice', 'out_refund')
+                           OR NOT exclude_operation AS contributes,
+                       CASE WHEN move_type IN ('out_invoice', 'out_refund')
+                                 OR NOT exclude_operation
+                            THEN sign * base ELSE 0 END AS base,
+                       CASE WHEN move_type IN ('out_invoice', 'out_refund')
+                                 OR NOT (exclude_operation OR exclude_vat)
+                            THEN sign * tax ELSE 0 END AS tax
+                  FROM moves
+            )
+            SELECT company_id,
+                   month,
+                   COALESCE(SUM(base) FILTER (WHERE is_sale), 0),
+                   COALESCE(SUM(base) FILTER (WHERE NOT is_sale), 0),
+                   COALESCE(SUM(tax) FILTER (WHERE is_sale), 0),
+                   COALESCE(SUM(tax) FILTER (WHERE NOT is_sale), 0),
+                   ARRAY_AGG(id ORDER BY id) FILTER (WHERE contributes),
+                   ARRAY_AGG(base ORDER BY id) FILTER (WHERE contributes),
+                   ARRAY_AGG(tax ORDER BY id) FILTER (WHERE contributes)
+              FROM contributions
+             GROUP BY company_id, month
+            """,
+            self._get_invoice_moves_params(period_type, period),
+        )
+        totals = {}
+        snapshots = {}
+        for (
+            company_id, month, attive, passive, esigibile, detratta,
+            move_ids, bases, taxes,
+        ) in self.env.cr.fetchall():
+            key = self._get_vp_period_key(period_type, month, (month - 1) // 3 + 1)
+            targets = [totals.setdefault(key, dict.fromkeys(VP_AMOUNT_FIELDS, 0.0))]
+            if breakdown is not None:
+                targets.append(
+                    breakdown.setdefault(key, {}).setdefault(
+                        company_id, dict.fromkeys(VP_AMOUNT_FIELDS, 0.0)
+                    )
+                )
+            for vals in targets:
+                vals["imponibile_operazioni_attive"] += float(attive)
+                vals["imponibile_operazioni_passive"] += float(passive)
+                vals["iva_esigibile"] += float(esigibile)
+                vals["iva_detratta"] += float(detratta)
+            snapshot = snapshots.setdefault(key, invoice_snapshot.InvoiceSnapshot())
+            for move_id, base, tax in zip(move_ids or [], bases or [], taxes or []):
+                snapshot.add(move_id, float(base), float(tax))
+        vp_model = self.env["comunicazione.liquidazione.vp"]
+        for key, snapshot in snapshots.items():
+            totals[key].update(vp_model._get_invoice_snapshot_values(snapshot))
+        if tax_breakdown is not None:
+            tax_breakdown.update(self._get_invoice_tax_totals(period_type, period))
+        return totals
+
+    def _get_invoice_move_ids(self, period_type, period):
+        """Fatture che concorrono al mese / trimestre period (CTE "moves")"""
+        self.ensure_one()
+        self._flush_invoice_moves()
+        self.env.cr.execute(
+            "WITH " + self._get_invoice_moves_cte() + " SELECT DISTINCT id FROM moves",
+            self._get_invoice_moves_params(period_type, period),
+        )
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    def _get_invoice_tax_totals(self, period_type, period=None):
+        """Imponibile e imposta per imposta di tutti i periodi dell'anno (o
+        del solo mese / trimestre period).
+
+        Stesse fatture e stesse esclusioni dei totali VP (CTE "moves"):
+        l'imponibile viene dalle righe prodotto per ciascuna imposta
+        applicata, l'imposta dalle righe d'imposta. Importi con il segno
+        dei quadri VP (note di credito in negativo). Le imposte delle
+        fatture escluse compaiono con importo zero: il dettaglio è anche
+        l'indice delle imposte da cui dipende ogni periodo.
+        Restituisce {chiave periodo: {id imposta: valori}}.
+        """
+        self.ensure_one()
+        self._flush_invoice_moves()
+        self.env["account.move.line"].flush_model(["tax_line_id", "balance"])
+        self.env.cr.execute(
+            "WITH "
+            + self._get_invoice_moves_cte()
+            + """,
+            tax_lines AS (
+                SELECT mv.month,
+                       mv.move_type IN ('out_invoice', 'out_refund') AS is_sale,
+                       rel.account_tax_id AS tax_id,
+                       CASE WHEN mv.move_type IN ('out_invoice', 'out_refund')
+                                 OR NOT mv.exclude_operation
+                            THEN aml.balance * mv.base_share ELSE 0 END AS base,
+                       0 AS tax
+                  FROM moves mv
+                  JOIN account_move_line aml
+                    ON aml.move_id = mv.id AND aml.display_type = 'product'
+                  JOIN account_move_line_account_tax_rel rel
+                    ON rel.account_move_line_id = aml.id
+                UNION ALL
+                SELECT mv.month,
+                       mv.move_type IN ('out_invoice', 'out_refund') AS is_sale,
+                       aml.tax_line_id AS tax_id,
+                       0 AS base,
+                       CASE WHEN mv.move_type IN ('out_invoice', 'out_refund')
+                                 OR NOT (mv.exclude_operation OR mv.exclude_vat)
+                            THEN aml.balance * mv.tax_share ELSE 0 END AS tax
+                  FROM moves mv
+                  JOIN account_move_line aml
+                    ON aml.move_id = mv.id AND aml.tax_line_id IS NOT NULL
+            )
+            SELECT month,
+                   tax_id,
+                   SUM(CASE WHEN is_sale THEN -base ELSE base END),
+                   SUM(CASE WHEN is_sale THEN -tax ELSE tax END)
+              FROM tax_lines
+             GROUP BY month, tax_id
+            """,
+            self._get_invoice_moves_params(period_type, period),
+        )
+        tax_totals = {}
+        for month, tax_id, base, tax in self.env.cr.fetchall():
+            key = self._get_vp_period_key(period_type, month, (month - 1) // 3 + 1)
+            vals = tax_totals.setdefault(key, {}).setdefault(
+                tax_id, {"amount_base": 0.0, "amount_tax": 0.0}
+            )
+            vals["amount_base"] += float(base)
+            vals["amount_tax"] += float(tax)
+        return tax_totals
+
+    def _sync_vp_rows(self, desired, overwrite=True, unlink_obsolete=True):
+        """Allinea i quadri VP ai periodi desiderati con il minimo di scritture.
+
+        desired: {chiave periodo: valori VP}. Le righe esistenti vengono
+        aggiornate solo nei campi cambiati (se overwrite, una scrittura per
+        gruppo di righe con le stesse modifiche), le mancanti create
+        in un solo batch e, se unlink_obsolete, le righe di periodi non più
+        desiderati (o duplicate) eliminate in un solo batch.
+        Restituisce i conteggi di righe create, aggiornate, invariate,
+        saltate ed eliminate.
+        """
+        self.ensure_one()
+        vp_model = self.env["comunicazione.liquidazione.vp"]
+        currency = self.company_id.currency_id
+        existing = {}
+        obsolete = vp_model
+        for vp in self.quadri_vp_ids:
+            key = self._get_vp_period_key(vp.period_type, vp.month, vp.quarter)
+            if key in existing or key not in desired:
+                obsolete |= vp
+            else:
+                existing[key] = vp
+
+        result = dict(created=0, updated=0, unchanged=0, skipped=0, deleted=0)
+        create_vals = []
+        updates = {}
+        for key, vals in desired.items():
+            vp = existing.get(key)
+            if not vp:
+                period_type, month, quarter = key
+                create_vals.append(
+                    dict(
+                        vals,
+                        comunicazione_id=self.id,
+                        period_type=period_type,
+                        month=month,
+                        quarter=quarter,
+                    )
+                )
+                continue
+            if not overwrite:
+                result["skipped"] += 1
+                continue
+            changes = {
+                name: value
+                for name, value in vals.items()
+                if (
+                    not currency.is_zero(vp[name] - value)
+                    if isinstance(value, float)
+                    else vp[name] != value
+                )
+            }
+            if changes:
+                updates.setdefault(tuple(sorted(changes.items())), []).append(vp.id)
+                result["updated"] += 1
+            else:
+                result["unchanged"] += 1
+
+        # Le righe con le stesse modifiche (tipicamente i periodi azzerati)
+        # vengono aggiornate con un'unica scrittura
+        for changes, vp_ids in updates.items():
+            vp_model.browse(vp_ids).write(dict(changes))
+        if unlink_obsolete and obsolete:
+            result["deleted"] = len(obsolete)
+            obsolete.unlink()
+        if create_vals:
+            vp_model.create(create_vals)
+            result["created"] = len(create_vals)
+        return result
+
+    def _has_vat_statements(self):
+        return "account.vat.period.end.statement" in self.env
+
+    def _get_statement_vat_totals(self, period_type, tax_breakdown=None):
+        """Valori VP dalle liquidazioni periodiche IVA dell'anno.
+
+        Il periodo di una liquidazione va dalla prima all'ultima data dei
+        date.range collegati (vat_statement_id) e la liquidazione viene
+        assegnata al mese o trimestre che lo contiene. Intervalli,
+        liquidazioni e righe a debito / a credito vengono letti in blocco.
+        Se le righe delle liquidazioni non riportano l'imponibile, questo
+        viene preso dalla query raggruppata sulle fatture.
+        Restituisce ({chiave periodo: valori VP}, [liquidazioni scartate]);
+        se tax_breakdown è un dizionario viene riempito con il dettaglio per
+        imposta come in _get_invoice_vat_totals.
+        """
+        self.ensure_one()
+        if not self._has_vat_statements():
+            raise UserError(_("VAT period end statements are not installed"))
+        statement_model = self.env["account.vat.period.end.statement"]
+        bounds = {}
+        for date_range in self.env["date.range"].search_read(
+            [
+                ("vat_statement_id", "!=", False),
+                ("date_start", ">=", date(self.year, 1, 1)),
+                ("date_end", "<=", date(self.year, 12, 31)),
+            ],
+            ["vat_statement_id", "date_start", "date_end"],
+        ):
+            statement_id = date_range["vat_statement_id"][0]
+            start, end = bounds.get(
+                statement_id, (date_range["date_start"], date_range["date_end"])
+            )
+            bounds[statement_id] = (
+                min(start, date_range["date_start"]),
+                max(end, date_range["date_end"]),
+            )
+
+        statement_fields = [
+            name
+            for name in [
+                *VP_STATEMENT_CARRY_OVER_FIELDS.values(),
+                *VP_STATEMENT_SUM_FIELDS.values(),
+            ]
+            if name in statement_model._fields
+        ]
+        statements = statement_model.search_read(
+            [
+                ("id", "in", list(bounds)),
+                ("company_id", "in", self._get_vat_company_ids()),
+            ],
+            ["display_name", *statement_fields],
+        )
+        statements.sort(key=lambda statement: bounds[statement["id"]])
+
+        totals = {}
+        statement_keys = {}
+        discarded = []
+        for statement in statements:
+            start, end = bounds[statement["id"]]
+            quarter = (start.month - 1) // 3 + 1
+            if period_type == "month" and start.month == end.month:
+                key = self._get_vp_period_key("month", start.month, 0)
+            elif period_type == "quarter" and quarter == (end.month - 1) // 3 + 1:
+                key = self._get_vp_period_key("quarter", 0, quarter)
+            else:
+                discarded.append(statement["display_name"])
+                continue
+            statement_keys[statement["id"]] = key
+            vals = totals.get(key)
+            if vals is None:
+                vals = totals[key] = dict.fromkeys(
+                    [*VP_AMOUNT_FIELDS, *VP_STATEMENT_CARRY_OVER_FIELDS,
+                     *VP_STATEMENT_SUM_FIELDS],
+                    0.0,
+                )
+                for vp_field, statement_field in VP_STATEMENT_CARRY_OVER_FIELDS.items():
+                    vals[vp_field] = statement.get(statement_field) or 0.0
+                # I valori non vengono dalle fatture: l'istantanea delle
+                # fatture di un'importazione precedente non vale più
+                vals.update(invoice_snapshot=False, invoice_snapshot_count=0)
+            for vp_field, statement_field in VP_STATEMENT_SUM_FIELDS.items():
+                vals[vp_field] += statement.get(statement_field) or 0.0
+
+        with_base = True
+        for lines_field, tax_field, base_field in (
+            ("debit_vat_account_line_ids", "iva_esigibile", "imponibile_operazioni_attive"),
+            ("credit_vat_account_line_ids", "iva_detratta", "imponibile_operazioni_passive"),
+        ):
+            field = statement_model._fields[lines_field]
+            line_model = self.env[field.comodel_name]
+            has_base = "base_amount" in line_model._fields
+            with_base = with_base and has_base
+            for statement, tax, amount, *base in line_model._read_group(
+                [(field.inverse_name, "in", list(statement_keys))],
+                [field.inverse_name, "tax_id"],
+                ["amount:sum", *(["base_amount:sum"] if has_base else [])],
+            ):
+                key = statement_keys[statement.id]
+                totals[key][tax_field] += amount
+                if has_base:
+                    totals[key][base_field] += base[0]
+                if tax_breakdown is not None and tax:
+                    tax_vals = tax_breakdown.setdefault(key, {}).setdefault(
+                        tax.id, {"amount_base": 0.0, "amount_tax": 0.0}
+                    )
+                    tax_vals["amount_tax"] += amount
+                    if has_base:
+                        tax_vals["amount_base"] += base[0]
+
+        if not with_base and totals:
+            invoice_totals = self._get_invoice_vat_totals(period_type)
+            for key, vals in totals.items():
+                for base_field in (
+                    "imponibile_operazioni_attive", "imponibile_operazioni_passive"
+                ):
+                    vals[base_field] = invoice_totals.get(key, {}).get(base_field, 0.0)
+        return totals, discarded
+
+    def _sync_vp_breakdowns(self, keys, breakdown, tax_breakdown):
+        """Riscrive il dettaglio per società e per imposta dei quadri VP.
+
+        keys: chiavi dei periodi da aggiornare; breakdown e tax_breakdown
+        come riempiti da _get_invoice_vat_totals. Il dettaglio per società
+        viene tenuto solo per la liquidazione di gruppo.
+        """
+        self.ensure_one()
+        keys = set(keys)
+        quadri = self.quadri_vp_ids.filtered(
+            lambda vp: self._get_vp_period_key(vp.period_type, vp.month, vp.quarter)
+            in keys
+        )
+        if not self.liquidazione_del_gruppo:
+            breakdown = {}
+        self._replace_vp_detail_lines(quadri, "group_line_ids", "company_id", breakdown)
+        self._replace_vp_detail_lines(quadri, "tax_line_ids", "tax_id", tax_breakdown)
+        quadri.filtered("is_stale").write({"is_stale": False})
+
+    def _replace_vp_detail_lines(self, quadri, field_name, detail_field, breakdown):
+        """Sostituisce le righe di dettaglio con un'unica eliminazione e
+        un'unica creazione. breakdown: {chiave periodo: {id: valori}}"""
+        quadri[field_name].unlink()
+        return self.env[quadri._fields[field_name].comodel_name].create(
+            [
+                dict(vals, vp_id=quadro.id, **{detail_field: detail_id})
+                for quadro in quadri
+                for detail_id, vals in breakdown.get(
+                    self._get_vp_period_key(
+                        quadro.period_type, quadro.month, quadro.quarter
+                    ),
+                    {},
+                ).items()
+            ]
+        )
+
+    def _get_invoice_anomalies(self, date_from, date_to):
+        """Fatture del periodo che l'importazione non conteggia correttamente.
+
+        Un'unica query raggruppata sulle fatture (bozze e registrate) con
+        data fattura, o data contabile se manca, nel periodo:
+
+        * no_invoice_date: registrate senza data fattura;
+        * draft: in bozza;
+        * no_tax: registrate senza alcuna imposta;
+        * partial_exclusion: fatture di acquisto con imposte escluse solo su
+          una parte delle righe (viene esclusa l'intera fattura).
+
+        Restituisce {codice anomalia: [id fatture]}.
+        """
+        self.ensure_one()
+        self.env["account.move"].flush_model(
+            ["move_type", "state", "company_id", "invoice_date", "date"]
+        )
+        self.env["account.move.line"].flush_model(
+            ["move_id", "display_type", "tax_ids", "tax_line_id"]
+        )
+        self.env["account.tax"].flush_model(["vsc_exclude_operation", "vsc_exclude_vat"])
+        self.env.cr.execute(
+            """
+            WITH moves AS (
+                SELECT m.id,
+                       m.state,
+                       m.move_type,
+                       m.invoice_date,
+                       lines.product_lines,
+                       lines.taxed_lines,
+                       lines.excluded_lines,
+                       lines.tax_lines
+                  FROM account_move m
+                  LEFT JOIN LATERAL (
+                        SELECT COUNT(DISTINCT aml.id) FILTER (
+                                   WHERE aml.display_type = 'product') AS product_lines,
+                               COUNT(DISTINCT aml.id) FILTER (
+                                   WHERE aml.display_type = 'product'
+                                     AND tax.id IS NOT NULL) AS taxed_lines,
+                               COUNT(DISTINCT aml.id) FILTER (
+                                   WHERE aml.display_type = 'product'
+                                     AND (tax.vsc_exclude_operation
+                                          OR tax.vsc_exclude_vat)) AS excluded_lines,
+                               COUNT(DISTINCT aml.id) FILTER (
+                                   WHERE aml.tax_line_id IS NOT NULL) AS tax_lines
+                          FROM account_move_line aml
+                          LEFT JOIN account_move_line_account_tax_rel rel
+                            ON rel.account_move_line_id = aml.id
+                          LEFT JOIN account_tax tax ON tax.id = rel.account_tax_id
+                         WHERE aml.move_id = m.id
+                  ) lines ON TRUE
+                 WHERE m.company_id = ANY(%(company_ids)s)
+                   AND m.state IN ('draft', 'posted')
+                   AND COALESCE(m.invoice_date, m.date)
+                       BETWEEN %(date_from)s AND %(date_to)s
+                   AND m.move_type IN ('out_invoice', 'out_refund',
+                                       'in_invoice', 'in_refund')
+            )
+            SELECT ARRAY_AGG(id ORDER BY id) FILTER (
+                       WHERE state = 'posted' AND invoice_date IS NULL),
+                   ARRAY_AGG(id ORDER BY id) FILTER (WHERE state = 'draft'),
+                   ARRAY_AGG(id ORDER BY id) FILTER (
+                       WHERE state = 'posted'
+                         AND taxed_lines = 0
+                         AND tax_lines = 0),
+                   ARRAY_AGG(id ORDER BY id) FILTER (
+                       WHERE state = 'posted'
+                         AND move_type IN ('in_invoice', 'in_refund')
+                         AND excluded_lines > 0
+                         AND excluded_lines < product_lines)
+              FROM moves
+            """,
+            {
+                "company_ids": self._get_vat_company_ids(),
+                "date_from": date_from,
+                "date_to": date_to,
+            },
+        )
+        no_invoice_date, draft, no_tax, partial_exclusion = self.env.cr.fetchone()
+        return {
+            "no_invoice_date": no_invoice_date or [],
+            "draft": draft or [],
+            "no_tax": no_tax or [],
+            "partial_exclusion": partial_exclusion or [],
+        }
+
+    def _open_anomaly_scan(self, date_from, date_to):
+        """Apre il controllo delle anomalie delle fatture del periodo"""
+        self.ensure_one()
+        wizard = self.env["comunicazione.liquidazione.anomaly.scan"].create(
+            {"comunicazione_id": self.id, "date_from": date_from, "date_to": date_to}
+        )
+        wizard.action_run()
+        return {
+            "name": _("Invoice anomalies"),
+            "type": "ir.actions.act_window",
+            "res_model": wizard._name,
+            "res_id": wizard.id,
+            "view_mode": "form",
+            "target": "new",
+        }
+
+    def _get_ledger_vat_balances(self):
+        """Saldi IVA a debito / a credito per mese dai movimenti contabili.
+
+        Un'unica query raggruppata su account.move.line per tutto l'anno:
+        le righe d'imposta delle tasse di vendita formano l'IVA esigibile,
+        quelle delle tasse di acquisto l'IVA detratta. Le righe delle
+        fatture vengono attribuite ai mesi con le stesse regole dei quadri
+        VP (CTE "moves": data fattura o, con l'IVA per cassa, pagamenti;
+        fatture di acquisto con imposte escluse non conteggiate); le altre
+        registrazioni contano nel mese della data contabile, escluse quelle
+        delle tasse con IVA esclusa e le registrazioni di IVA per cassa
+        generate dalle riconciliazioni, già comprese nelle righe delle
+        fatture. Restituisce {mese: (iva_esigibile, iva_detratta)}.
+        """
+        self.ensure_one()
+        self._flush_invoice_moves()
+        self.env["account.move"].flush_model(["tax_cash_basis_rec_id"])
+        self.env["account.move.line"].flush_model(
+            ["balance", "date", "parent_state", "company_id", "tax_line_id", "move_id"]
+        )
+        self.env["account.tax"].flush_model(["type_tax_use", "vsc_exclude_vat"])
+        self.env.cr.execute(
+            "WITH "
+            + self._get_invoice_moves_cte()
+            + """,
+            tax_lines AS (
+                SELECT mv.month,
+                       aml.balance * mv.tax_share AS balance,
+                       tax.type_tax_use,
+                       mv.move_type IN ('out_invoice', 'out_refund')
+                           OR NOT (mv.exclude_operation OR mv.exclude_vat)
+                           AS included
+                  FROM moves mv
+                  JOIN account_move_line aml
+                    ON aml.move_id = mv.id AND aml.tax_line_id IS NOT NULL
+                  JOIN account_tax tax ON tax.id = aml.tax_line_id
+                UNION ALL
+                SELECT EXTRACT(MONTH FROM aml.date)::integer,
+                       aml.balance,
+                       tax.type_tax_use,
+                       NOT COALESCE(tax.vsc_exclude_vat, FALSE)
+                  FROM account_move_line aml
+                  JOIN account_move m ON m.id = aml.move_id
+                  JOIN account_tax tax ON tax.id = aml.tax_line_id
+                 WHERE aml.company_id = ANY(%(company_ids)s)
+                   AND aml.parent_state = 'posted'
+                   AND aml.date BETWEEN %(date_from)s AND %(date_to)s
+                   AND m.move_type NOT IN ('out_invoice', 'out_refund',
+                                           'in_invoice', 'in_refund')
+                   AND m.tax_cash_basis_rec_id IS NULL
+            )
+            SELECT month,
+                   COALESCE(SUM(-balance) FILTER (
+                       WHERE type_tax_use = 'sale'), 0) AS iva_esigibile,
+                   COALESCE(SUM(balance) FILTER (
+                       WHERE type_tax_use = 'purchase' AND included), 0)
+                       AS iva_detratta
+              FROM tax_lines
+             GROUP BY month
+            """,
+            self._get_invoice_moves_params(),
+        )
+        return {
+            month: (float(iva_esigibile), float(iva_detratta))
+            for month, iva_esigibile, iva_detratta in self.env.cr.fetchall()
+        }
+
+    @api.model
+    def _mark_stale_periods(self, taxes):
+        """Segna da ricalcolare i quadri VP che dipendono dalle imposte.
 
+        La dipendenza è data dal dettaglio per imposta scritto durante
+        l'importazione. Se la società lo prevede, i periodi vengono
+        ricalcolati subito, una comunicazione alla volta.
+        Restituisce i quadri VP coinvolti.
+        """
+        quadri = (
+            self.env["comunicazione.liquidazione.vp.tax"]
+            .sudo()
+            .search([("tax_id", "in", taxes.ids)])
+            .vp_id
+        )
+        if not quadri:
+            return quadri
+        quadri.write({"is_stale": True})
+        for comunicazione in quadri.comunicazione_id:
+            stale = quadri.filtered(lambda vp: vp.comunicazione_id == comunicazione)
+            comunicazione.message_post(
+                body=_(
+                    "VAT exclusion flags changed on taxes %(taxes)s: "
+                    "%(count)s VP tables must be recomputed."
+                )
+                % {"taxes": ", ".join(taxes.mapped("name")), "count": len(stale)}
+            )
+            if comunicazione.company_id.vsc_recompute_on_tax_change:
+                comunicazione._recompute_vp_periods(stale)
+        return quadri
+
+    def _recompute_vp_periods(self, quadri):
+        """Ricalcola solo i quadri VP indicati, dalla stessa fonte da cui
+        sono stati importati (fatture o liquidazioni periodiche IVA).
+
+        Una sola aggregazione per tipo di periodo e fonte; i campi inseriti
+        a mano (riporti, crediti, acconto) non vengono toccati. Restituisce
+        False se è in corso un'importazione sulla comunicazione.
+        """
+        self.ensure_one()
+        if not self._lock_for_import():
+            return False
+        self._record_import_snapshot()
+        vp_model = self.env["comunicazione.liquidazione.vp"]
+        empty_values = dict(
+            dict.fromkeys(VP_AMOUNT_FIELDS, 0.0),
+            **vp_model._get_invoice_snapshot_values(invoice_snapshot.InvoiceSnapshot()),
+        )
+        groups = {}
+        for vp in quadri:
+            source = vp.import_source or "invoices"
+            if source == "statements" and not self._has_vat_statements():
+                # Il modulo delle liquidazioni non è più installato: il quadro
+                # resta da ricalcolare
+                continue
+            groups.setdefault((vp.period_type, source), []).append(
+                self._get_vp_period_key(vp.period_type, vp.month, vp.quarter)
+            )
+        for (period_type, source), keys in groups.items():
+            breakdown, tax_breakdown = {}, {}
+            if source == "statements":
+                totals, __ = self._get_statement_vat_totals(period_type, tax_breakdown)
+            else:
+                totals = self._get_invoice_vat_totals(
+                    period_type, breakdown, tax_breakdown
+                )
+            self._sync_vp_rows(
+                {key: totals.get(key, empty_values) for key in keys},
+                unlink_obsolete=False,
+            )
+            self._sync_vp_breakdowns(keys, breakdown, tax_breakdown)
+        return True
+
+    def action_recompute_stale_periods(self):
+        """Ricalcola i quadri VP segnati da ricalcolare"""
+        for comunicazione in self:
+            stale = comunicazione.quadri_vp_ids.filtered("is_stale")
+            if not stale:
+                continue
+            if not comunicazione._recompute_vp_periods(stale):
+                return comunicazione._import_running_notification()
+            comunicazione.message_post(
+                body=_("%s stale VP tables recomputed") % len(stale)
+            )
+        return True
+
+    def action_check_ledger(self):
+        """Confronta i quadri VP con i saldi dei conti IVA in contabilità"""
+        mismatches = 0
+        for comunicazione in self:
+            balances = comunicazione._get_ledger_vat_balances()
+            rows = []
+            for quadro in comunicazione.quadri_vp_ids:
+                months = quadro._get_period_months()
+                ledger_esigibile = sum(balances.get(m, (0, 0))[0] for m in months)
+                ledger_detratta = sum(balances.get(m, (0, 0))[1] for m in months)
+                quadro.write(
+                    {
+                        "ledger_iva_esigibile": ledger_esigibile,
+                        "ledger_iva_detratta": ledger_detratta,
+                    }
+                )
+                if quadro.ledger_mismatch:
+                    mismatches += 1
+                    rows.append(
+                        "<tr><td>%s</td><td>€ %s</td><td>€ %s</td></tr>"
+                        % (
+                            quadro.month or quadro.quarter,
+                            f"{quadro.iva_esigibile - ledger_esigibile:,.2f}",
+                            f"{quadro.iva_detratta - ledger_detratta:,.2f}",
+                        )
+                    )
+            if rows:
+                comunicazione.message_post(
+                    body=_(
+                        """
+                <div class="alert alert-warning">
+                    <h4>Ledger check: differences found</h4>
+                    <table class="table table-sm">
+                        <tr><th>Period</th><th>Due VAT difference</th><th>Deducted VAT difference</th></tr>
+                        %s
+                    </table>
+                </div>
+                """
+                    )
+                    % "".join(rows)
+                )
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("Ledger check completed"),
+                "message": _("%s periods differ from the VAT account balances")
+                % mismatches
+                if mismatches
+                else _("All periods match the VAT account balances"),
+                "type": "warning" if mismatches else "success",
+            },
+        }
+
+    def get_export_xml(self):
+        """Esporta XML secondo specifiche Agenzia Entrate"""
+        self._validate()
         xml_string = etree.tostring(
-            x1_Fornitura, encoding="utf8", method="xml", pretty_print=True
+            self._build_export_xml(), encoding="utf8", method="xml", pretty_print=True
         )
         return xml_string
 
-    def _validate(self):
-        """Controllo congruità dati della comunicazione"""
+    def _build_export_xml(self):
+        """Albero XML della fornitura, senza controlli di congruità"""
         self.ensure_one()
+        return xml_export.build_fornitura(self._get_export_xml_data())
+
+    def _get_export_xml_data(self):
+        """Valori della comunicazione per tools.xml_export, senza record ORM"""
+        self.ensure_one()
+        return {
+            "identificativo": self.identificativo,
+            "intestazione": self._get_export_xml_intestazione_data(),
+            "frontespizio": self._get_export_xml_frontespizio_data(),
+            "moduli": [
+                self._get_export_xml_modulo_data(quadro) for quadro in self.quadri_vp_ids
+            ],
+        }
+
+    def _get_export_xml_intestazione_data(self):
+        return {
+            "supply_code": self.company_id.vsc_supply_code,
+            "declarant_fiscalcode": self.declarant_fiscalcode,
+            "codice_carica": self.codice_carica_id.code,
+        }
+
+    def _get_export_xml_frontespizio_data(self):
+        return {
+            "taxpayer_fiscalcode": self.taxpayer_fiscalcode,
+            "year": self.year,
+            "taxpayer_vat": self.taxpayer_vat,
+            "controller_vat": self.controller_vat,
+            "last_month": self.last_month,
+            "liquidazione_del_gruppo": self.liquidazione_del_gruppo,
+            "declarant_fiscalcode": self.declarant_fiscalcode,
+            "declarant_sign": self.declarant_sign,
+        }
+
+    def _get_export_xml_modulo_data(self, quadro):
+        return {
+            "period_type": quadro.period_type,
+            "month": quadro.month,
+            "quarter": quadro.quarter,
+            "imponibile_operazioni_attive": quadro.imponibile_operazioni_attive,
+            "imponibile_operazioni_passive": quadro.imponibile_operazioni_passive,
+            "iva_esigibile": quadro.iva_esigibile,
+            "iva_detratta": quadro.iva_detratta,
+            "iva_dovuta_debito": quadro.iva_dovuta_debito,
+            "iva_dovuta_credito": quadro.iva_dovuta_credito,
+        }
+
+    def _get_validation_errors(self):
+        """Elenco di tutti gli errori di congruità dati della comunicazione"""
+        self.ensure_one()
+        errors = []
         # Validazioni base
         if not self.year:
-            raise ValidationError(_("Year required"))
+            errors.append(_("Year required"))
 
         if not self.taxpayer_fiscalcode or len(self.taxpayer_fiscalcode) not in [11, 16]:
-            raise ValidationError(
+            errors.append(
                 _("Taxpayer Fiscalcode is required. Length must be 11 or 16 chars")
             )
 
@@ -216,144 +1349,182 @@ class ComunicazioneLiquidazione(models.Model):
             and len(self.taxpayer_fiscalcode) == 11
             and not self.declarant_fiscalcode
         ):
-            raise ValidationError(
+            errors.append(
                 _("Declarant Fiscalcode is required for company fiscal codes")
             )
 
         # Altre validazioni...
+        if self.group_company_ids and not self.liquidazione_del_gruppo:
+            errors.append(
+                _("Controlled companies can be set only on group's statements")
+            )
+        if self.company_id in self.group_company_ids:
+            errors.append(
+                _("The controlling company cannot be one of the controlled companies")
+            )
         if self.liquidazione_del_gruppo:
             if self.controller_vat:
-                raise ValidationError(
+                errors.append(
                     _("For group's statement, controller's TIN must be empty")
                 )
-            if len(self.taxpayer_fiscalcode) == 16:
-                raise ValidationError(
+            if self.taxpayer_fiscalcode and len(self.taxpayer_fiscalcode) == 16:
+                errors.append(
                     _("Group's statement not valid for 16 character fiscal codes")
                 )
 
+        return errors
+
+    def _validate(self):
+        """Controllo congruità dati della comunicazione"""
+        self.ensure_one()
+        errors = self._get_validation_errors()
+        if errors:
+            raise ValidationError(errors[0])
         return True
 
-    def _export_xml_get_fornitura(self):
-        return etree.Element(etree.QName(NS_IV, "Fornitura"), nsmap=NS_MAP)
+    def _get_vp_consistency_errors(self):
+        """Errori di coerenza dei periodi dei quadri VP"""
+        self.ensure_one()
+        errors = []
+        seen = set()
+        for quadro in self.quadri_vp_ids:
+            key = self._get_vp_period_key(quadro.period_type, quadro.month, quadro.quarter)
+            if key in seen:
+                errors.append(_("Duplicated VP table for period %s") % (key[1] or key[2]))
+            seen.add(key)
+            if quadro.period_type == "month" and not 1 <= quadro.month <= 12:
+                errors.append(_("Invalid month %s in VP table") % quadro.month)
+            if quadro.period_type == "quarter" and not 1 <= quadro.quarter <= 5:
+                errors.append(_("Invalid quarter %s in VP table") % quadro.quarter)
+            if quadro.is_stale:
+                errors.append(
+                    _("VP table for period %s must be recomputed: tax exclusions changed")
+                    % (key[1] or key[2])
+                )
+        if len({key[0] for key in seen}) > 1:
+            errors.append(_("Monthly and quarterly VP tables cannot be mixed"))
+        if len(self.quadri_vp_ids) > 5:
+            errors.append(_("A communication cannot contain more than 5 VP tables"))
+        return errors
 
-    def _export_xml_get_intestazione(self):
-        x1_1_Intestazione = etree.Element(etree.QName(NS_IV, "Intestazione"))
-        
-        # Codice Fornitura
-        x1_1_1_CodiceFornitura = etree.SubElement(
-            x1_1_Intestazione, etree.QName(NS_IV, "CodiceFornitura")
-        )
-        code = self.company_id.vsc_supply_code
-        x1_1_1_CodiceFornitura.text = code
-        
-        # Codice Fiscale Dichiarante
-        if self.declarant_fiscalcode:
-            x1_1_2_CodiceFiscaleDichiarante = etree.SubElement(
-                x1_1_Intestazione, etree.QName(NS_IV, "CodiceFiscaleDichiarante")
-            )
-            x1_1_2_CodiceFiscaleDichiarante.text = str(self.declarant_fiscalcode)
-        
-        # Codice Carica
-        if self.codice_carica_id:
-            x1_1_3_CodiceCarica = etree.SubElement(
-                x1_1_Intestazione, etree.QName(NS_IV, "CodiceCarica")
-            )
-            x1_1_3_CodiceCarica.text = str(self.codice_carica_id.code)
-        
-        return x1_1_Intestazione
+    def get_preflight_errors(self):
+        """Controlli pre-invio di tutte le comunicazioni in un solo passaggio.
 
-    def _export_xml_get_frontespizio(self):
-        x1_2_1_Frontespizio = etree.Element(etree.QName(NS_IV, "Frontespizio"))
-        
-        # Codice Fiscale
-        x1_2_1_1_CodiceFiscale = etree.SubElement(
-            x1_2_1_Frontespizio, etree.QName(NS_IV, "CodiceFiscale")
-        )
-        x1_2_1_1_CodiceFiscale.text = str(self.taxpayer_fiscalcode) if self.taxpayer_fiscalcode else ""
-        
-        # Anno Imposta
-        x1_2_1_2_AnnoImposta = etree.SubElement(
-            x1_2_1_Frontespizio, etree.QName(NS_IV, "AnnoImposta")
-        )
-        x1_2_1_2_AnnoImposta.text = str(self.year)
-        
-        # Partita IVA
-        x1_2_1_3_PartitaIVA = etree.SubElement(
-            x1_2_1_Frontespizio, etree.QName(NS_IV, "PartitaIVA")
-        )
-        x1_2_1_3_PartitaIVA.text = self.taxpayer_vat
-        
-        # Altri campi del frontespizio...
-        if self.controller_vat:
-            x1_2_1_4_PIVAControllante = etree.SubElement(
-                x1_2_1_Frontespizio, etree.QName(NS_IV, "PIVAControllante")
-            )
-            x1_2_1_4_PIVAControllante.text = self.controller_vat
+        Restituisce {id comunicazione: [errori]} con gli errori di testata,
+        dei codici fiscali (lunghezza e carattere di controllo), di coerenza
+        dei periodi VP e di conformità allo schema XSD. Lo schema viene
+        compilato una sola volta e i dati letti a blocchi dal prefetch ORM.
+        """
+        result = {}
+        for comunicazione in self:
+            errors = comunicazione._get_validation_errors()
+            for label, code in (
+                (_("Taxpayer Fiscalcode"), comunicazione.taxpayer_fiscalcode),
+                (_("Declarant Fiscalcode"), comunicazione.declarant_fiscalcode),
+                (_("Delegate Fiscalcode"), comunicazione.delegate_fiscalcode),
+            ):
+                if code and not fiscalcode.is_valid_fiscalcode(code):
+                    errors.append(_("%s %s has a wrong check character") % (label, code))
+            errors += comunicazione._get_vp_consistency_errors()
+            errors += [
+                _("XSD: %s") % message
+                for message in xml_schema.get_schema_errors(
+                    comunicazione._build_export_xml()
+                )
+            ]
+            result[comunicazione.id] = errors
+        return result
 
-        if self.last_month:
-            x1_2_1_5_UltimoMese = etree.SubElement(
-                x1_2_1_Frontespizio, etree.QName(NS_IV, "UltimoMese")
-            )
-            x1_2_1_5_UltimoMese.text = str(self.last_month)
+    def _get_acconto_proposals(self):
+        """Proposta di acconto IVA per ogni comunicazione.
 
-        # Liquidazione Gruppo
-        x1_2_1_6_LiquidazioneGruppo = etree.SubElement(
-            x1_2_1_Frontespizio, etree.QName(NS_IV, "LiquidazioneGruppo")
+        I quadri VP dell'anno e dell'anno precedente di tutte le
+        comunicazioni vengono letti con un'unica search_read e i tre metodi
+        valutati in modo vettoriale. Restituisce {id comunicazione: valori}.
+        """
+        previous = self.search(
+            [
+                ("company_id", "in", self.company_id.ids),
+                ("year", "in", [year - 1 for year in set(self.mapped("year"))]),
+            ],
+            order="id",
         )
-        x1_2_1_6_LiquidazioneGruppo.text = "1" if self.liquidazione_del_gruppo else "0"
-
-        # Altri campi opzionali...
-        if self.declarant_fiscalcode:
-            x1_2_1_7_CFDichiarante = etree.SubElement(
-                x1_2_1_Frontespizio, etree.QName(NS_IV, "CFDichiarante")
-            )
-            x1_2_1_7_CFDichiarante.text = self.declarant_fiscalcode
-
-        # FirmaDichiarazione
-        x1_2_1_10_FirmaDichiarazione = etree.SubElement(
-            x1_2_1_Frontespizio, etree.QName(NS_IV, "FirmaDichiarazione")
+        previous_by_company = {
+            (comunicazione.company_id.id, comunicazione.year): comunicazione.id
+            for comunicazione in previous
+        }
+        rows = self.env["comunicazione.liquidazione.vp"].search_read(
+            [("comunicazione_id", "in", self.ids + previous.ids)],
+            [
+                "comunicazione_id", "period_type", "month", "quarter",
+                "iva_dovuta_debito", "iva_dovuta_credito", "iva_da_versare",
+                "accounto_dovuto",
+            ],
+            order="comunicazione_id, month, quarter",
         )
-        x1_2_1_10_FirmaDichiarazione.text = "1" if self.declarant_sign else "0"
-
-        return x1_2_1_Frontespizio
-
-    def _export_xml_get_dati_modulo(self, quadro):
-        """Genera sezione Modulo XML"""
-        xModulo = etree.Element(etree.QName(NS_IV, "Modulo"))
-        
-        if quadro.period_type == "month":
-            Mese = etree.SubElement(xModulo, etree.QName(NS_IV, "Mese"))
-            Mese.text = str(quadro.month)
-        else:
-            Trimestre = etree.SubElement(xModulo, etree.QName(NS_IV, "Trimestre"))
-            Trimestre.text = str(quadro.quarter)
+        rows_by_comunicazione = {}
+        for row in rows:
+            rows_by_comunicazione.setdefault(row["comunicazione_id"][0], []).append(row)
 
-        # Campi obbligatori
-        if not self.liquidazione_del_gruppo:
-            TotaleOperazioniAttive = etree.SubElement(
-                xModulo, etree.QName(NS_IV, "TotaleOperazioniAttive")
+        bases = [
+            acconto.bases_from_rows(
+                rows_by_comunicazione.get(comunicazione.id, []),
+                rows_by_comunicazione.get(
+                    previous_by_company.get(
+                        (comunicazione.company_id.id, comunicazione.year - 1)
+                    ),
+                    [],
+                ),
             )
-            TotaleOperazioniAttive.text = f"{quadro.imponibile_operazioni_attive:.2f}".replace(".", ",")
-            
-            TotaleOperazioniPassive = etree.SubElement(
-                xModulo, etree.QName(NS_IV, "TotaleOperazioniPassive")
+            for comunicazione in self
+        ]
+        if not bases:
+            return {}
+        try:
+            methods, amounts, method_amounts = acconto.propose(*zip(*bases))
+        except ImportError as e:
+            raise UserError(
+                _("The numpy library is required to compute the VAT down payment")
+            ) from e
+        return {
+            comunicazione.id: {
+                "metodo_calcolo_acconto": method,
+                "accounto_dovuto": amount,
+                "storico": by_method[0],
+                "previsionale": by_method[1],
+                "analitico": by_method[2],
+            }
+            for comunicazione, method, amount, by_method in zip(
+                self, methods, amounts, method_amounts
             )
-            TotaleOperazioniPassive.text = f"{quadro.imponibile_operazioni_passive:.2f}".replace(".", ",")
-
-        # IVA
-        IvaEsigibile = etree.SubElement(xModulo, etree.QName(NS_IV, "IvaEsigibile"))
-        IvaEsigibile.text = f"{quadro.iva_esigibile:.2f}".replace(".", ",")
-        
-        IvaDetratta = etree.SubElement(xModulo, etree.QName(NS_IV, "IvaDetratta"))
-        IvaDetratta.text = f"{quadro.iva_detratta:.2f}".replace(".", ",")
-
-        # Altri campi del modulo...
-        if quadro.iva_dovuta_debito:
-            IvaDovuta = etree.SubElement(xModulo, etree.QName(NS_IV, "IvaDovuta"))
-            IvaDovuta.text = f"{quadro.iva_dovuta_debito:.2f}".replace(".", ",")
+        }
 
-        if quadro.iva_dovuta_credito:
-            IvaCredito = etree.SubElement(xModulo, etree.QName(NS_IV, "IvaCredito"))
-            IvaCredito.text = f"{quadro.iva_dovuta_credito:.2f}".replace(".", ",")
+    def action_compute_acconto(self):
+        """Apre il calcolo dell'acconto IVA per le comunicazioni selezionate"""
+        wizard = self.env["comunicazione.liquidazione.acconto.wizard"].create(
+            {"comunicazione_ids": [(6, 0, self.ids)]}
+        )
+        wizard.action_compute()
+        return {
+            "name": _("VAT down payment"),
+            "type": "ir.actions.act_window",
+            "res_model": wizard._name,
+            "res_id": wizard.id,
+            "view_mode": "form",
+            "target": "new",
+        }
 
-        return xModulo
\ No newline at end of file
+    def action_preflight_check(self):
+        """Apre il report dei controlli pre-invio per le comunicazioni"""
+        wizard = self.env["comunicazione.liquidazione.preflight"].create(
+            {"comunicazione_ids": [(6, 0, self.ids)]}
+        )
+        wizard.action_run()
+        return {
+            "name": _("Pre-flight check"),
+            "type": "ir.actions.act_window",
+            "res_model": wizard._name,
+            "res_id": wizard.id,
+            "view_mode": "form",
+            "target": "new",
+        }
@@ -1,13 +1,23 @@
+import base64
+
 from flectra import _, api, fields, models
 from flectra.exceptions import UserError
-from datetime import date
-from dateutil.relativedelta import relativedelta
+
+from ..tools import invoice_snapshot, settlement
 
 
 class ComunicazioneLiquidazioneVp(models.Model):
     _name = "comunicazione.liquidazione.vp"
     _description = "VAT statement communication - VP table"
 
+    _sql_constraints = [
+        (
+            "period_unique",
+            "unique(comunicazione_id, period_type, month, quarter)",
+            "A VP table for this period already exists in the communication!",
+        )
+    ]
+
     # IMPORTANTE: Campo comunicazione_id DEVE essere il primo campo definito
     comunicazione_id = fields.Many2one(
         "comunicazione.liquidazione", string="Communication", required=True, ondelete='cascade'
@@ -15,13 +25,12 @@ class ComunicazioneLiquidazioneVp(models.Model):
 
     @api.depends("iva_esigibile", "iva_detratta")
     def _compute_VP6_iva_dovuta_credito(self):
-        for quadro in self:
-            quadro.iva_dovuta_debito = 0
-            quadro.iva_dovuta_credito = 0
-            if quadro.iva_esigibile >= quadro.iva_detratta:
-                quadro.iva_dovuta_debito = quadro.iva_esigibile - quadro.iva_detratta
-            else:
-                quadro.iva_dovuta_credito = quadro.iva_detratta - quadro.iva_esigibile
+        debiti, crediti = settlement.compute_vp6(
+            self.mapped("iva_esigibile"), self.mapped("iva_detratta")
+        )
+        for quadro, debito, credito in zip(self, debiti, crediti):
+            quadro.iva_dovuta_debito = debito
+            quadro.iva_dovuta_credito = credito
 
     @api.depends(
         "iva_dovuta_debito",
@@ -35,31 +44,17 @@ class ComunicazioneLiquidazioneVp(models.Model):
         "accounto_dovuto",
     )
     def _compute_VP14_iva_da_versare_credito(self):
-        for quadro in self:
-            quadro.iva_da_versare = 0
-            quadro.iva_a_credito = 0
-            
-            if quadro.period_type == "quarter" and quadro.quarter == 5:
-                continue
-                
-            debito = (
-                quadro.iva_dovuta_debito
-                + quadro.debito_periodo_precedente
-                + quadro.interessi_dovuti
-            )
-            credito = (
-                quadro.iva_dovuta_credito
-                + quadro.credito_periodo_precedente
-                + quadro.credito_anno_precedente
-                + quadro.versamento_auto_UE
-                + quadro.crediti_imposta
-                + quadro.accounto_dovuto
-            )
-            
-            if debito >= credito:
-                quadro.iva_da_versare = debito - credito
-            else:
-                quadro.iva_a_credito = credito - debito
+        da_versare, a_credito = settlement.compute_vp14(
+            [[quadro[f] for f in settlement.VP14_DEBIT_FIELDS] for quadro in self],
+            [[quadro[f] for f in settlement.VP14_CREDIT_FIELDS] for quadro in self],
+            skip=[
+                quadro.period_type == "quarter" and quadro.quarter == 5
+                for quadro in self
+            ],
+        )
+        for quadro, versare, credito in zip(self, da_versare, a_credito):
+            quadro.iva_da_versare = versare
+            quadro.iva_a_credito = credito
 
     period_type = fields.Selection(
         [("month", "Monthly"), ("quarter", "Quarterly")],
@@ -111,20 +106,199 @@ class ComunicazioneLiquidazioneVp(models.Model):
         string="Credit VAT", compute="_compute_VP14_iva_da_versare_credito", store=True
     )
 
+    # Verifica con i saldi dei conti IVA in contabilità generale
+    ledger_iva_esigibile = fields.Float(string="Ledger due VAT", readonly=True)
+    ledger_iva_detratta = fields.Float(string="Ledger deducted VAT", readonly=True)
+    ledger_mismatch = fields.Boolean(
+        string="Ledger mismatch", compute="_compute_ledger_mismatch"
+    )
+
+    @api.depends(
+        "iva_esigibile", "iva_detratta", "ledger_iva_esigibile", "ledger_iva_detratta"
+    )
+    def _compute_ledger_mismatch(self):
+        for quadro in self:
+            currency = quadro.comunicazione_id.company_id.currency_id
+            quadro.ledger_mismatch = bool(currency) and not (
+                currency.is_zero(quadro.iva_esigibile - quadro.ledger_iva_esigibile)
+                and currency.is_zero(quadro.iva_detratta - quadro.ledger_iva_detratta)
+            )
+
+    # Istantanea delle fatture che compongono il quadro, scritta solo
+    # dall'importazione e mai modificabile a mano
+    invoice_snapshot = fields.Binary(
+        string="Invoice snapshot", attachment=False, readonly=True, copy=False
+    )
+    invoice_snapshot_count = fields.Integer(
+        string="Snapshot invoices", readonly=True, copy=False
+    )
+
+    # Dettaglio per società della liquidazione di gruppo e per imposta
+    group_line_ids = fields.One2many(
+        "comunicazione.liquidazione.vp.group", "vp_id", string="Group breakdown"
+    )
+    tax_line_ids = fields.One2many(
+        "comunicazione.liquidazione.vp.tax", "vp_id", string="Tax breakdown"
+    )
+    import_source = fields.Selection(
+        [
+            ("invoices", "Invoices"),
+            ("statements", "VAT period end statements"),
+        ],
+        string="Imported from",
+        readonly=True,
+        copy=False,
+    )
+    is_stale = fields.Boolean(
+        string="To recompute",
+        readonly=True,
+        copy=False,
+        help="The exclusion flags of a tax used in this period changed after "
+        "the import",
+    )
+
+    @api.model
+    def _get_invoice_snapshot_values(self, snapshot):
+        return {
+            "invoice_snapshot": base64.b64encode(snapshot.pack()),
+            "invoice_snapshot_count": len(snapshot),
+        }
+
+    def _get_invoice_snapshot(self):
+        """{id fattura: (imponibile, imposta)} salvati all'importazione"""
+        self.ensure_one()
+        if not self.invoice_snapshot:
+            return {}
+        return invoice_snapshot.unpack(base64.b64decode(self.invoice_snapshot))
+
+    def _is_last_period(self):
+        """Ultimo mese o trimestre dell'anno, su cui si indica l'acconto"""
+        self.ensure_one()
+        if self.period_type == "month":
+            return self.month == 12
+        return self.quarter >= 4
+
+    def _get_period_keys(self):
+        """Chiavi periodo IVA (AAAAMM) delle fatture del quadro"""
+        self.ensure_one()
+        year = self.comunicazione_id.year
+        return [year * 100 + month for month in self._get_period_months()]
+
+    def _get_invoice_domain(self):
+        self.ensure_one()
+        if self.comunicazione_id.vat_cash_basis:
+            # IVA per cassa: le fatture del quadro sono quelle con data nel
+            # periodo (imponibile) e quelle pagate nel periodo (imposta)
+            move_ids = self.comunicazione_id._get_invoice_move_ids(
+                self.period_type,
+                self.month if self.period_type == "month" else self.quarter,
+            )
+            return [("id", "in", move_ids)]
+        return [
+            ("company_id", "in", self.comunicazione_id._get_vat_company_ids()),
+            ("vsc_period_key", "in", self._get_period_keys()),
+            ("state", "=", "posted"),
+            ("move_type", "in", ["out_invoice", "out_refund", "in_invoice", "in_refund"]),
+        ]
+
+    def action_view_invoices(self):
+        """Fatture del periodo del quadro (ricerca sull'indice del periodo)"""
+        self.ensure_one()
+        return {
+            "name": _("Invoices of the period"),
+            "type": "ir.actions.act_window",
+            "res_model": "account.move",
+            "view_mode": "tree,form",
+            "domain": self._get_invoice_domain(),
+            "context": {"create": False},
+        }
+
+    def action_view_snapshot_invoices(self):
+        self.ensure_one()
+        return {
+            "name": _("Invoices of the VP table"),
+            "type": "ir.actions.act_window",
+            "res_model": "account.move",
+            "view_mode": "tree,form",
+            "domain": [("id", "in", list(self._get_invoice_snapshot()))],
+        }
+
+    def action_compare_invoice_snapshot(self):
+        """Confronta l'istantanea con le fatture attualmente in contabilità"""
+        self.ensure_one()
+        comunicazione = self.comunicazione_id
+        key = comunicazione._get_vp_period_key(self.period_type, self.month, self.quarter)
+        live_vals = comunicazione._get_invoice_vat_totals(
+            self.period_type,
+            period=self.month if self.period_type == "month" else self.quarter,
+        ).get(key, {})
+        live = (
+            invoice_snapshot.unpack(base64.b64decode(live_vals["invoice_snapshot"]))
+            if live_vals.get("invoice_snapshot")
+            else {}
+        )
+        stored = self._get_invoice_snapshot()
+        added = live.keys() - stored.keys()
+        removed = stored.keys() - live.keys()
+        changed = [
+            move_id for move_id in live.keys() & stored.keys()
+            if live[move_id] != stored[move_id]
+        ]
+        message = _(
+            "Invoice snapshot of period %s compared with the ledger: "
+            "%s new, %s removed, %s changed invoices"
+        ) % (self.month or self.quarter, len(added), len(removed), len(changed))
+        comunicazione.message_post(body=message)
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("Invoice snapshot"),
+                "message": message,
+                "type": "warning" if added or removed or changed else "success",
+            },
+        }
+
+    def _get_period_months(self):
+        """Mesi dell'anno coperti dal quadro (il trimestre 5 coincide col 4)"""
+        self.ensure_one()
+        return settlement.period_months(
+            self.period_type,
+            self.month if self.period_type == "month" else self.quarter,
+        )
+
+    @api.model
+    def _get_reset_values(self):
+        return {
+            "imponibile_operazioni_attive": 0.0,
+            "imponibile_operazioni_passive": 0.0,
+            "iva_esigibile": 0.0,
+            "iva_detratta": 0.0,
+            "debito_periodo_precedente": 0.0,
+            "credito_periodo_precedente": 0.0,
+            "credito_anno_precedente": 0.0,
+            "versamento_auto_UE": 0.0,
+            "crediti_imposta": 0.0,
+            "interessi_dovuti": 0.0,
+            "accounto_dovuto": 0.0,
+            "metodo_calcolo_acconto": False,
+            "invoice_snapshot": False,
+            "invoice_snapshot_count": 0,
+        }
+
     def _reset_values(self):
         for quadro in self:
-            quadro.imponibile_operazioni_attive = 0
-            quadro.imponibile_operazioni_passive = 0
-            quadro.iva_esigibile = 0
-            quadro.iva_detratta = 0
-            quadro.debito_periodo_precedente = 0
-            quadro.credito_periodo_precedente = 0
-            quadro.credito_anno_precedente = 0
-            quadro.versamento_auto_UE = 0
-            quadro.crediti_imposta = 0
-            quadro.interessi_dovuti = 0
-            quadro.accounto_dovuto = 0
-            quadro.metodo_calcolo_acconto = False
+            quadro.update(self._get_reset_values())
+
+    def action_scan_anomalies(self):
+        """Controlla le fatture del periodo prima dell'importazione"""
+        self.ensure_one()
+        date_start, date_end = settlement.period_dates(
+            self.comunicazione_id.year,
+            self.period_type,
+            self.month if self.period_type == "month" else self.quarter,
+        )
+        return self.comunicazione_id._open_anomaly_scan(date_start, date_end)
 
     def action_import_from_invoices_single(self):
         """IMPORTA DATI DAL PERIODO SPECIFICO"""
@@ -137,30 +311,52 @@ class ComunicazioneLiquidazioneVp(models.Model):
             raise UserError(_("Please specify the quarter!"))
         
         # Calcola date di inizio e fine periodo
-        year = self.comunicazione_id.year
-        
-        if self.period_type == "month":
-            date_start = date(year, self.month, 1)
-            date_end = date_start + relativedelta(months=1) - relativedelta(days=1)
-        else:  # quarter
-            if self.quarter == 1:
-                date_start = date(year, 1, 1)
-                date_end = date(year, 3, 31)
-            elif self.quarter == 2:
-                date_start = date(year, 4, 1)
-                date_end = date(year, 6, 30)
-            elif self.quarter == 3:
-                date_start = date(year, 7, 1)
-                date_end = date(year, 9, 30)
-            else:  # quarter 4
-                date_start = date(year, 10, 1)
-                date_end = date(year, 12, 31)
+        date_start, date_end = settlement.period_dates(
+            self.comunicazione_id.year,
+            self.period_type,
+            self.month if self.period_type == "month" else self.quarter,
+        )
+
+        if not self.comunicazione_id._lock_for_import():
+            return self.comunicazione_id._import_running_notification()
+
+        # Tutte le letture avvengono sullo stesso snapshot del database
+        self.comunicazione_id._record_import_snapshot()
 
         # Reset valori
         self._reset_values()
+        self.import_source = "invoices"
         
-        # Importa dalle fatture
-        self._import_invoice_data(date_start, date_end)
+        comunicazione = self.comunicazione_id
+        period = self.month if self.period_type == "month" else self.quarter
+        key = comunicazione._get_vp_period_key(self.period_type, self.month, self.quarter)
+        breakdown, tax_breakdown = {}, {}
+        if comunicazione.company_id.vsc_import_chunk_size > 0 and not (
+            comunicazione.vat_cash_basis
+        ):
+            # Importazione fattura per fattura a blocchi (memoria limitata),
+            # con il solo dettaglio per imposta dalla query raggruppata
+            self._import_invoice_data(
+                date_start, date_end, breakdown=breakdown.setdefault(key, {})
+            )
+            tax_breakdown = comunicazione._get_invoice_tax_totals(
+                self.period_type, period
+            )
+        else:
+            # Un'unica aggregazione raggruppata limitata al periodo (valori già
+            # azzerati se non ci sono fatture o pagamenti nel periodo)
+            totals = comunicazione._get_invoice_vat_totals(
+                self.period_type, breakdown, tax_breakdown, period=period
+            )
+            if key in totals:
+                self.write(totals[key])
+            comunicazione.message_post(
+                body=_("VAT data of period %s to %s imported from %s invoices")
+                % (date_start, date_end, self.invoice_snapshot_count)
+            )
+
+        # Dettaglio per imposta (e per società se di gruppo) del periodo
+        comunicazione._sync_vp_breakdowns([key], breakdown, tax_breakdown)
         
         return {
             'type': 'ir.actions.client',
@@ -172,90 +368,191 @@ class ComunicazioneLiquidazioneVp(models.Model):
             }
         }
 
-    def _import_invoice_data(self, date_start, date_end):
-        """IMPORTA I DATI DALLE FATTURE DEL PERIODO SPECIFICATO - VERSIONE MIGLIORATA"""
+    @api.model
+    def _new_invoice_totals(self):
+        return {
+            'active_operations': 0,
+            'passive_operations': 0,
+            'vat_due': 0,
+            'vat_deductible': 0,
+            'customer_count': 0,
+            'vendor_count': 0,
+            'snapshot': invoice_snapshot.InvoiceSnapshot(),
+        }
+
+    @api.model
+    def _add_invoice_to_totals(
+        self, totals, move_id, move_type, base_amount, tax_amount,
+        exclude_operation=False, exclude_vat=False,
+    ):
+        """Somma una fattura ai totali del periodo (note di credito in negativo)"""
+        sign = 1 if move_type in ('out_invoice', 'in_invoice') else -1
+        base_amount = sign * (base_amount or 0)
+        tax_amount = sign * (tax_amount or 0)
+        if move_type in ('out_invoice', 'out_refund'):
+            totals['customer_count'] += 1
+            totals['active_operations'] += base_amount
+            totals['vat_due'] += tax_amount
+            totals['snapshot'].add(move_id, base_amount, tax_amount)
+        else:
+            totals['vendor_count'] += 1
+            if not exclude_operation:
+                totals['passive_operations'] += base_amount
+                if exclude_vat:
+                    tax_amount = 0
+                totals['vat_deductible'] += tax_amount
+                totals['snapshot'].add(move_id, base_amount, tax_amount)
+
+    @api.model
+    def _compute_invoice_totals_chunked(
+        self, customer_domain, vendor_domain, chunk_size, company_totals=None
+    ):
+        """Totali del periodo calcolati a blocchi di fatture.
+
+        Le fatture vengono lette in blocchi ordinati per id leggendo solo i
+        campi necessari, e la cache ORM viene svuotata tra un blocco e
+        l'altro: la memoria occupata dipende da chunk_size e non dal numero
+        di fatture del periodo. Se company_totals è un dizionario viene
+        riempito con i totali per società {id società: totali}.
+        """
+        totals = self._new_invoice_totals()
+
+        def targets(row):
+            if company_totals is None:
+                return [totals]
+            return [
+                totals,
+                company_totals.setdefault(
+                    row['company_id'][0], self._new_invoice_totals()
+                ),
+            ]
+
+        for rows in self._iter_invoice_chunks(customer_domain, chunk_size):
+            for row in rows:
+                for target in targets(row):
+                    self._add_invoice_to_totals(
+                        target, row['id'], row['move_type'],
+                        row['amount_untaxed'], row['amount_tax'],
+                    )
+        for rows in self._iter_invoice_chunks(vendor_domain, chunk_size):
+            flags = self._get_excluded_tax_flags([row['id'] for row in rows])
+            for row in rows:
+                exclude_operation, exclude_vat = flags.get(row['id'], (False, False))
+                for target in targets(row):
+                    self._add_invoice_to_totals(
+                        target,
+                        row['id'],
+                        row['move_type'],
+                        row['amount_untaxed'],
+                        row['amount_tax'],
+                        exclude_operation=exclude_operation,
+                        exclude_vat=exclude_vat,
+                    )
+        return totals
+
+    @api.model
+    def _get_invoice_totals_values(self, totals):
+        """Valori VP dai totali di _new_invoice_totals"""
+        return {
+            'imponibile_operazioni_attive': totals['active_operations'],
+            'imponibile_operazioni_passive': totals['passive_operations'],
+            'iva_esigibile': totals['vat_due'],
+            'iva_detratta': totals['vat_deductible'],
+        }
+
+    @api.model
+    def _iter_invoice_chunks(self, domain, chunk_size):
+        """Genera blocchi di fatture (dizionari) ordinati per id"""
+        last_id = 0
+        while True:
+            rows = self.env['account.move'].search_read(
+                domain + [('id', '>', last_id)],
+                ['company_id', 'move_type', 'amount_untaxed', 'amount_tax'],
+                order='id',
+                limit=chunk_size,
+            )
+            if not rows:
+                return
+            last_id = rows[-1]['id']
+            yield rows
+            # Libera la cache ORM prima del blocco successivo
+            self.env.invalidate_all()
+
+    @api.model
+    def _get_excluded_tax_flags(self, move_ids):
+        """Restituisce {move_id: (escludi_operazione, escludi_iva)} per le
+        fatture con almeno una riga soggetta a imposta esclusa"""
+        if not move_ids:
+            return {}
+        self.env.cr.execute(
+            """
+            SELECT aml.move_id,
+                   BOOL_OR(COALESCE(tax.vsc_exclude_operation, FALSE)),
+                   BOOL_OR(COALESCE(tax.vsc_exclude_vat, FALSE))
+              FROM account_move_line aml
+              JOIN account_move_line_account_tax_rel rel
+                ON rel.account_move_line_id = aml.id
+              JOIN account_tax tax ON tax.id = rel.account_tax_id
+             WHERE aml.move_id = ANY(%s)
+               AND aml.display_type = 'product'
+             GROUP BY aml.move_id
+            """,
+            [list(move_ids)],
+        )
+        return {
+            move_id: (exclude_operation, exclude_vat)
+            for move_id, exclude_operation, exclude_vat in self.env.cr.fetchall()
+        }
+
+    def _import_invoice_data(self, date_start, date_end, breakdown=None):
+        """IMPORTA I DATI DALLE FATTURE DEL PERIODO SPECIFICATO - VERSIONE MIGLIORATA
+
+        Le fatture vengono elaborate a blocchi di vsc_import_chunk_size; se
+        breakdown è un dizionario viene riempito con i valori VP per società.
+        """
         
         if not self.comunicazione_id or not self.comunicazione_id.company_id:
             raise UserError(_("Communication or company not found!"))
             
-        company_id = self.comunicazione_id.company_id.id
+        company_ids = self.comunicazione_id._get_vat_company_ids()
         
-        # Debug info
-        self.env.cr.execute("SELECT COUNT(*) FROM account_move WHERE company_id = %s", (company_id,))
-        total_moves = self.env.cr.fetchone()[0]
-        
-        # FATTURE DI VENDITA (IVA ESIGIBILE + OPERAZIONI ATTIVE)
-        customer_invoices = self.env['account.move'].search([
+        customer_domain = [
             ('move_type', 'in', ['out_invoice', 'out_refund']),
             ('state', '=', 'posted'),
-            ('company_id', '=', company_id),
+            ('company_id', 'in', company_ids),
             ('invoice_date', '>=', date_start),
             ('invoice_date', '<=', date_end),
-        ])
-        
-        # FATTURE DI ACQUISTO (IVA DETRAIBILE + OPERAZIONI PASSIVE)
-        vendor_invoices = self.env['account.move'].search([
+        ]
+        vendor_domain = [
             ('move_type', 'in', ['in_invoice', 'in_refund']),
             ('state', '=', 'posted'),
-            ('company_id', '=', company_id),
+            ('company_id', 'in', company_ids),
             ('invoice_date', '>=', date_start),
             ('invoice_date', '<=', date_end),
-        ])
-        
-        # === CALCOLO OPERAZIONI ATTIVE (FATTURE VENDITA) ===
-        active_operations_total = 0
-        vat_due_total = 0
-        
-        for invoice in customer_invoices:
-            # Imponibile (esclusa IVA)
-            base_amount = invoice.amount_untaxed or 0
-            tax_amount = invoice.amount_tax or 0
-            
-            if invoice.move_type == 'out_invoice':
-                active_operations_total += base_amount
-                vat_due_total += tax_amount
-            else:  # note di credito
-                active_operations_total -= base_amount
-                vat_due_total -= tax_amount
-        
-        # === CALCOLO OPERAZIONI PASSIVE (FATTURE ACQUISTO) ===
-        passive_operations_total = 0
-        vat_deductible_total = 0
-        
-        for invoice in vendor_invoices:
-            base_amount = invoice.amount_untaxed or 0
-            tax_amount = invoice.amount_tax or 0
-            
-            # Filtro per tasse escluse (se i campi esistono)
-            exclude_operation = False
-            exclude_vat = False
-            
-            # Controlla se ci sono tasse da escludere
-            for line in invoice.invoice_line_ids:
-                for tax in line.tax_ids:
-                    if hasattr(tax, 'vsc_exclude_operation') and tax.vsc_exclude_operation:
-                        exclude_operation = True
-                    if hasattr(tax, 'vsc_exclude_vat') and tax.vsc_exclude_vat:
-                        exclude_vat = True
-            
-            if not exclude_operation:
-                if invoice.move_type == 'in_invoice':
-                    passive_operations_total += base_amount
-                    if not exclude_vat:
-                        vat_deductible_total += tax_amount
-                else:  # note di credito
-                    passive_operations_total -= base_amount
-                    if not exclude_vat:
-                        vat_deductible_total -= tax_amount
-        
+        ]
+
+        company_totals = {} if breakdown is not None else None
+        totals = self._compute_invoice_totals_chunked(
+            customer_domain,
+            vendor_domain,
+            max(self.comunicazione_id.company_id.vsc_import_chunk_size, 1),
+            company_totals,
+        )
+        if breakdown is not None:
+            breakdown.update(
+                (company_id, self._get_invoice_totals_values(company_total))
+                for company_id, company_total in company_totals.items()
+            )
+
+        active_operations_total = totals['active_operations']
+        passive_operations_total = totals['passive_operations']
+        vat_due_total = totals['vat_due']
+        vat_deductible_total = totals['vat_deductible']
+
         # === AGGIORNA I CAMPI ===
-        vals = {
-            'imponibile_operazioni_attive': active_operations_total,
-            'imponibile_operazioni_passive': passive_operations_total,
-            'iva_esigibile': vat_due_total,
-            'iva_detratta': vat_deductible_total,
-        }
-        
+        vals = self._get_invoice_totals_values(totals)
+        vals.update(self._get_invoice_snapshot_values(totals['snapshot']))
+
         self.write(vals)
         
         # === LOG DETTAGLIATO ===
@@ -270,7 +567,6 @@ class ComunicazioneLiquidazioneVp(models.Model):
                 <tr><td><b>VAT Deductible (Vendor invoices):</b></td><td>€ %s</td></tr>
                 <tr><td><b>Customer invoices processed:</b></td><td>%s</td></tr>
                 <tr><td><b>Vendor invoices processed:</b></td><td>%s</td></tr>
-                <tr><td><b>Total invoices in DB:</b></td><td>%s</td></tr>
             </table>
         </div>
         """) % (
@@ -279,9 +575,82 @@ class ComunicazioneLiquidazioneVp(models.Model):
             f"{passive_operations_total:,.2f}",
             f"{vat_due_total:,.2f}", 
             f"{vat_deductible_total:,.2f}",
-            len(customer_invoices),
-            len(vendor_invoices),
-            total_moves
+            totals['customer_count'],
+            totals['vendor_count'],
         )
         
-        self.comunicazione_id.message_post(body=message)
\ No newline at end of file
+        self.comunicazione_id.message_post(body=message)
+
+
+class ComunicazioneLiquidazioneVpGroup(models.Model):
+    _name = "comunicazione.liquidazione.vp.group"
+    _description = "VAT statement communication - VP table group breakdown"
+    _order = "vp_id, company_id"
+
+    vp_id = fields.Many2one(
+        "comunicazione.liquidazione.vp", string="VP table", required=True,
+        ondelete="cascade", index=True,
+    )
+    comunicazione_id = fields.Many2one(
+        related="vp_id.comunicazione_id", store=True, string="Communication"
+    )
+    company_id = fields.Many2one("res.company", string="Company", required=True)
+    imponibile_operazioni_attive = fields.Float(string="Active operations total (without VAT)")
+    imponibile_operazioni_passive = fields.Float(string="Passive operations total (without VAT)")
+    iva_esigibile = fields.Float(string="Due VAT")
+    iva_detratta = fields.Float(string="Deducted VAT")
+    iva_dovuta_debito = fields.Float(
+        string="Debit VAT", compute="_compute_iva_dovuta", store=True
+    )
+    iva_dovuta_credito = fields.Float(
+        string="Credit due VAT", compute="_compute_iva_dovuta", store=True
+    )
+
+    _sql_constraints = [
+        (
+            "company_unique",
+            "unique(vp_id, company_id)",
+            "A company can appear only once in the group breakdown of a VP table!",
+        )
+    ]
+
+    @api.depends("iva_esigibile", "iva_detratta")
+    def _compute_iva_dovuta(self):
+        debiti, crediti = settlement.compute_vp6(
+            self.mapped("iva_esigibile"), self.mapped("iva_detratta")
+        )
+        for line, debito, credito in zip(self, debiti, crediti):
+            line.iva_dovuta_debito = debito
+            line.iva_dovuta_credito = credito
+
+
+class ComunicazioneLiquidazioneVpTax(models.Model):
+    _name = "comunicazione.liquidazione.vp.tax"
+    _description = "VAT statement communication - VP table tax breakdown"
+    _order = "vp_id, type_tax_use desc, tax_id"
+
+    vp_id = fields.Many2one(
+        "comunicazione.liquidazione.vp", string="VP table", required=True,
+        ondelete="cascade", index=True,
+    )
+    comunicazione_id = fields.Many2one(
+        related="vp_id.comunicazione_id", store=True, string="Communication"
+    )
+    year = fields.Integer(related="vp_id.comunicazione_id.year", store=True)
+    period_type = fields.Selection(related="vp_id.period_type", store=True)
+    month = fields.Integer(related="vp_id.month", store=True)
+    quarter = fields.Integer(related="vp_id.quarter", store=True)
+    tax_id = fields.Many2one("account.tax", string="Tax", required=True, index=True)
+    company_id = fields.Many2one(related="tax_id.company_id", store=True)
+    type_tax_use = fields.Selection(related="tax_id.type_tax_use", store=True)
+    amount = fields.Float(related="tax_id.amount", string="Rate")
+    amount_base = fields.Float(string="Base")
+    amount_tax = fields.Float(string="Tax")
+
+    _sql_constraints = [
+        (
+            "tax_unique",
+            "unique(vp_id, tax_id)",
+            "A tax can appear only once in the tax breakdown of a VP table!",
+        )
+    ]
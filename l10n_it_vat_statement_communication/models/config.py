@@ -7,4 +7,17 @@ class ResCompany(models.Model):
         "Vat statement communication supply code",
         default="IVP18",
         help="IVP18",
-    )
\ No newline at end of file
+    )
+    vsc_import_chunk_size = fields.Integer(
+        "Vat statement communication import chunk size",
+        default=0,
+        help="When greater than zero, the import of a single period processes "
+        "invoices one by one in batches of this size instead of the grouped "
+        "aggregation, to keep memory usage bounded on very large periods.",
+    )
+    vsc_recompute_on_tax_change = fields.Boolean(
+        "Recompute VP tables when tax exclusions change",
+        help="When the VAT statement exclusion flags of a tax change, the VP "
+        "tables using that tax are recomputed immediately instead of being "
+        "only marked as stale.",
+    )
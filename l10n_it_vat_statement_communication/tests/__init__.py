@@ -2,3 +2,10 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
 from . import test_vat_statement_communication
+from . import test_settlement
+from . import test_export_xml_fuzz
+from . import test_vp_import
+from . import test_export_vp
+from . import test_acconto
+from . import test_controller
+from . import test_fiscalcode
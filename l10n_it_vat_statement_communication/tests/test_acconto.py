@@ -0,0 +1,93 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import math
+import unittest
+
+from flectra.tests.common import BaseCase, tagged
+
+from ..tools import acconto
+
+NAN = float("nan")
+
+
+def _row(
+    period_type, period, debito=0.0, credito=0.0, da_versare=0.0, acconto_dovuto=0.0
+):
+    return {
+        "period_type": period_type,
+        "month": period if period_type == "month" else 0,
+        "quarter": period if period_type == "quarter" else 0,
+        "iva_dovuta_debito": debito,
+        "iva_dovuta_credito": credito,
+        "iva_da_versare": da_versare,
+        "accounto_dovuto": acconto_dovuto,
+    }
+
+
+@unittest.skipIf(acconto.np is None, "numpy is not installed")
+@tagged("-at_install", "post_install")
+class VatAccontoKernelCase(BaseCase):
+    def test_propose_storico(self):
+        methods, amounts, by_method = acconto.propose([200.0], [300.0], [250.0])
+        self.assertEqual(methods, ["1"])
+        self.assertEqual(amounts, [176.0])
+        self.assertEqual(by_method, [[176.0, 264.0, 250.0]])
+
+    def test_propose_previsionale(self):
+        methods, amounts, __ = acconto.propose([1000.0], [150.0], [500.0])
+        self.assertEqual(methods, ["2"])
+        self.assertEqual(amounts, [132.0])
+
+    def test_propose_analitico(self):
+        methods, amounts, __ = acconto.propose([1000.0], [1000.0], [120.0])
+        self.assertEqual(methods, ["3"])
+        self.assertEqual(amounts, [120.0])
+
+    def test_propose_vectorised(self):
+        # Ogni contribuente ha il proprio metodo; i metodi non disponibili
+        # (NaN) non vengono proposti
+        methods, amounts, by_method = acconto.propose(
+            [200.0, NAN, NAN], [300.0, 150.0, NAN], [250.0, NAN, NAN]
+        )
+        self.assertEqual(methods, ["1", "2", False])
+        self.assertEqual(amounts, [176.0, 132.0, 0.0])
+        self.assertTrue(math.isnan(by_method[1][0]))
+
+    def test_propose_below_minimum(self):
+        # Sotto 103,29 euro l'acconto non è dovuto: il metodo resta indicato
+        # ma l'importo è zero; le basi negative valgono zero
+        methods, amounts, by_method = acconto.propose(
+            [100.0, -50.0], [NAN, NAN], [NAN, NAN]
+        )
+        self.assertEqual(methods, ["1", "1"])
+        self.assertEqual(amounts, [0.0, 0.0])
+        self.assertEqual(by_method[0][0], 88.0)
+        self.assertEqual(by_method[1][0], 0.0)
+
+    def test_bases_from_rows_month(self):
+        previous = [
+            _row("month", 11, da_versare=999.0),
+            _row("month", 12, da_versare=300.0, acconto_dovuto=100.0),
+        ]
+        current = [
+            _row("month", 10, debito=100.0),
+            _row("month", 11, debito=300.0, credito=100.0),
+            _row("month", 12, debito=310.0),
+        ]
+        storico, previsionale, analitico = acconto.bases_from_rows(current, previous)
+        self.assertEqual(storico, 400.0)
+        self.assertEqual(previsionale, 150.0)
+        self.assertAlmostEqual(analitico, 200.0)
+
+    def test_bases_from_rows_quarter(self):
+        # Il quarto trimestre dei trimestrali (5) usa l'IVA dovuta netta
+        previous = [_row("quarter", 5, debito=500.0, credito=100.0, da_versare=50.0)]
+        current = [_row("quarter", 1, debito=90.0), _row("quarter", 4, debito=920.0)]
+        storico, previsionale, analitico = acconto.bases_from_rows(current, previous)
+        self.assertEqual(storico, 400.0)
+        self.assertEqual(previsionale, 90.0)
+        self.assertAlmostEqual(analitico, 810.0)
+
+    def test_bases_from_rows_missing(self):
+        bases = acconto.bases_from_rows([], [])
+        self.assertTrue(all(math.isnan(base) for base in bases))
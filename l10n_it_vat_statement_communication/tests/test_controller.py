@@ -0,0 +1,101 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from flectra.tests.common import HttpCase, tagged
+
+
+@tagged("-at_install", "post_install")
+class VpSummaryControllerCase(HttpCase):
+    def setUp(self):
+        super().setUp()
+        self.comunicazione = self.env["comunicazione.liquidazione"].create(
+            {
+                "year": 2022,
+                "taxpayer_vat": "11876260784",
+                "taxpayer_fiscalcode": "FNCPLC19D01I168X",
+                "declarant_fiscalcode": "FNCPLC19D01I168X",
+                "codice_carica_id": self.env.ref("l10n_it_appointment_code.1").id,
+                "quadri_vp_ids": [
+                    (
+                        0,
+                        0,
+                        {
+                            "period_type": "month",
+                            "month": 7,
+                            "imponibile_operazioni_attive": 100.0,
+                            "iva_esigibile": 22.0,
+                        },
+                    ),
+                    (0, 0, {"period_type": "month", "month": 8, "iva_detratta": 11.0}),
+                ],
+            }
+        )
+        self.url = "/l10n_it_vat_statement_communication/vp/%s" % self.comunicazione.id
+        self.authenticate("admin", "admin")
+
+    def _touch_vp(self):
+        # All writes of the test share the transaction timestamp: move
+        # write_date forward as a later request would
+        self.env.flush_all()
+        self.env.cr.execute(
+            """
+            UPDATE comunicazione_liquidazione_vp
+               SET write_date = write_date + interval '1 second'
+             WHERE comunicazione_id = %s
+            """,
+            [self.comunicazione.id],
+        )
+        self.env.invalidate_all()
+
+    def test_vp_summary(self):
+        response = self.url_open(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["ETag"])
+        [communication] = response.json()["communications"]
+        self.assertEqual(communication["id"], self.comunicazione.id)
+        self.assertEqual(communication["year"], 2022)
+        self.assertEqual(len(communication["vp"]), 2)
+        self.assertEqual(communication["totals"]["iva_esigibile"], 22.0)
+        self.assertEqual(communication["totals"]["iva_detratta"], 11.0)
+
+    def test_vp_summary_not_modified(self):
+        etag = self.url_open(self.url).headers["ETag"]
+
+        response = self.url_open(self.url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(response.content)
+
+        # A modification date alone does not give a 304 response
+        last_modified = response.headers["Last-Modified"]
+        response = self.url_open(
+            self.url, headers={"If-Modified-Since": last_modified}
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_vp_summary_modified(self):
+        etag = self.url_open(self.url).headers["ETag"]
+
+        july = self.comunicazione.quadri_vp_ids.filtered(lambda vp: vp.month == 7)
+        july.iva_esigibile = 33.0
+        self._touch_vp()
+        response = self.url_open(self.url, headers={"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        [communication] = response.json()["communications"]
+        self.assertEqual(communication["totals"]["iva_esigibile"], 33.0)
+
+        # Deleting a VP table does not change the last modification date,
+        # but changes the ETag
+        etag = response.headers["ETag"]
+        july.unlink()
+        response = self.url_open(self.url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["communications"][0]["vp"]), 1)
+
+    def test_vp_summary_not_found(self):
+        response = self.url_open(
+            "/l10n_it_vat_statement_communication/vp/%s"
+            % (self.comunicazione.id + 1000)
+        )
+        self.assertEqual(response.status_code, 404)
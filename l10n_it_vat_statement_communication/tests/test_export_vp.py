@@ -0,0 +1,86 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import csv
+import hashlib
+import io
+from unittest.mock import patch
+
+from flectra.tests.common import tagged
+
+from ..wizard import export_vp
+from .test_vat_statement_communication import VatStatementCommunicationCommon
+
+
+@tagged("-at_install", "post_install")
+class VpExportCase(VatStatementCommunicationCommon):
+    def _export_csv(self, **vals):
+        wizard = self.env["comunicazione.liquidazione.vp.export"].create(
+            dict(file_format="csv", **vals)
+        )
+        wizard.action_export()
+        reader = csv.reader(
+            io.StringIO(wizard.attachment_id.raw.decode("utf-8")), delimiter=";"
+        )
+        return wizard, list(reader)
+
+    def test_export_csv(self):
+        # VP tables read in batches are all written after the header
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        comunicazione = self.env["comunicazione.liquidazione"].create(
+            dict(
+                self.get_vals_comunicazione_liquidazione(),
+                quadri_vp_ids=[
+                    (0, 0, {"period_type": "month", "month": month})
+                    for month in (7, 8, 9)
+                ],
+            )
+        )
+        comunicazione.quadri_vp_ids.filtered(
+            lambda vp: vp.month == 7
+        ).action_import_from_invoices_single()
+        other = self.env["comunicazione.liquidazione"].create(
+            dict(
+                self.get_vals_comunicazione_liquidazione(),
+                year=2021,
+                quadri_vp_ids=[(0, 0, {"period_type": "quarter", "quarter": 1})],
+            )
+        )
+
+        with patch.object(export_vp, "EXPORT_BATCH_SIZE", 2):
+            wizard, rows = self._export_csv(
+                comunicazione_ids=[(6, 0, (comunicazione | other).ids)]
+            )
+
+        self.assertEqual(wizard.row_count, 4)
+        self.assertEqual(wizard.attachment_id.mimetype, "text/csv")
+        self.assertEqual(wizard.attachment_id.res_id, wizard.id)
+        raw = wizard.attachment_id.raw
+        self.assertEqual(wizard.attachment_id.file_size, len(raw))
+        self.assertEqual(wizard.attachment_id.checksum, hashlib.sha1(raw).hexdigest())
+        header, *lines = rows
+        self.assertEqual(
+            len(header),
+            len(export_vp.HEADER_FIELDS) + len(export_vp.VP_EXPORT_FIELDS),
+        )
+        self.assertEqual(len(lines), 4)
+
+        def column(name):
+            return len(export_vp.HEADER_FIELDS) + export_vp.VP_EXPORT_FIELDS.index(name)
+
+        july = next(line for line in lines if line[column("month")] == "7")
+        self.assertEqual(july[0], str(comunicazione.identificativo))
+        self.assertEqual(july[2], "2022")
+        self.assertAlmostEqual(
+            float(july[column("imponibile_operazioni_attive")]), 100.0
+        )
+        self.assertAlmostEqual(float(july[column("iva_esigibile")]), 22.0)
+        self.assertEqual(
+            sorted(line[2] for line in lines), ["2021", "2022", "2022", "2022"]
+        )
+
+        # Filter on the year
+        wizard, rows = self._export_csv(
+            comunicazione_ids=[(6, 0, (comunicazione | other).ids)], year=2021
+        )
+        self.assertEqual(wizard.row_count, 1)
+        self.assertEqual(rows[1][column("quarter")], "1")
@@ -0,0 +1,166 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import random
+import string
+
+from flectra.tests.common import BaseCase, tagged
+
+from ..tools import settlement, xml_export, xml_schema
+
+# Numero di comunicazioni casuali generate a ogni esecuzione
+FUZZ_ITERATIONS = 3000
+FUZZ_SEED = 20170216
+
+CF_DIGITS = string.digits + "LMNPQRSTUV"
+CODICI_CARICA = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "11", "12", "13", "14", "15"]
+AMOUNT_FIELDS = [
+    "imponibile_operazioni_attive",
+    "imponibile_operazioni_passive",
+    "iva_esigibile",
+    "iva_detratta",
+]
+
+
+class CommunicationGenerator:
+    """Dati casuali ma validi di una comunicazione per tools.xml_export"""
+
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+
+    def _chars(self, alphabet, length):
+        return "".join(self.random.choice(alphabet) for __ in range(length))
+
+    def partita_iva(self):
+        return self.random.choice("01234567") + self._chars(string.digits, 10)
+
+    def codice_fiscale(self):
+        upper = string.ascii_uppercase
+        return (
+            self._chars(upper, 6)
+            + self._chars(CF_DIGITS, 2)
+            + self._chars(upper, 1)
+            + self._chars(CF_DIGITS, 2)
+            + self._chars(upper, 1)
+            + self._chars(CF_DIGITS, 3)
+            + self._chars(upper, 1)
+        )
+
+    def amount(self):
+        kind = self.random.random()
+        if kind < 0.15:
+            return 0.0
+        if kind < 0.3:
+            return -round(self.random.uniform(0.01, 1e6), 2)
+        if kind < 0.4:
+            return round(self.random.uniform(1e9, 1e12 - 1), 2)
+        return round(self.random.uniform(0.01, 1e6), 2)
+
+    def moduli(self):
+        count = self.random.randint(1, 5)
+        if self.random.random() < 0.5:
+            periods = sorted(self.random.sample(range(1, 13), count))
+            keys = [("month", period, 0) for period in periods]
+        else:
+            periods = sorted(self.random.sample(range(1, 6), count))
+            keys = [("quarter", 0, period) for period in periods]
+        moduli = [
+            dict(
+                {name: self.amount() for name in AMOUNT_FIELDS},
+                period_type=period_type,
+                month=month,
+                quarter=quarter,
+            )
+            for period_type, month, quarter in keys
+        ]
+        debiti, crediti = settlement.compute_vp6(
+            [modulo["iva_esigibile"] for modulo in moduli],
+            [modulo["iva_detratta"] for modulo in moduli],
+        )
+        for modulo, debito, credito in zip(moduli, debiti, crediti):
+            modulo["iva_dovuta_debito"] = round(debito, 2)
+            modulo["iva_dovuta_credito"] = round(credito, 2)
+        return moduli
+
+    def communication(self):
+        gruppo = self.random.random() < 0.25
+        # La liquidazione di gruppo richiede il codice fiscale numerico
+        # e nessuna partita IVA della controllante
+        if gruppo or self.random.random() < 0.5:
+            taxpayer_fiscalcode = self._chars(string.digits, 11)
+        else:
+            taxpayer_fiscalcode = self.codice_fiscale()
+        declarant_fiscalcode = (
+            self.codice_fiscale()
+            if len(taxpayer_fiscalcode) == 11 or self.random.random() < 0.5
+            else False
+        )
+        return {
+            "identificativo": self.random.randint(1, 99999),
+            "intestazione": {
+                "supply_code": self.random.choice(["IVP17", "IVP18"]),
+                "declarant_fiscalcode": declarant_fiscalcode,
+                "codice_carica": (
+                    self.random.choice(CODICI_CARICA) if declarant_fiscalcode else False
+                ),
+            },
+            "frontespizio": {
+                "taxpayer_fiscalcode": taxpayer_fiscalcode,
+                "year": self.random.randint(2017, 2099),
+                "taxpayer_vat": self.partita_iva(),
+                "controller_vat": (
+                    self.partita_iva()
+                    if not gruppo and self.random.random() < 0.2
+                    else False
+                ),
+                "last_month": self.random.choice(
+                    [False] * 6 + list(range(1, 14)) + [99]
+                ),
+                "liquidazione_del_gruppo": gruppo,
+                "declarant_fiscalcode": declarant_fiscalcode,
+                "declarant_sign": self.random.random() < 0.8,
+            },
+            "moduli": self.moduli(),
+        }
+
+
+def expected_round_trip(data):
+    """Dati attesi dalla rilettura: nella liquidazione di gruppo le
+    operazioni attive e passive non vengono esportate"""
+    if not data["frontespizio"]["liquidazione_del_gruppo"]:
+        return data
+    return dict(
+        data,
+        moduli=[
+            dict(
+                modulo,
+                imponibile_operazioni_attive=0.0,
+                imponibile_operazioni_passive=0.0,
+            )
+            for modulo in data["moduli"]
+        ],
+    )
+
+
+@tagged("-at_install", "post_install")
+class ExportXmlFuzzCase(BaseCase):
+    def test_export_xml_fuzz(self):
+        schema = xml_schema.get_schema()
+        generator = CommunicationGenerator(FUZZ_SEED)
+        for iteration in range(FUZZ_ITERATIONS):
+            data = generator.communication()
+            xml = xml_export.build_fornitura(data)
+            if not schema.validate(xml):
+                self.fail(
+                    "Iteration %s: invalid XML %s\n%s"
+                    % (iteration, schema.error_log, data)
+                )
+            parsed = xml_export.parse_fornitura(
+                xml_export.etree.tostring(xml, encoding="utf8")
+            )
+            self.assertEqual(parsed, expected_round_trip(data), "Iteration %s" % iteration)
+
+    def test_format_amount(self):
+        self.assertEqual(xml_export.format_amount(0), "0,00")
+        self.assertEqual(xml_export.format_amount(-1234.5), "-1234,50")
+        self.assertEqual(xml_export.format_amount(999999999999.99), "999999999999,99")
+        self.assertEqual(xml_export.parse_amount("-1234,50"), -1234.5)
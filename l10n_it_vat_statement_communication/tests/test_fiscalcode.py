@@ -0,0 +1,40 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from flectra.tests.common import BaseCase, tagged
+
+from ..tools import fiscalcode
+
+
+@tagged("-at_install", "post_install")
+class FiscalcodeCase(BaseCase):
+    def test_partita_iva(self):
+        self.assertTrue(fiscalcode.is_valid_partita_iva("12345670017"))
+        self.assertTrue(fiscalcode.is_valid_partita_iva("11876260784"))
+        self.assertFalse(fiscalcode.is_valid_partita_iva("12345670018"))
+        self.assertFalse(fiscalcode.is_valid_partita_iva("1234567001"))
+        self.assertFalse(fiscalcode.is_valid_partita_iva("1234567001A"))
+        self.assertFalse(fiscalcode.is_valid_partita_iva(""))
+        self.assertFalse(fiscalcode.is_valid_partita_iva(None))
+
+    def test_codice_fiscale(self):
+        self.assertTrue(fiscalcode.is_valid_codice_fiscale("RSSMRA85T10A562S"))
+        self.assertTrue(fiscalcode.is_valid_codice_fiscale("rssmra85t10a562s"))
+        self.assertTrue(fiscalcode.is_valid_codice_fiscale("FNCPLC19D01I168X"))
+        self.assertFalse(fiscalcode.is_valid_codice_fiscale("RSSMRA85T10A562T"))
+        self.assertFalse(fiscalcode.is_valid_codice_fiscale("RSSMRA85T10A562"))
+        self.assertFalse(fiscalcode.is_valid_codice_fiscale(""))
+
+    def test_non_ascii(self):
+        # Cifre e lettere non ASCII vengono rifiutate, non causano errori
+        self.assertFalse(fiscalcode.is_valid_partita_iva("١٢٣٤٥٦٧٠٠١٧"))
+        self.assertFalse(fiscalcode.is_valid_codice_fiscale("RSSMRA85T10A56²S"))
+        self.assertFalse(fiscalcode.is_valid_codice_fiscale("ＲSSMRA85T10A562S"))
+        self.assertFalse(fiscalcode.is_valid_codice_fiscale("RSSMRÀ85T10A562S"))
+
+    def test_fiscalcode(self):
+        self.assertTrue(fiscalcode.is_valid_fiscalcode("12345670017"))
+        self.assertTrue(fiscalcode.is_valid_fiscalcode("RSSMRA85T10A562S"))
+        self.assertFalse(fiscalcode.is_valid_fiscalcode("12345670018"))
+        self.assertFalse(fiscalcode.is_valid_fiscalcode("RSSMRA85T10A562T"))
+        self.assertFalse(fiscalcode.is_valid_fiscalcode("FNCPLC"))
+        self.assertFalse(fiscalcode.is_valid_fiscalcode(False))
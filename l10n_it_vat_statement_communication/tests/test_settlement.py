@@ -0,0 +1,52 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from datetime import date
+
+from flectra.tests.common import BaseCase, tagged
+
+from ..tools import settlement
+
+
+@tagged("-at_install", "post_install")
+class VatSettlementKernelCase(BaseCase):
+    def test_vp6(self):
+        debiti, crediti = settlement.compute_vp6([100.0, 20.0, 5.0], [40.0, 50.0, 5.0])
+        self.assertEqual(debiti, [60.0, 0.0, 0.0])
+        self.assertEqual(crediti, [0.0, 30.0, 0.0])
+
+    def test_vp14(self):
+        # debito: dovuta, periodo precedente, interessi
+        # credito: dovuta, periodo prec., anno prec., auto UE, crediti, acconto
+        da_versare, a_credito = settlement.compute_vp14(
+            [(100.0, 10.0, 1.0), (0.0, 0.0, 0.0), (50.0, 0.0, 0.0)],
+            [
+                (0.0, 20.0, 0.0, 0.0, 0.0, 30.0),
+                (30.0, 0.0, 5.0, 0.0, 0.0, 0.0),
+                (0.0, 0.0, 0.0, 0.0, 0.0, 0.0),
+            ],
+            skip=[False, False, True],
+        )
+        self.assertEqual(da_versare, [61.0, 0.0, 0.0])
+        self.assertEqual(a_credito, [0.0, 35.0, 0.0])
+
+    def test_period_months(self):
+        self.assertEqual(settlement.period_months("month", 7), [7])
+        self.assertEqual(settlement.period_months("quarter", 2), [4, 5, 6])
+        self.assertEqual(settlement.period_months("quarter", 5), [10, 11, 12])
+        self.assertEqual(settlement.period_months("month", 0), [])
+
+    def test_period_dates(self):
+        self.assertEqual(
+            settlement.period_dates(2024, "month", 2),
+            (date(2024, 2, 1), date(2024, 2, 29)),
+        )
+        self.assertEqual(
+            settlement.period_dates(2022, "quarter", 3),
+            (date(2022, 7, 1), date(2022, 9, 30)),
+        )
+        self.assertEqual(
+            settlement.period_dates(2022, "quarter", 5),
+            (date(2022, 10, 1), date(2022, 12, 31)),
+        )
+        with self.assertRaises(ValueError):
+            settlement.period_dates(2022, "quarter", 0)
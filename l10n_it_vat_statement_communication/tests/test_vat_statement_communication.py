@@ -8,8 +8,7 @@ from odoo.tests.common import Form, tagged
 from odoo.addons.account.tests.common import TestAccountReconciliationCommon
 
 
-@tagged("-at_install", "post_install")
-class VatStatementCommunicationCase(TestAccountReconciliationCommon):
+class VatStatementCommunicationCommon(TestAccountReconciliationCommon):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
@@ -218,6 +217,41 @@ class VatStatementCommunicationCase(TestAccountReconciliationCommon):
 
         return vat_statement
 
+    def _create_invoice(self, move_type, invoice_date, amount, taxes=None):
+        # Creates and posts an invoice with a single line
+        if taxes is None:
+            taxes = (
+                self.tax_22_sale
+                if move_type in ("out_invoice", "out_refund")
+                else self.tax_22_purchase
+            )
+        invoice = self.init_invoice(
+            move_type,
+            partner=self.res_partner_1,
+            invoice_date=invoice_date,
+            amounts=[amount],
+            taxes=taxes,
+            company=taxes.company_id,
+        )
+        invoice.action_post()
+        return invoice
+
+    def _pay_invoice(self, invoice, payment_date, amount=None):
+        # Registers a (partial) payment of the invoice
+        vals = {"payment_date": fields.Date.from_string(payment_date)}
+        if amount is not None:
+            vals["amount"] = amount
+        return (
+            self.env["account.payment.register"]
+            .with_context(active_model="account.move", active_ids=invoice.ids)
+            .create(vals)
+            ._create_payments()
+        )
+
+
+@tagged("-at_install", "post_install")
+class VatStatementCommunicationCase(VatStatementCommunicationCommon):
+
     def test_name(self):
         # Checks name of VAT statements
         comunicazione_liquidazione = self.env["comunicazione.liquidazione"].create(
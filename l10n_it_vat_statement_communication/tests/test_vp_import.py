@@ -0,0 +1,725 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from unittest.mock import patch
+
+from psycopg2 import IntegrityError
+from psycopg2.errors import LockNotAvailable
+
+from flectra.exceptions import AccessError
+from flectra.tests.common import Form, new_test_user, tagged
+from flectra.tools import mute_logger
+
+from ..tools import acconto
+from .test_vat_statement_communication import VatStatementCommunicationCommon
+
+
+@tagged("-at_install", "post_install")
+class VpImportCase(VatStatementCommunicationCommon):
+    def _new_comunicazione(self, **vals):
+        return self.env["comunicazione.liquidazione"].create(
+            dict(self.get_vals_comunicazione_liquidazione(), **vals)
+        )
+
+    def _import_vp(self, comunicazione, period_type="month", **vals):
+        # Imports the VP tables of the year through the import wizard
+        wizard = self.env["comunicazione.liquidazione.import.wizard"].create(
+            dict(
+                comunicazione_id=comunicazione.id,
+                year=comunicazione.year,
+                period_type=period_type,
+                **vals,
+            )
+        )
+        wizard.action_import_data()
+        return wizard
+
+    def _get_vp(self, comunicazione, month=0, quarter=0):
+        return comunicazione.quadri_vp_ids.filtered(
+            lambda vp: vp.month == month and vp.quarter == quarter
+        )
+
+    def _assert_vp_values(self, vp, attive, passive, esigibile, detratta):
+        self.assertEqual(len(vp), 1)
+        self.assertAlmostEqual(vp.imponibile_operazioni_attive, attive)
+        self.assertAlmostEqual(vp.imponibile_operazioni_passive, passive)
+        self.assertAlmostEqual(vp.iva_esigibile, esigibile)
+        self.assertAlmostEqual(vp.iva_detratta, detratta)
+
+    def test_import_invoices_month(self):
+        # Sales, purchases and credit notes are summed in the month of the
+        # invoice date, credit notes in negative
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        self._create_invoice("out_refund", "2022-07-20", 20.0)
+        self._create_invoice("in_invoice", "2022-07-10", 50.0)
+        self._create_invoice("out_invoice", "2022-08-01", 10.0)
+        self._create_invoice("out_invoice", "2021-07-05", 1000.0)
+        comunicazione = self._new_comunicazione()
+
+        self._import_vp(comunicazione)
+
+        self.assertEqual(len(comunicazione.quadri_vp_ids), 12)
+        july = self._get_vp(comunicazione, month=7)
+        self._assert_vp_values(july, 80.0, 50.0, 17.6, 11.0)
+        self.assertAlmostEqual(july.iva_dovuta_debito, 6.6)
+        self.assertEqual(july.import_source, "invoices")
+        self._assert_vp_values(self._get_vp(comunicazione, month=8), 10.0, 0, 2.2, 0)
+        self._assert_vp_values(self._get_vp(comunicazione, month=1), 0, 0, 0, 0)
+
+    def test_import_invoices_quarter(self):
+        self._create_invoice("out_invoice", "2022-10-05", 100.0)
+        self._create_invoice("in_invoice", "2022-12-31", 50.0)
+        comunicazione = self._new_comunicazione()
+
+        self._import_vp(comunicazione, period_type="quarter")
+
+        self.assertEqual(len(comunicazione.quadri_vp_ids), 4)
+        self._assert_vp_values(
+            self._get_vp(comunicazione, quarter=4), 100.0, 50.0, 22.0, 11.0
+        )
+
+    def test_import_single_period(self):
+        # Importing a single VP table gives the same values as the wizard,
+        # with or without the chunked iteration
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        self._create_invoice("in_refund", "2022-07-10", 50.0)
+        comunicazione = self._new_comunicazione(
+            quadri_vp_ids=[(0, 0, {"period_type": "month", "month": 7})]
+        )
+        vp = comunicazione.quadri_vp_ids
+
+        vp.action_import_from_invoices_single()
+        self._assert_vp_values(vp, 100.0, -50.0, 22.0, -11.0)
+        self.assertEqual(vp.invoice_snapshot_count, 2)
+
+        self.env.company.vsc_import_chunk_size = 1
+        vp.action_import_from_invoices_single()
+        self._assert_vp_values(vp, 100.0, -50.0, 22.0, -11.0)
+
+    def test_import_upsert(self):
+        # A new import updates the existing VP tables in place and resets
+        # the values of every imported period
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        comunicazione = self._new_comunicazione()
+        self._import_vp(comunicazione)
+        july = self._get_vp(comunicazione, month=7)
+        august = self._get_vp(comunicazione, month=8)
+        august.crediti_imposta = 5.0
+        vp_ids = comunicazione.quadri_vp_ids.ids
+
+        self._create_invoice("out_invoice", "2022-07-25", 50.0)
+        self._import_vp(comunicazione)
+
+        self.assertEqual(comunicazione.quadri_vp_ids.ids, vp_ids)
+        self._assert_vp_values(july, 150.0, 0, 33.0, 0)
+        self.assertAlmostEqual(august.crediti_imposta, 0.0)
+
+    def test_import_empty_period(self):
+        # A period left without invoices loses the snapshot of the previous
+        # import, whatever the import path
+        invoice = self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        comunicazione = self._new_comunicazione()
+        self._import_vp(comunicazione)
+        july = self._get_vp(comunicazione, month=7)
+        self.assertEqual(july.invoice_snapshot_count, 1)
+
+        invoice.button_draft()
+        self._import_vp(comunicazione)
+        self._assert_vp_values(july, 0, 0, 0, 0)
+        self.assertFalse(july.invoice_snapshot)
+        self.assertEqual(july.invoice_snapshot_count, 0)
+
+        invoice.action_post()
+        july.action_import_from_invoices_single()
+        self.assertEqual(july.invoice_snapshot_count, 1)
+        invoice.button_draft()
+        july.action_import_from_invoices_single()
+        self.assertFalse(july.invoice_snapshot)
+        self.assertEqual(july.invoice_snapshot_count, 0)
+        self.assertIn("imported from 0 invoices", comunicazione.message_ids[0].body)
+
+    def test_import_without_overwrite(self):
+        # Without overwrite only the missing periods are created and the
+        # periods out of the selection are kept
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        comunicazione = self._new_comunicazione(
+            quadri_vp_ids=[
+                (0, 0, {"period_type": "month", "month": 7}),
+                (0, 0, {"period_type": "month", "month": 1}),
+            ]
+        )
+        july = self._get_vp(comunicazione, month=7)
+        january = self._get_vp(comunicazione, month=1)
+
+        self._import_vp(
+            comunicazione,
+            create_all_periods=False,
+            force_overwrite=False,
+            **{"month_%s" % month: month in (7, 8) for month in range(1, 13)},
+        )
+
+        self.assertEqual(len(comunicazione.quadri_vp_ids), 3)
+        self.assertIn(january, comunicazione.quadri_vp_ids)
+        self._assert_vp_values(july, 0, 0, 0, 0)
+        self._assert_vp_values(self._get_vp(comunicazione, month=8), 0, 0, 0, 0)
+
+    def test_import_exclude_zero_amounts(self):
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        comunicazione = self._new_comunicazione()
+
+        self._import_vp(comunicazione, exclude_zero_amounts=True)
+
+        self.assertEqual(comunicazione.quadri_vp_ids.mapped("month"), [7])
+
+    def test_import_locked(self):
+        # While another transaction holds the lock of the communication the
+        # import returns a notification and writes nothing
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        comunicazione = self._new_comunicazione()
+        cursor_class = type(self.env.cr)
+        execute = cursor_class.execute
+
+        def execute_locked(cr, query, *args, **kwargs):
+            if "NOWAIT" in str(query):
+                raise LockNotAvailable()
+            return execute(cr, query, *args, **kwargs)
+
+        wizard = self.env["comunicazione.liquidazione.import.wizard"].create(
+            {"comunicazione_id": comunicazione.id, "year": comunicazione.year}
+        )
+        with patch.object(cursor_class, "execute", execute_locked):
+            action = wizard.action_import_data()
+
+        self.assertEqual(action["params"]["type"], "warning")
+        self.assertFalse(comunicazione.quadri_vp_ids)
+        self.assertFalse(comunicazione.import_snapshot)
+
+    def test_import_no_invoices(self):
+        # Without posted invoices the import stops before the aggregation
+        # and no database snapshot is recorded
+        comunicazione = self._new_comunicazione(
+            company_id=self.company_data_2["company"].id
+        )
+        wizard = self.env["comunicazione.liquidazione.import.wizard"].create(
+            {"comunicazione_id": comunicazione.id, "year": comunicazione.year}
+        )
+        action = wizard.action_import_data()
+
+        self.assertEqual(action["params"]["type"], "warning")
+        self.assertFalse(comunicazione.quadri_vp_ids)
+        self.assertFalse(comunicazione.import_snapshot)
+        self.assertFalse(comunicazione.import_snapshot_date)
+
+    def test_tax_breakdown(self):
+        # Base and tax of every tax in the period, with the VP signs
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        self._create_invoice("out_refund", "2022-07-20", 20.0)
+        self._create_invoice("in_invoice", "2022-07-10", 50.0)
+        comunicazione = self._new_comunicazione()
+        self._import_vp(comunicazione)
+        july = self._get_vp(comunicazione, month=7)
+
+        sale = july.tax_line_ids.filtered(lambda line: line.tax_id == self.tax_22_sale)
+        self.assertAlmostEqual(sale.amount_base, 80.0)
+        self.assertAlmostEqual(sale.amount_tax, 17.6)
+        purchase = july.tax_line_ids.filtered(
+            lambda line: line.tax_id == self.tax_22_purchase
+        )
+        self.assertAlmostEqual(purchase.amount_base, 50.0)
+        self.assertAlmostEqual(purchase.amount_tax, 11.0)
+        self.assertFalse(self._get_vp(comunicazione, month=8).tax_line_ids)
+
+        # A new import replaces the lines
+        self._import_vp(comunicazione)
+        self.assertEqual(len(july.tax_line_ids), 2)
+
+        with mute_logger("flectra.sql_db"), self.assertRaises(IntegrityError):
+            self.env["comunicazione.liquidazione.vp.tax"].create(
+                {"vp_id": july.id, "tax_id": self.tax_22_sale.id}
+            )
+
+    def test_import_group(self):
+        # The group's statement sums the invoices of the controlled companies
+        # and keeps the breakdown by company
+        company_2 = self.company_data_2["company"]
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        invoice_2 = self._create_invoice(
+            "out_invoice",
+            "2022-07-15",
+            200.0,
+            taxes=self.company_data_2["default_tax_sale"],
+        )
+        vendor_invoice_2 = self._create_invoice(
+            "in_invoice",
+            "2022-07-15",
+            300.0,
+            taxes=self.company_data_2["default_tax_purchase"],
+        )
+        comunicazione = self._new_comunicazione(
+            taxpayer_fiscalcode="11876260784",
+            liquidazione_del_gruppo=True,
+            group_company_ids=[(6, 0, company_2.ids)],
+        )
+
+        self._import_vp(comunicazione)
+
+        july = self._get_vp(comunicazione, month=7)
+        self._assert_vp_values(
+            july,
+            300.0,
+            300.0,
+            22.0 + invoice_2.amount_tax,
+            vendor_invoice_2.amount_tax,
+        )
+        self.assertEqual(
+            july.group_line_ids.company_id, self.env.company | company_2
+        )
+        line_2 = july.group_line_ids.filtered(
+            lambda line: line.company_id == company_2
+        )
+        self.assertAlmostEqual(line_2.imponibile_operazioni_attive, 200.0)
+        self.assertAlmostEqual(line_2.imponibile_operazioni_passive, 300.0)
+
+        # Without the group's statement only the company's invoices count
+        comunicazione.write(
+            {"liquidazione_del_gruppo": False, "group_company_ids": [(5, 0, 0)]}
+        )
+        self._import_vp(comunicazione)
+        self._assert_vp_values(july, 100.0, 0, 22.0, 0)
+        self.assertFalse(july.group_line_ids)
+
+    def test_group_companies(self):
+        # Unticking the group's statement drops the controlled companies
+        company_2 = self.company_data_2["company"]
+        comunicazione = self._new_comunicazione(
+            taxpayer_fiscalcode="11876260784",
+            liquidazione_del_gruppo=True,
+            group_company_ids=[(6, 0, company_2.ids)],
+        )
+        with Form(comunicazione) as comunicazione_form:
+            comunicazione_form.liquidazione_del_gruppo = False
+        self.assertFalse(comunicazione.group_company_ids)
+
+        # The VAT data of companies the user cannot access are not read
+        comunicazione.write(
+            {"liquidazione_del_gruppo": True, "group_company_ids": company_2.ids}
+        )
+        user = new_test_user(
+            self.env,
+            login="vsc_accountant",
+            groups="account.group_account_user",
+            company_id=self.env.company.id,
+            company_ids=[(6, 0, self.env.company.ids)],
+        )
+        with self.assertRaises(AccessError):
+            comunicazione.with_user(user)._get_vat_company_ids()
+        user.company_ids |= company_2
+        self.assertEqual(
+            sorted(comunicazione.with_user(user)._get_vat_company_ids()),
+            sorted((self.env.company | company_2).ids),
+        )
+
+    def _create_vat_statement_july(self):
+        if not self.env["comunicazione.liquidazione"]._has_vat_statements():
+            self.skipTest("VAT period end statements are not installed")
+        return self._create_vat_statement(
+            "2022-07-31",
+            interest=False,
+            name_period="07-2022",
+            type_period=self.type_month,
+            date_start_period="2022-07-01",
+            date_end_period="2022-07-31",
+        )
+
+    def test_import_statements(self):
+        # The VP tables are filled from the statement of the period, the
+        # invoice snapshot of a previous import is cleared
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        self._create_invoice("in_invoice", "2022-07-10", 50.0)
+        vat_statement = self._create_vat_statement_july()
+        comunicazione = self._new_comunicazione()
+        self._import_vp(comunicazione)
+        july = self._get_vp(comunicazione, month=7)
+        self.assertTrue(july.invoice_snapshot)
+
+        self._import_vp(comunicazione, import_source="statements")
+
+        self._assert_vp_values(
+            july,
+            100.0,
+            50.0,
+            sum(vat_statement.debit_vat_account_line_ids.mapped("amount")),
+            sum(vat_statement.credit_vat_account_line_ids.mapped("amount")),
+        )
+        self.assertAlmostEqual(july.iva_esigibile, 22.0)
+        self.assertAlmostEqual(july.iva_detratta, 11.0)
+        self.assertEqual(july.import_source, "statements")
+        self.assertFalse(july.invoice_snapshot)
+        self.assertEqual(july.invoice_snapshot_count, 0)
+        sale = july.tax_line_ids.filtered(lambda line: line.tax_id == self.tax_22_sale)
+        self.assertAlmostEqual(sale.amount_tax, 22.0)
+        self._assert_vp_values(self._get_vp(comunicazione, month=8), 0, 0, 0, 0)
+
+    def test_recompute_stale_periods(self):
+        # Changing the exclusion flags of a tax marks the VP tables using it,
+        # the recompute leaves the manual fields untouched
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        self._create_invoice("in_invoice", "2022-07-10", 50.0)
+        self._create_invoice("in_invoice", "2022-08-10", 20.0)
+        self._create_invoice("out_invoice", "2022-09-10", 10.0)
+        comunicazione = self._new_comunicazione()
+        self._import_vp(comunicazione)
+        july = self._get_vp(comunicazione, month=7)
+        august = self._get_vp(comunicazione, month=8)
+        september = self._get_vp(comunicazione, month=9)
+        july.crediti_imposta = 5.0
+
+        self.tax_22_purchase.vsc_exclude_operation = True
+
+        self.assertEqual(comunicazione.quadri_vp_ids.filtered("is_stale"), july | august)
+        self._assert_vp_values(july, 100.0, 50.0, 22.0, 11.0)
+
+        comunicazione.action_recompute_stale_periods()
+
+        self.assertFalse(comunicazione.quadri_vp_ids.filtered("is_stale"))
+        self._assert_vp_values(july, 100.0, 0, 22.0, 0)
+        self.assertAlmostEqual(july.crediti_imposta, 5.0)
+        self._assert_vp_values(august, 0, 0, 0, 0)
+        self._assert_vp_values(september, 10.0, 0, 2.2, 0)
+        # The excluded tax stays in the breakdown, with zero amounts
+        purchase = july.tax_line_ids.filtered(
+            lambda line: line.tax_id == self.tax_22_purchase
+        )
+        self.assertAlmostEqual(purchase.amount_base, 0.0)
+        self.assertAlmostEqual(purchase.amount_tax, 0.0)
+
+    def test_recompute_on_tax_change(self):
+        self.env.company.vsc_recompute_on_tax_change = True
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        self._create_invoice("in_invoice", "2022-07-10", 50.0)
+        comunicazione = self._new_comunicazione()
+        self._import_vp(comunicazione)
+        july = self._get_vp(comunicazione, month=7)
+
+        self.tax_22_purchase.vsc_exclude_vat = True
+
+        self.assertFalse(july.is_stale)
+        self._assert_vp_values(july, 100.0, 50.0, 22.0, 0)
+
+    def test_recompute_statement_periods(self):
+        # VP tables imported from statements are recomputed from statements
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        self._create_invoice("in_invoice", "2022-07-10", 50.0)
+        self._create_vat_statement_july()
+        comunicazione = self._new_comunicazione()
+        self._import_vp(comunicazione, import_source="statements")
+        july = self._get_vp(comunicazione, month=7)
+
+        self.tax_22_purchase.vsc_exclude_vat = True
+        self.assertTrue(july.is_stale)
+        comunicazione.action_recompute_stale_periods()
+
+        self.assertFalse(july.is_stale)
+        self.assertEqual(july.import_source, "statements")
+        self.assertAlmostEqual(july.iva_detratta, 11.0)
+        self.assertFalse(july.invoice_snapshot)
+
+    def test_compare_invoice_snapshot(self):
+        # The snapshot keeps base and tax of every invoice of the import and
+        # the comparison reports the invoices changed afterwards
+        invoice = self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        refund = self._create_invoice("in_refund", "2022-07-10", 50.0)
+        comunicazione = self._new_comunicazione()
+        self._import_vp(comunicazione)
+        july = self._get_vp(comunicazione, month=7)
+
+        self.assertEqual(july.invoice_snapshot_count, 2)
+        self.assertEqual(
+            july._get_invoice_snapshot(),
+            {invoice.id: (100.0, 22.0), refund.id: (-50.0, -11.0)},
+        )
+        params = july.action_compare_invoice_snapshot()["params"]
+        self.assertEqual(params["type"], "success")
+
+        refund.button_draft()
+        self._create_invoice("out_invoice", "2022-07-20", 10.0)
+        params = july.action_compare_invoice_snapshot()["params"]
+
+        self.assertEqual(params["type"], "warning")
+        self.assertIn("1 new, 1 removed, 0 changed invoices", params["message"])
+        self.assertIn(params["message"], comunicazione.message_ids[0].body)
+
+    def _create_cash_basis_invoices(self):
+        invoice = self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        vendor_invoice = self._create_invoice("in_invoice", "2022-07-10", 50.0)
+        self._pay_invoice(invoice, "2022-08-05", 61.0)
+        self._pay_invoice(invoice, "2022-09-05", 61.0)
+        self._pay_invoice(vendor_invoice, "2022-08-20")
+        unpaid_invoice = self._create_invoice("out_invoice", "2022-09-15", 10.0)
+        return invoice, vendor_invoice, unpaid_invoice
+
+    def test_cash_basis(self):
+        # Taxable amounts stay in the month of the invoice date, VAT goes to
+        # the months of the payments in proportion to the amount paid
+        invoice, vendor_invoice, unpaid_invoice = self._create_cash_basis_invoices()
+        comunicazione = self._new_comunicazione(vat_cash_basis=True)
+
+        self._import_vp(comunicazione)
+
+        july = self._get_vp(comunicazione, month=7)
+        august = self._get_vp(comunicazione, month=8)
+        september = self._get_vp(comunicazione, month=9)
+        self._assert_vp_values(july, 100.0, 50.0, 0, 0)
+        self._assert_vp_values(august, 0, 0, 11.0, 11.0)
+        self._assert_vp_values(september, 10.0, 0, 11.0, 0)
+
+        sale = july.tax_line_ids.filtered(lambda line: line.tax_id == self.tax_22_sale)
+        self.assertAlmostEqual(sale.amount_base, 100.0)
+        self.assertAlmostEqual(sale.amount_tax, 0.0)
+        sale = august.tax_line_ids.filtered(
+            lambda line: line.tax_id == self.tax_22_sale
+        )
+        self.assertAlmostEqual(sale.amount_base, 0.0)
+        self.assertAlmostEqual(sale.amount_tax, 11.0)
+
+        # Drill-down to the invoices dated or paid in the period
+        account_move = self.env["account.move"]
+        self.assertEqual(
+            account_move.search(august._get_invoice_domain()),
+            invoice | vendor_invoice,
+        )
+        self.assertEqual(
+            account_move.search(september._get_invoice_domain()),
+            invoice | unpaid_invoice,
+        )
+
+        # Without cash basis VAT stays in the month of the invoice date
+        comunicazione.vat_cash_basis = False
+        self._import_vp(comunicazione)
+        self._assert_vp_values(july, 100.0, 50.0, 22.0, 11.0)
+        self._assert_vp_values(august, 0, 0, 0, 0)
+
+    def test_cash_basis_quarter(self):
+        invoice, vendor_invoice, unpaid_invoice = self._create_cash_basis_invoices()
+        comunicazione = self._new_comunicazione(vat_cash_basis=True)
+
+        self._import_vp(comunicazione, period_type="quarter")
+
+        quarter = self._get_vp(comunicazione, quarter=3)
+        self._assert_vp_values(quarter, 110.0, 50.0, 22.0, 11.0)
+        # The shares of the same invoice in different months are summed, the
+        # unpaid invoice has no VAT yet
+        self.assertEqual(
+            quarter._get_invoice_snapshot(),
+            {
+                invoice.id: (100.0, 22.0),
+                vendor_invoice.id: (50.0, 11.0),
+                unpaid_invoice.id: (10.0, 0.0),
+            },
+        )
+
+        # The single period import ignores the chunked mode under cash basis
+        self.env.company.vsc_import_chunk_size = 1
+        quarter.action_import_from_invoices_single()
+        self._assert_vp_values(quarter, 110.0, 50.0, 22.0, 11.0)
+
+    def test_check_ledger(self):
+        # Invoices with excluded taxes count neither in the VP tables nor in
+        # the ledger balances
+        excluded_tax = self.tax_22_purchase.copy(
+            {"name": "IVA 22 Purchase excluded", "vsc_exclude_vat": True}
+        )
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        self._create_invoice("in_invoice", "2022-07-10", 50.0)
+        self._create_invoice("in_invoice", "2022-07-15", 30.0, taxes=excluded_tax)
+        comunicazione = self._new_comunicazione()
+        self._import_vp(comunicazione)
+        july = self._get_vp(comunicazione, month=7)
+
+        params = comunicazione.action_check_ledger()["params"]
+
+        self.assertEqual(params["type"], "success")
+        self.assertAlmostEqual(july.ledger_iva_esigibile, 22.0)
+        self.assertAlmostEqual(july.ledger_iva_detratta, 11.0)
+        self.assertFalse(july.ledger_mismatch)
+
+    def test_check_ledger_cash_basis(self):
+        self._create_cash_basis_invoices()
+        comunicazione = self._new_comunicazione(vat_cash_basis=True)
+        self._import_vp(comunicazione)
+
+        params = comunicazione.action_check_ledger()["params"]
+
+        self.assertEqual(params["type"], "success")
+        august = self._get_vp(comunicazione, month=8)
+        self.assertAlmostEqual(august.ledger_iva_esigibile, 11.0)
+        self.assertAlmostEqual(august.ledger_iva_detratta, 11.0)
+        self.assertAlmostEqual(self._get_vp(comunicazione, month=7).ledger_iva_esigibile, 0)
+
+    def test_check_ledger_mismatch(self):
+        # An invoice posted after the import makes the period differ
+        self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        comunicazione = self._new_comunicazione()
+        self._import_vp(comunicazione)
+        self._create_invoice("out_invoice", "2022-07-20", 10.0)
+        july = self._get_vp(comunicazione, month=7)
+
+        params = comunicazione.action_check_ledger()["params"]
+
+        self.assertEqual(params["type"], "warning")
+        self.assertAlmostEqual(july.ledger_iva_esigibile, 24.2)
+        self.assertTrue(july.ledger_mismatch)
+        self.assertFalse(self._get_vp(comunicazione, month=8).ledger_mismatch)
+        self.assertIn("differences found", comunicazione.message_ids[0].body)
+
+    def test_compute_acconto(self):
+        # Proposals under the minimum amount are not selected
+        if acconto.np is None:
+            self.skipTest("numpy is not installed")
+        small = self._new_comunicazione(
+            quadri_vp_ids=[
+                (0, 0, {"period_type": "month", "month": 12, "iva_esigibile": 100.0})
+            ]
+        )
+        large = self._new_comunicazione(
+            quadri_vp_ids=[
+                (0, 0, {"period_type": "month", "month": 12, "iva_esigibile": 1000.0})
+            ]
+        )
+        action = (small | large).action_compute_acconto()
+        wizard = self.env[action["res_model"]].browse(action["res_id"])
+
+        small_line = wizard.line_ids.filtered(
+            lambda line: line.comunicazione_id == small
+        )
+        self.assertEqual(small_line.metodo_calcolo_acconto, "3")
+        self.assertAlmostEqual(small_line.accounto_dovuto, 0.0)
+        self.assertFalse(small_line.to_apply)
+        large_line = wizard.line_ids.filtered(
+            lambda line: line.comunicazione_id == large
+        )
+        self.assertAlmostEqual(large_line.accounto_dovuto, 645.16)
+        self.assertTrue(large_line.to_apply)
+
+    def test_scan_anomalies(self):
+        # Every kind of anomaly of the period is reported, correct invoices
+        # and invoices of other periods are not
+        self._create_invoice("out_invoice", "2022-07-01", 100.0)
+        self._create_invoice(
+            "out_invoice", "2022-08-01", 100.0, taxes=self.env["account.tax"]
+        )
+        no_tax = self._create_invoice(
+            "out_invoice", "2022-07-02", 100.0, taxes=self.env["account.tax"]
+        )
+        draft = self.init_invoice(
+            "in_invoice",
+            partner=self.res_partner_1,
+            invoice_date="2022-07-03",
+            amounts=[50.0],
+            taxes=self.tax_22_purchase,
+        )
+        no_invoice_date = self._create_invoice("out_invoice", "2022-07-04", 100.0)
+        self.env.cr.execute(
+            "UPDATE account_move SET invoice_date = NULL WHERE id = %s",
+            [no_invoice_date.id],
+        )
+        no_invoice_date.invalidate_recordset(["invoice_date"])
+        partial_exclusion = self.init_invoice(
+            "in_invoice",
+            partner=self.res_partner_1,
+            invoice_date="2022-07-05",
+            amounts=[50.0, 30.0],
+            taxes=self.tax_22_purchase,
+        )
+        partial_exclusion.invoice_line_ids[1].tax_ids = self.tax_22_purchase.copy(
+            {"name": "IVA 22 Purchase excluded", "vsc_exclude_operation": True}
+        )
+        partial_exclusion.action_post()
+        comunicazione = self._new_comunicazione(
+            quadri_vp_ids=[(0, 0, {"period_type": "month", "month": 7})]
+        )
+
+        action = comunicazione.quadri_vp_ids.action_scan_anomalies()
+
+        scan = self.env[action["res_model"]].browse(action["res_id"])
+        self.assertEqual(scan.anomaly_count, 4)
+        anomalies = {line.code: line.move_ids for line in scan.line_ids}
+        self.assertEqual(anomalies["no_tax"], no_tax)
+        self.assertEqual(anomalies["draft"], draft)
+        self.assertEqual(anomalies["no_invoice_date"], no_invoice_date)
+        self.assertEqual(anomalies["partial_exclusion"], partial_exclusion)
+
+    def test_period_keys(self):
+        # Monthly and quarterly keys never collide, quarter 5 is the fourth
+        comunicazione_model = self.env["comunicazione.liquidazione"]
+        self.assertEqual(
+            comunicazione_model._get_vp_period_key("month", 10, 0), ("month", 10, 0)
+        )
+        self.assertEqual(
+            comunicazione_model._get_vp_period_key("quarter", 0, 4), ("quarter", 0, 4)
+        )
+        self.assertEqual(
+            comunicazione_model._get_vp_period_key("quarter", 0, 5),
+            comunicazione_model._get_vp_period_key("quarter", 0, 4),
+        )
+        self.assertNotEqual(
+            comunicazione_model._get_vp_period_key("month", 4, 0),
+            comunicazione_model._get_vp_period_key("quarter", 0, 4),
+        )
+
+        # Invoice key: year and month of the invoice date
+        invoice = self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        self.assertEqual(invoice.vsc_period_key, 202207)
+        invoice.button_draft()
+        invoice.invoice_date = "2022-11-30"
+        self.assertEqual(invoice.vsc_period_key, 202211)
+        invoice.invoice_date = False
+        self.assertEqual(invoice.vsc_period_key, 0)
+
+    def test_period_drill_down(self):
+        july_invoice = self._create_invoice("out_invoice", "2022-07-05", 100.0)
+        october_invoice = self._create_invoice("out_invoice", "2022-10-05", 100.0)
+        december_bill = self._create_invoice("in_invoice", "2022-12-31", 50.0)
+        self._create_invoice("out_invoice", "2021-12-31", 100.0)
+        monthly = self._new_comunicazione(
+            quadri_vp_ids=[(0, 0, {"period_type": "month", "month": 7})]
+        )
+        quarterly = self._new_comunicazione(
+            quadri_vp_ids=[(0, 0, {"period_type": "quarter", "quarter": 5})]
+        )
+        account_move = self.env["account.move"]
+
+        july = monthly.quadri_vp_ids
+        self.assertEqual(july._get_period_keys(), [202207])
+        self.assertEqual(
+            account_move.search(july.action_view_invoices()["domain"]), july_invoice
+        )
+        quarter = quarterly.quadri_vp_ids
+        self.assertEqual(quarter._get_period_keys(), [202210, 202211, 202212])
+        self.assertEqual(
+            account_move.search(quarter.action_view_invoices()["domain"]),
+            october_invoice | december_bill,
+        )
+
+        # The VP table of quarter 5 gets the values of the fourth quarter
+        quarter.action_import_from_invoices_single()
+        self._assert_vp_values(quarter, 100.0, 50.0, 22.0, 11.0)
+        self.assertEqual(
+            quarter.tax_line_ids.tax_id, self.tax_22_sale | self.tax_22_purchase
+        )
+
+    def test_preflight_check(self):
+        # Checking again keeps the report open with the updated errors
+        comunicazione = self._new_comunicazione(
+            declarant_fiscalcode="RSSMRA85T10A562T"
+        )
+        action = comunicazione.action_preflight_check()
+        wizard = self.env[action["res_model"]].browse(action["res_id"])
+        self.assertIn("RSSMRA85T10A562T", wizard.report)
+
+        comunicazione.declarant_fiscalcode = "RSSMRA85T10A562S"
+        action = wizard.action_rescan()
+
+        self.assertEqual(action["res_model"], wizard._name)
+        self.assertEqual(action["res_id"], wizard.id)
+        self.assertEqual(action["target"], "new")
+        self.assertNotIn("RSSMRA85T10A562", wizard.report)
@@ -0,0 +1,6 @@
+from . import acconto
+from . import fiscalcode
+from . import invoice_snapshot
+from . import settlement
+from . import xml_export
+from . import xml_schema
@@ -0,0 +1,92 @@
+"""Calcolo vettoriale dell'acconto IVA di dicembre con i tre metodi.
+
+Per ogni contribuente si confrontano:
+
+* "1" storico: 88% dell'IVA dovuta per l'ultimo periodo dell'anno precedente,
+  al lordo dell'acconto versato;
+* "2" previsionale: 88% dell'IVA stimata per l'ultimo periodo dell'anno,
+  come media dei periodi precedenti dell'anno in corso;
+* "3" analitico: 100% dell'IVA effettiva fino al 20 dicembre, riproporzionata
+  sull'ultimo periodo importato.
+
+I valori non disponibili vanno passati come NaN; viene proposto il metodo
+con l'importo minore. Sotto la soglia di 103,29 euro l'acconto non è dovuto.
+"""
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+    _logger.debug("Cannot import numpy")
+
+METHODS = ("1", "2", "3")
+RATES = (0.88, 0.88, 1.0)
+MINIMUM_AMOUNT = 103.29
+
+
+def propose(storico, previsionale, analitico):
+    """Restituisce (metodi, importi, importi per metodo) per ogni contribuente.
+
+    I tre argomenti sono sequenze della stessa lunghezza con le basi di
+    calcolo di ciascun metodo. metodi contiene il codice del metodo più
+    conveniente (False se nessuno è applicabile), importi l'acconto proposto
+    e importi per metodo la matrice n x 3 degli acconti di tutti i metodi.
+    """
+    if np is None:
+        raise ImportError("numpy is required to compute the VAT down payment")
+    bases = np.array([storico, previsionale, analitico], dtype=float).T.reshape(-1, 3)
+    amounts = np.clip(bases, 0, None) * np.array(RATES)
+    available = ~np.isnan(amounts)
+    any_available = available.any(axis=1)
+    best = np.argmin(np.where(available, amounts, np.inf), axis=1)
+    proposed = np.where(any_available, amounts[np.arange(len(best)), best], 0.0)
+    proposed = np.where(proposed < MINIMUM_AMOUNT, 0.0, np.round(proposed, 2))
+    methods = np.where(any_available, np.array(METHODS)[best], "")
+    return (
+        [method or False for method in methods.tolist()],
+        proposed.tolist(),
+        np.round(amounts, 2).tolist(),
+    )
+
+
+def _is_last_period(row):
+    if row["period_type"] == "month":
+        return row["month"] == 12
+    return row["quarter"] >= 4
+
+
+def _net_vat(row):
+    return row["iva_dovuta_debito"] - row["iva_dovuta_credito"]
+
+
+# Quota dell'ultimo periodo fino al 20 dicembre (mese: 20/31, trimestre: 81/92)
+ANALITICO_FRACTION = {"month": 20 / 31, "quarter": 81 / 92}
+
+
+def bases_from_rows(current, previous):
+    """Basi (storico, previsionale, analitico) dai quadri VP di un contribuente.
+
+    current e previous sono liste di dizionari dei quadri VP dell'anno in
+    corso e dell'anno precedente; le basi non determinabili sono NaN.
+    """
+    nan = float("nan")
+    storico = previsionale = analitico = nan
+    previous_last = [row for row in previous if _is_last_period(row)]
+    if previous_last:
+        row = previous_last[-1]
+        if row["period_type"] == "quarter" and row["quarter"] == 5:
+            storico = _net_vat(row)
+        else:
+            storico = row["iva_da_versare"] + row["accounto_dovuto"]
+    current_others = [_net_vat(row) for row in current if not _is_last_period(row)]
+    if current_others:
+        previsionale = sum(current_others) / len(current_others)
+    current_last = [row for row in current if _is_last_period(row)]
+    if current_last:
+        row = current_last[-1]
+        analitico = _net_vat(row) * ANALITICO_FRACTION[row["period_type"]]
+    return storico, previsionale, analitico
@@ -0,0 +1,59 @@
+"""Controllo dei caratteri di controllo di codici fiscali e partite IVA"""
+
+import re
+
+# Solo caratteri ASCII: le tabelle dei valori non coprono altre lettere
+_PARTITA_IVA_RE = re.compile(r"[0-9]{11}")
+_CODICE_FISCALE_RE = re.compile(r"[A-Z0-9]{16}")
+
+_CF_ODD_VALUES = dict(
+    zip(
+        "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ",
+        [1, 0, 5, 7, 9, 13, 15, 17, 19, 21]
+        + [1, 0, 5, 7, 9, 13, 15, 17, 19, 21, 2, 4, 18]
+        + [20, 11, 3, 6, 8, 12, 14, 16, 10, 22, 25, 24, 23],
+    )
+)
+
+
+def _cf_odd_value(char):
+    return _CF_ODD_VALUES[char]
+
+
+def _cf_even_value(char):
+    return int(char) if char.isdigit() else ord(char) - ord("A")
+
+
+def is_valid_partita_iva(code):
+    """Partita IVA / codice fiscale numerico di 11 cifre"""
+    if not code or not _PARTITA_IVA_RE.fullmatch(code):
+        return False
+    total = 0
+    for index, char in enumerate(code[:10]):
+        digit = int(char)
+        if index % 2:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return (10 - total % 10) % 10 == int(code[10])
+
+
+def is_valid_codice_fiscale(code):
+    """Codice fiscale di persona fisica (16 caratteri alfanumerici)"""
+    if not code:
+        return False
+    code = code.upper()
+    if not _CODICE_FISCALE_RE.fullmatch(code):
+        return False
+    total = 0
+    for index, char in enumerate(code[:15]):
+        total += _cf_odd_value(char) if index % 2 == 0 else _cf_even_value(char)
+    return chr(total % 26 + ord("A")) == code[15]
+
+
+def is_valid_fiscalcode(code):
+    """Codice fiscale di 11 (soggetti diversi) o 16 caratteri"""
+    if code and len(code) == 11:
+        return is_valid_partita_iva(code)
+    return is_valid_codice_fiscale(code)
@@ -0,0 +1,78 @@
+"""Istantanea compatta delle fatture che compongono un quadro VP.
+
+Le fatture vengono salvate come tre array paralleli di interi a 64 bit
+(id in differenze successive, imponibile e imposta in centesimi con segno),
+compressi con zlib: pochi byte per fattura e lettura in millisecondi.
+"""
+
+import struct
+import sys
+import zlib
+from array import array
+
+VERSION = 1
+_HEADER = struct.Struct("<BI")
+
+
+def _to_cents(amount):
+    return int(round((amount or 0) * 100))
+
+
+class InvoiceSnapshot:
+    def __init__(self):
+        self.rows = {}
+
+    def add(self, move_id, base, tax):
+        # Con l'IVA per cassa la stessa fattura può comparire in più mesi
+        # dello stesso trimestre: le quote si sommano
+        previous_base, previous_tax = self.rows.get(move_id, (0, 0))
+        self.rows[move_id] = (
+            previous_base + _to_cents(base),
+            previous_tax + _to_cents(tax),
+        )
+
+    def __len__(self):
+        return len(self.rows)
+
+    def pack(self):
+        ids = array("q")
+        bases = array("q")
+        taxes = array("q")
+        previous_id = 0
+        for move_id in sorted(self.rows):
+            base, tax = self.rows[move_id]
+            ids.append(move_id - previous_id)
+            bases.append(base)
+            taxes.append(tax)
+            previous_id = move_id
+        if sys.byteorder != "little":
+            for values in (ids, bases, taxes):
+                values.byteswap()
+        payload = ids.tobytes() + bases.tobytes() + taxes.tobytes()
+        return zlib.compress(_HEADER.pack(VERSION, len(ids)) + payload, 9)
+
+
+def unpack(data):
+    """Restituisce {id fattura: (imponibile, imposta)} dall'istantanea"""
+    if not data:
+        return {}
+    raw = zlib.decompress(data)
+    version, count = _HEADER.unpack_from(raw)
+    if version != VERSION:
+        raise ValueError("Unsupported invoice snapshot version %s" % version)
+    columns = []
+    offset = _HEADER.size
+    for _index in range(3):
+        values = array("q")
+        values.frombytes(raw[offset:offset + count * values.itemsize])
+        if sys.byteorder != "little":
+            values.byteswap()
+        offset += count * values.itemsize
+        columns.append(values)
+    ids, bases, taxes = columns
+    result = {}
+    move_id = 0
+    for delta, base, tax in zip(ids, bases, taxes):
+        move_id += delta
+        result[move_id] = (base / 100, tax / 100)
+    return result
@@ -0,0 +1,81 @@
+"""Calcoli della liquidazione IVA indipendenti dall'ORM.
+
+Le funzioni lavorano su sequenze di valori (un elemento per periodo) e
+restituiscono liste dei valori derivati, senza effetti collaterali: i campi
+calcolati dei quadri VP le usano e possono essere verificate senza database.
+"""
+
+import calendar
+from datetime import date
+
+# Campi di input del rigo VP14, nell'ordine di compute_vp14
+VP14_DEBIT_FIELDS = ("iva_dovuta_debito", "debito_periodo_precedente", "interessi_dovuti")
+VP14_CREDIT_FIELDS = (
+    "iva_dovuta_credito",
+    "credito_periodo_precedente",
+    "credito_anno_precedente",
+    "versamento_auto_UE",
+    "crediti_imposta",
+    "accounto_dovuto",
+)
+
+
+def _split_balance(debits, credits):
+    """Per ogni periodo restituisce (saldo a debito, saldo a credito)"""
+    to_pay = []
+    to_credit = []
+    for debit, credit in zip(debits, credits):
+        if debit >= credit:
+            to_pay.append(debit - credit)
+            to_credit.append(0.0)
+        else:
+            to_pay.append(0.0)
+            to_credit.append(credit - debit)
+    return to_pay, to_credit
+
+
+def compute_vp6(iva_esigibile, iva_detratta):
+    """VP6: IVA dovuta o a credito del periodo.
+
+    Restituisce due liste (iva_dovuta_debito, iva_dovuta_credito).
+    """
+    return _split_balance(iva_esigibile, iva_detratta)
+
+
+def compute_vp14(debits, credits, skip=None):
+    """VP14: IVA da versare o a credito.
+
+    debits e credits sono sequenze di tuple per periodo con i valori dei
+    campi VP14_DEBIT_FIELDS e VP14_CREDIT_FIELDS; i periodi per cui skip è
+    vero (trimestre 5) restano a zero. Restituisce due liste
+    (iva_da_versare, iva_a_credito).
+    """
+    debits = [sum(values) for values in debits]
+    credits = [sum(values) for values in credits]
+    to_pay, to_credit = _split_balance(debits, credits)
+    for index, skipped in enumerate(skip or []):
+        if skipped:
+            to_pay[index] = to_credit[index] = 0.0
+    return to_pay, to_credit
+
+
+def period_months(period_type, period):
+    """Mesi coperti da un periodo (il trimestre 5 coincide col quarto)"""
+    if not period:
+        return []
+    if period_type == "month":
+        return [period]
+    quarter = min(period, 4)
+    return list(range(quarter * 3 - 2, quarter * 3 + 1))
+
+
+def period_dates(year, period_type, period):
+    """Date di inizio e fine di un mese o trimestre dell'anno"""
+    months = period_months(period_type, period)
+    if not months:
+        raise ValueError("Invalid %s %s" % (period_type, period))
+    last_month = months[-1]
+    return (
+        date(year, months[0], 1),
+        date(year, last_month, calendar.monthrange(year, last_month)[1]),
+    )
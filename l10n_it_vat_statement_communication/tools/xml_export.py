@@ -0,0 +1,191 @@
+"""Generazione (e rilettura) del file XML della comunicazione da dati semplici.
+
+Nessuna dipendenza dall'ORM: il modello raccoglie i valori in dizionari
+(vedi comunicazione.liquidazione._get_export_xml_data) e questo modulo
+costruisce l'albero lxml secondo le specifiche dell'Agenzia delle Entrate.
+
+Struttura dei dati::
+
+    {
+        "identificativo": int,
+        "intestazione": {"supply_code", "declarant_fiscalcode", "codice_carica"},
+        "frontespizio": {
+            "taxpayer_fiscalcode", "year", "taxpayer_vat", "controller_vat",
+            "last_month", "liquidazione_del_gruppo", "declarant_fiscalcode",
+            "declarant_sign",
+        },
+        "moduli": [{
+            "period_type", "month", "quarter",
+            "imponibile_operazioni_attive", "imponibile_operazioni_passive",
+            "iva_esigibile", "iva_detratta",
+            "iva_dovuta_debito", "iva_dovuta_credito",
+        }],
+    }
+
+I campi facoltativi assenti valgono False.
+"""
+
+from lxml import etree
+
+NS_IV = "urn:www.agenziaentrate.gov.it:specificheTecniche:sco:ivp"
+NS_XSI = "http://www.w3.org/2001/XMLSchema-instance"
+NS_MAP = {
+    "iv": NS_IV,
+    "xsi": NS_XSI,
+}
+
+
+def _qname(tag):
+    return etree.QName(NS_IV, tag)
+
+
+def format_amount(amount):
+    """Importo con due decimali e la virgola come separatore"""
+    return f"{amount:.2f}".replace(".", ",")
+
+
+def parse_amount(text):
+    return float(text.replace(",", "."))
+
+
+def _sub(parent, tag, text):
+    element = etree.SubElement(parent, _qname(tag))
+    element.text = text
+    return element
+
+
+def build_intestazione(data):
+    intestazione = etree.Element(_qname("Intestazione"))
+    _sub(intestazione, "CodiceFornitura", data["supply_code"])
+    if data["declarant_fiscalcode"]:
+        _sub(intestazione, "CodiceFiscaleDichiarante", str(data["declarant_fiscalcode"]))
+    if data["codice_carica"]:
+        _sub(intestazione, "CodiceCarica", str(data["codice_carica"]))
+    return intestazione
+
+
+def build_frontespizio(data):
+    frontespizio = etree.Element(_qname("Frontespizio"))
+    _sub(
+        frontespizio,
+        "CodiceFiscale",
+        str(data["taxpayer_fiscalcode"]) if data["taxpayer_fiscalcode"] else "",
+    )
+    _sub(frontespizio, "AnnoImposta", str(data["year"]))
+    _sub(frontespizio, "PartitaIVA", data["taxpayer_vat"])
+    if data["controller_vat"]:
+        _sub(frontespizio, "PIVAControllante", data["controller_vat"])
+    if data["last_month"]:
+        _sub(frontespizio, "UltimoMese", str(data["last_month"]))
+    _sub(frontespizio, "LiquidazioneGruppo", "1" if data["liquidazione_del_gruppo"] else "0")
+    if data["declarant_fiscalcode"]:
+        _sub(frontespizio, "CFDichiarante", data["declarant_fiscalcode"])
+    _sub(frontespizio, "FirmaDichiarazione", "1" if data["declarant_sign"] else "0")
+    return frontespizio
+
+
+def build_modulo(data, liquidazione_del_gruppo):
+    modulo = etree.Element(_qname("Modulo"))
+    if data["period_type"] == "month":
+        _sub(modulo, "Mese", str(data["month"]))
+    else:
+        _sub(modulo, "Trimestre", str(data["quarter"]))
+
+    # Le operazioni attive e passive non si indicano nella liquidazione di gruppo
+    if not liquidazione_del_gruppo:
+        _sub(
+            modulo,
+            "TotaleOperazioniAttive",
+            format_amount(data["imponibile_operazioni_attive"]),
+        )
+        _sub(
+            modulo,
+            "TotaleOperazioniPassive",
+            format_amount(data["imponibile_operazioni_passive"]),
+        )
+    _sub(modulo, "IvaEsigibile", format_amount(data["iva_esigibile"]))
+    _sub(modulo, "IvaDetratta", format_amount(data["iva_detratta"]))
+    if data["iva_dovuta_debito"]:
+        _sub(modulo, "IvaDovuta", format_amount(data["iva_dovuta_debito"]))
+    if data["iva_dovuta_credito"]:
+        _sub(modulo, "IvaCredito", format_amount(data["iva_dovuta_credito"]))
+    return modulo
+
+
+def build_fornitura(data):
+    """Albero XML completo della fornitura"""
+    fornitura = etree.Element(_qname("Fornitura"), nsmap=NS_MAP)
+    comunicazione = etree.Element(
+        _qname("Comunicazione"), {"identificativo": str(data["identificativo"]).zfill(5)}
+    )
+    comunicazione.append(build_frontespizio(data["frontespizio"]))
+    dati_contabili = etree.SubElement(comunicazione, _qname("DatiContabili"))
+    for modulo in data["moduli"]:
+        dati_contabili.append(
+            build_modulo(modulo, data["frontespizio"]["liquidazione_del_gruppo"])
+        )
+    fornitura.append(build_intestazione(data["intestazione"]))
+    fornitura.append(comunicazione)
+    return fornitura
+
+
+def _text(parent, tag):
+    element = parent.find(_qname(tag))
+    return element.text if element is not None else False
+
+
+def _amount(parent, tag):
+    text = _text(parent, tag)
+    return parse_amount(text) if text else 0.0
+
+
+def parse_fornitura(root):
+    """Rilegge un albero (o un file XML in bytes) nella struttura dei dati.
+
+    Gli importi non presenti nel file valgono 0.0, come nei quadri VP.
+    """
+    if isinstance(root, bytes):
+        root = etree.fromstring(root)
+    intestazione = root.find(_qname("Intestazione"))
+    comunicazione = root.find(_qname("Comunicazione"))
+    frontespizio = comunicazione.find(_qname("Frontespizio"))
+    last_month = _text(frontespizio, "UltimoMese")
+    codice_carica = _text(intestazione, "CodiceCarica")
+    moduli = []
+    for modulo in comunicazione.find(_qname("DatiContabili")).iterfind(_qname("Modulo")):
+        month = _text(modulo, "Mese")
+        quarter = _text(modulo, "Trimestre")
+        moduli.append(
+            {
+                "period_type": "month" if month else "quarter",
+                "month": int(month) if month else 0,
+                "quarter": int(quarter) if quarter else 0,
+                "imponibile_operazioni_attive": _amount(modulo, "TotaleOperazioniAttive"),
+                "imponibile_operazioni_passive": _amount(
+                    modulo, "TotaleOperazioniPassive"
+                ),
+                "iva_esigibile": _amount(modulo, "IvaEsigibile"),
+                "iva_detratta": _amount(modulo, "IvaDetratta"),
+                "iva_dovuta_debito": _amount(modulo, "IvaDovuta"),
+                "iva_dovuta_credito": _amount(modulo, "IvaCredito"),
+            }
+        )
+    return {
+        "identificativo": int(comunicazione.get("identificativo")),
+        "intestazione": {
+            "supply_code": _text(intestazione, "CodiceFornitura"),
+            "declarant_fiscalcode": _text(intestazione, "CodiceFiscaleDichiarante"),
+            "codice_carica": codice_carica,
+        },
+        "frontespizio": {
+            "taxpayer_fiscalcode": _text(frontespizio, "CodiceFiscale"),
+            "year": int(_text(frontespizio, "AnnoImposta")),
+            "taxpayer_vat": _text(frontespizio, "PartitaIVA"),
+            "controller_vat": _text(frontespizio, "PIVAControllante"),
+            "last_month": int(last_month) if last_month else False,
+            "liquidazione_del_gruppo": _text(frontespizio, "LiquidazioneGruppo") == "1",
+            "declarant_fiscalcode": _text(frontespizio, "CFDichiarante"),
+            "declarant_sign": _text(frontespizio, "FirmaDichiarazione") == "1",
+        },
+        "moduli": moduli,
+    }
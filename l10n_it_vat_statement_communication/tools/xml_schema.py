@@ -0,0 +1,81 @@
+"""Schema XSD della comunicazione, compilato una volta per processo"""
+
+import os
+
+from lxml import etree
+
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+SCHEMA_FILE = "fornituraIvp_2017_v1.xsd"
+INTESTAZIONE_FILE = "intestazioneIvp_2017_v1.xsd"
+XS_NS = "http://www.w3.org/2001/XMLSchema"
+
+# Codici fornitura accettati. Lo schema pubblicato nel 2017 elenca solo
+# IVP17, le comunicazioni successive usano IVP18 con lo stesso tracciato:
+# il file distribuito resta quello ufficiale e l'elenco viene esteso al
+# caricamento.
+SUPPLY_CODES = ("IVP17", "IVP18")
+
+# La firma digitale non viene mai generata: basta dichiarare l'elemento
+# Signature senza scaricare lo schema xmldsig dal sito del W3C.
+XMLDSIG_NS = "http://www.w3.org/2000/09/xmldsig#"
+XMLDSIG_STUB = (
+    '<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" '
+    'targetNamespace="%s" elementFormDefault="qualified">'
+    '<xs:element name="Signature"/>'
+    "</xs:schema>" % XMLDSIG_NS
+)
+
+_schema = None
+
+
+def _load_intestazione(path):
+    """Schema dell'intestazione con tutti i codici fornitura accettati"""
+    document = etree.parse(path)
+    restriction = document.find(
+        ".//{%(xs)s}element[@name='CodiceFornitura']/{%(xs)s}simpleType"
+        "/{%(xs)s}restriction" % {"xs": XS_NS}
+    )
+    existing = {
+        enumeration.get("value")
+        for enumeration in restriction.iterfind("{%s}enumeration" % XS_NS)
+    }
+    for code in SUPPLY_CODES:
+        if code not in existing:
+            etree.SubElement(restriction, "{%s}enumeration" % XS_NS, value=code)
+    return etree.tostring(document)
+
+
+class _SchemaResolver(etree.Resolver):
+    """Risolve gli schemi importati sui file distribuiti nel modulo"""
+
+    def resolve(self, url, pubid, context):
+        if "xmldsig" in url:
+            return self.resolve_string(XMLDSIG_STUB, context)
+        path = os.path.join(SCHEMA_DIR, os.path.basename(url))
+        if os.path.basename(url) == INTESTAZIONE_FILE:
+            return self.resolve_string(
+                _load_intestazione(path), context, base_url=path
+            )
+        if os.path.exists(path):
+            return self.resolve_filename(path, context)
+        return None
+
+
+def get_schema():
+    global _schema
+    if _schema is None:
+        parser = etree.XMLParser()
+        parser.resolvers.add(_SchemaResolver())
+        document = etree.parse(os.path.join(SCHEMA_DIR, SCHEMA_FILE), parser)
+        _schema = etree.XMLSchema(document)
+    return _schema
+
+
+def get_schema_errors(xml_root):
+    """Elenco dei messaggi di errore di validazione XSD (vuoto se valido)"""
+    schema = get_schema()
+    if schema.validate(xml_root):
+        return []
+    return [
+        "line %s: %s" % (error.line, error.message) for error in schema.error_log
+    ]
@@ -1,2 +1,6 @@
+from . import acconto
+from . import anomaly_scan
 from . import export_file
-from . import import_wizard
\ No newline at end of file
+from . import export_vp
+from . import import_wizard
+from . import preflight
@@ -0,0 +1,105 @@
+import math
+
+from flectra import _, fields, models
+from flectra.exceptions import UserError
+
+METODO_ACCONTO = [
+    ("1", "Storico"),
+    ("2", "Previsionale"),
+    ("3", "Analitico - effettivo"),
+]
+
+
+class ComunicazioneLiquidazioneAccontoWizard(models.TransientModel):
+    _name = "comunicazione.liquidazione.acconto.wizard"
+    _description = "VAT down payment calculator"
+
+    comunicazione_ids = fields.Many2many(
+        "comunicazione.liquidazione", string="Communications"
+    )
+    line_ids = fields.One2many(
+        "comunicazione.liquidazione.acconto.line", "wizard_id", string="Proposals"
+    )
+
+    def action_compute(self):
+        for wizard in self:
+            proposals = wizard.comunicazione_ids._get_acconto_proposals()
+            wizard.line_ids.unlink()
+            self.env["comunicazione.liquidazione.acconto.line"].create(
+                [
+                    dict(
+                        {
+                            name: 0.0 if isinstance(value, float) and math.isnan(value)
+                            else value
+                            for name, value in values.items()
+                        },
+                        wizard_id=wizard.id,
+                        comunicazione_id=comunicazione_id,
+                        # Sotto l'importo minimo la proposta è azzerata: non
+                        # viene selezionata
+                        to_apply=bool(values["metodo_calcolo_acconto"])
+                        and values["accounto_dovuto"] > 0,
+                    )
+                    for comunicazione_id, values in proposals.items()
+                ]
+            )
+        return True
+
+    def action_apply(self):
+        """Scrive metodo e importo sull'ultimo periodo di ogni comunicazione"""
+        self.ensure_one()
+        lines = self.line_ids.filtered("to_apply")
+        if not lines:
+            raise UserError(_("No proposal selected"))
+        missing = []
+        for line in lines:
+            quadro = line.comunicazione_id.quadri_vp_ids.filtered(
+                lambda vp: vp._is_last_period()
+            )[-1:]
+            if not quadro:
+                missing.append(line.comunicazione_id.display_name)
+                continue
+            quadro.write(
+                {
+                    "metodo_calcolo_acconto": line.metodo_calcolo_acconto,
+                    "accounto_dovuto": line.accounto_dovuto,
+                }
+            )
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("VAT down payment"),
+                "message": _("Down payment applied to %s communications")
+                % (len(lines) - len(missing))
+                + (
+                    _(", no December / last quarter VP table in: %s")
+                    % ", ".join(missing)
+                    if missing
+                    else ""
+                ),
+                "type": "warning" if missing else "success",
+                "next": {"type": "ir.actions.act_window_close"},
+            },
+        }
+
+
+class ComunicazioneLiquidazioneAccontoLine(models.TransientModel):
+    _name = "comunicazione.liquidazione.acconto.line"
+    _description = "VAT down payment proposal"
+
+    wizard_id = fields.Many2one(
+        "comunicazione.liquidazione.acconto.wizard", required=True, ondelete="cascade"
+    )
+    comunicazione_id = fields.Many2one(
+        "comunicazione.liquidazione", string="Communication", required=True
+    )
+    company_id = fields.Many2one(related="comunicazione_id.company_id")
+    storico = fields.Float(string="Storico")
+    previsionale = fields.Float(string="Previsionale")
+    analitico = fields.Float(string="Analitico")
+    metodo_calcolo_acconto = fields.Selection(
+        METODO_ACCONTO, string="Proposed method"
+    )
+    accounto_dovuto = fields.Float(string="Proposed down payment")
+    to_apply = fields.Boolean(string="Apply")
@@ -0,0 +1,75 @@
+from flectra import _, api, fields, models
+
+ANOMALY_TYPES = [
+    ("no_invoice_date", "Posted invoices without invoice date"),
+    ("draft", "Draft invoices in the period"),
+    ("no_tax", "Posted invoices without taxes"),
+    ("partial_exclusion", "Vendor bills with excluded taxes on some lines only"),
+]
+
+
+class ComunicazioneLiquidazioneAnomalyScan(models.TransientModel):
+    _name = "comunicazione.liquidazione.anomaly.scan"
+    _description = "VAT statement communication invoice anomaly scan"
+
+    comunicazione_id = fields.Many2one("comunicazione.liquidazione", required=True)
+    date_from = fields.Date(required=True)
+    date_to = fields.Date(required=True)
+    line_ids = fields.One2many(
+        "comunicazione.liquidazione.anomaly.line", "scan_id", string="Anomalies"
+    )
+    anomaly_count = fields.Integer(string="Anomalous invoices", readonly=True)
+
+    def action_run(self):
+        for scan in self:
+            anomalies = scan.comunicazione_id._get_invoice_anomalies(
+                scan.date_from, scan.date_to
+            )
+            scan.line_ids.unlink()
+            scan.line_ids = [
+                (0, 0, {"code": code, "move_ids": [(6, 0, anomalies[code])]})
+                for code, __ in ANOMALY_TYPES
+            ]
+            scan.anomaly_count = len(
+                {move_id for move_ids in anomalies.values() for move_id in move_ids}
+            )
+        return True
+
+    def action_rescan(self):
+        self.action_run()
+        return {
+            "name": _("Invoice anomalies"),
+            "type": "ir.actions.act_window",
+            "res_model": self._name,
+            "res_id": self.id,
+            "view_mode": "form",
+            "target": "new",
+        }
+
+
+class ComunicazioneLiquidazioneAnomalyLine(models.TransientModel):
+    _name = "comunicazione.liquidazione.anomaly.line"
+    _description = "VAT statement communication invoice anomaly"
+
+    scan_id = fields.Many2one(
+        "comunicazione.liquidazione.anomaly.scan", required=True, ondelete="cascade"
+    )
+    code = fields.Selection(ANOMALY_TYPES, string="Anomaly", required=True)
+    move_ids = fields.Many2many("account.move", string="Invoices")
+    move_count = fields.Integer(string="Invoices", compute="_compute_move_count")
+
+    @api.depends("move_ids")
+    def _compute_move_count(self):
+        for line in self:
+            line.move_count = len(line.move_ids)
+
+    def action_view_invoices(self):
+        self.ensure_one()
+        return {
+            "name": dict(ANOMALY_TYPES)[self.code],
+            "type": "ir.actions.act_window",
+            "res_model": "account.move",
+            "view_mode": "tree,form",
+            "domain": [("id", "in", self.move_ids.ids)],
+            "context": {"create": False},
+        }
@@ -22,10 +22,7 @@ class ComunicazioneLiquidazioneExportFile(models.TransientModel):
             ):
                 out = base64.encodebytes(comunicazione.get_export_xml())
                 wizard.sudo().file_export = out
-                wizard.name = "{}_LI_{}.xml".format(
-                    comunicazione.declarant_fiscalcode,
-                    str(comunicazione.identificativo).rjust(5, "0"),
-                )
+                wizard.name = comunicazione._get_export_filename()
             view_id = self.env.ref(
                 "l10n_it_vat_statement_communication.wizard_liquidazione_export_file_exit"
             ).id
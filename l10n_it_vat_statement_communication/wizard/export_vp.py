@@ -0,0 +1,246 @@
+import csv
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+from flectra import _, fields, models
+from flectra.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+    _logger.debug("Cannot import xlsxwriter")
+
+# Righe lette dal database a ogni blocco
+EXPORT_BATCH_SIZE = 2000
+# Byte letti e copiati a ogni passaggio sul file esportato
+FILE_CHUNK_SIZE = 1024 * 1024
+# Righe di un foglio XLSX, intestazione esclusa
+XLSX_MAX_ROWS = 1048575
+
+HEADER_FIELDS = ["identificativo", "company_id", "year"]
+VP_EXPORT_FIELDS = [
+    "period_type",
+    "month",
+    "quarter",
+    "imponibile_operazioni_attive",
+    "imponibile_operazioni_passive",
+    "iva_esigibile",
+    "iva_detratta",
+    "iva_dovuta_debito",
+    "iva_dovuta_credito",
+    "debito_periodo_precedente",
+    "credito_periodo_precedente",
+    "credito_anno_precedente",
+    "versamento_auto_UE",
+    "crediti_imposta",
+    "interessi_dovuti",
+    "accounto_dovuto",
+    "metodo_calcolo_acconto",
+    "iva_da_versare",
+    "iva_a_credito",
+]
+
+
+class CsvRowWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", encoding="utf-8", newline="")
+        self.writer = csv.writer(self.file, delimiter=";")
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+class XlsxRowWriter:
+    """Scrittura XLSX a memoria costante (constant_memory di xlsxwriter):
+    ogni riga viene scaricata su disco appena completata. Oltre il limite
+    di righe di un foglio si prosegue su un nuovo foglio."""
+
+    def __init__(self, path):
+        self.workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+        self.header = None
+        self.sheet = None
+        self.row = 0
+
+    def writerow(self, row):
+        if self.header is None:
+            self.header = row
+        if self.sheet is None or self.row > XLSX_MAX_ROWS:
+            self.sheet = self.workbook.add_worksheet()
+            self.row = 0
+            if row is not self.header:
+                self.sheet.write_row(self.row, 0, self.header)
+                self.row += 1
+        self.sheet.write_row(self.row, 0, row)
+        self.row += 1
+
+    def close(self):
+        self.workbook.close()
+
+
+class ComunicazioneLiquidazioneVpExport(models.TransientModel):
+    _name = "comunicazione.liquidazione.vp.export"
+    _description = "Export VP tables of VAT statement communications"
+
+    file_format = fields.Selection(
+        [("xlsx", "Excel (XLSX)"), ("csv", "CSV")],
+        string="Format",
+        default="xlsx",
+        required=True,
+    )
+    comunicazione_ids = fields.Many2many(
+        "comunicazione.liquidazione",
+        string="Communications",
+        help="Leave empty to export the VP tables of all communications",
+    )
+    year = fields.Integer(help="Leave empty to export all years")
+    attachment_id = fields.Many2one("ir.attachment", readonly=True)
+    row_count = fields.Integer(string="Exported rows", readonly=True)
+
+    def _get_domain(self):
+        self.ensure_one()
+        domain = []
+        if self.comunicazione_ids:
+            domain.append(("comunicazione_id", "in", self.comunicazione_ids.ids))
+        if self.year:
+            domain.append(("comunicazione_id.year", "=", self.year))
+        return domain
+
+    def _get_header(self):
+        comunicazione_model = self.env["comunicazione.liquidazione"]
+        vp_model = self.env["comunicazione.liquidazione.vp"]
+        return [
+            comunicazione_model._fields[name]._description_string(self.env)
+            for name in HEADER_FIELDS
+        ] + [
+            vp_model._fields[name]._description_string(self.env)
+            for name in VP_EXPORT_FIELDS
+        ]
+
+    def _iter_rows(self):
+        """Righe da esportare, lette a blocchi ordinati per id (keyset)"""
+        self.ensure_one()
+        vp_model = self.env["comunicazione.liquidazione.vp"]
+        domain = self._get_domain()
+        headers = {}
+        last_id = 0
+        while True:
+            rows = vp_model.search_read(
+                domain + [("id", ">", last_id)],
+                ["comunicazione_id"] + VP_EXPORT_FIELDS,
+                order="id",
+                limit=EXPORT_BATCH_SIZE,
+            )
+            if not rows:
+                return
+            last_id = rows[-1]["id"]
+            missing = {row["comunicazione_id"][0] for row in rows} - set(headers)
+            for comunicazione in self.env["comunicazione.liquidazione"].search_read(
+                [("id", "in", list(missing))], HEADER_FIELDS
+            ):
+                headers[comunicazione["id"]] = [
+                    comunicazione["identificativo"],
+                    comunicazione["company_id"][1] if comunicazione["company_id"] else "",
+                    comunicazione["year"],
+                ]
+            for row in rows:
+                yield headers[row["comunicazione_id"][0]] + [
+                    row[name] if row[name] is not False else ""
+                    for name in VP_EXPORT_FIELDS
+                ]
+            # Libera la cache ORM prima del blocco successivo
+            self.env.invalidate_all()
+
+    def _store_file(self, path, filename, mimetype):
+        """Crea l'allegato dal file temporaneo senza caricarlo in memoria.
+
+        Checksum e copia nel filestore procedono a blocchi; il file viene
+        segnato per la garbage collection come in ir.attachment, così che un
+        rollback non lasci file orfani. Con l'archiviazione su database il
+        contenuto deve comunque passare per un unico valore.
+        """
+        attachment_model = self.env["ir.attachment"]
+        vals = {
+            "name": filename,
+            "type": "binary",
+            "mimetype": mimetype,
+            "res_model": self._name,
+            "res_id": self.id,
+        }
+        if attachment_model._storage() != "file":
+            with open(path, "rb") as data:
+                vals["raw"] = data.read()
+            return attachment_model.create(vals)
+
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as data:
+            for chunk in iter(lambda: data.read(FILE_CHUNK_SIZE), b""):
+                sha1.update(chunk)
+        checksum = sha1.hexdigest()
+        store_fname, full_path = attachment_model._get_path(b"", checksum)
+        if not os.path.isfile(full_path):
+            # Copia su un nome temporaneo e rinomina: nessun file parziale
+            # nel filestore se la copia si interrompe
+            partial_path = "%s.%s.part" % (full_path, os.getpid())
+            with open(path, "rb") as source, open(partial_path, "wb") as target:
+                shutil.copyfileobj(source, target, FILE_CHUNK_SIZE)
+            os.replace(partial_path, full_path)
+        attachment_model._mark_for_gc(store_fname)
+        vals.update(
+            store_fname=store_fname,
+            file_size=os.path.getsize(path),
+            checksum=checksum,
+        )
+        return attachment_model.create(vals)
+
+    def action_export(self):
+        self.ensure_one()
+        self.env["comunicazione.liquidazione.vp"].check_access_rights("read")
+        if self.file_format == "xlsx":
+            if xlsxwriter is None:
+                raise UserError(_("The xlsxwriter library is required for XLSX export"))
+            writer_class = XlsxRowWriter
+            mimetype = (
+                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+        else:
+            writer_class = CsvRowWriter
+            mimetype = "text/csv"
+
+        # Le righe vengono scritte in un file temporaneo di sistema, non
+        # accumulate in memoria
+        handle, path = tempfile.mkstemp(suffix="." + self.file_format)
+        os.close(handle)
+        try:
+            writer = writer_class(path)
+            try:
+                writer.writerow(self._get_header())
+                row_count = 0
+                for row in self._iter_rows():
+                    writer.writerow(row)
+                    row_count += 1
+            finally:
+                writer.close()
+            filename = "vp_%s.%s" % (
+                fields.Datetime.now().strftime("%Y%m%d_%H%M%S"),
+                self.file_format,
+            )
+            attachment = self._store_file(path, filename, mimetype)
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+
+        self.write({"attachment_id": attachment.id, "row_count": row_count})
+        return {
+            "type": "ir.actions.act_url",
+            "url": "/web/content/%s?download=true" % attachment.id,
+            "target": "self",
+        }
@@ -1,6 +1,22 @@
 from flectra import _, api, fields, models
 from flectra.exceptions import UserError
 
+from ..tools import settlement
+
+PREVIEW_FIELDS = [
+    "imponibile_operazioni_attive",
+    "imponibile_operazioni_passive",
+    "iva_esigibile",
+    "iva_detratta",
+]
+# Campi aggiuntivi importati dalle liquidazioni periodiche IVA
+STATEMENT_PREVIEW_FIELDS = [
+    "debito_periodo_precedente",
+    "credito_periodo_precedente",
+    "interessi_dovuti",
+    "accounto_dovuto",
+]
+
 
 class ComunicazioneLiquidazioneImportWizard(models.TransientModel):
     _name = "comunicazione.liquidazione.import.wizard"
@@ -12,6 +28,17 @@ class ComunicazioneLiquidazioneImportWizard(models.TransientModel):
         ("month", "Monthly"),
         ("quarter", "Quarterly")
     ], default="month", required=True)
+    import_source = fields.Selection(
+        [
+            ("invoices", "Invoices"),
+            ("statements", "VAT period end statements"),
+        ],
+        default="invoices",
+        required=True,
+        help="VAT period end statements: VP tables are filled from the statements "
+        "linked to the date ranges of the year, carry-overs and interests included",
+    )
+    vat_statements_available = fields.Boolean(compute="_compute_vat_statements_available")
     
     # Selezione periodi
     create_all_periods = fields.Boolean("Create all periods of the year", default=True)
@@ -42,34 +69,37 @@ class ComunicazioneLiquidazioneImportWizard(models.TransientModel):
     exclude_zero_amounts = fields.Boolean("Exclude periods with zero amounts", default=False,
                                         help="Don't create VP records if all amounts are zero")
 
-    def action_import_data(self):
-        """ESEGUE L'IMPORTAZIONE PER I PERIODI SELEZIONATI - VERSIONE MIGLIORATA"""
-        
-        if not self.comunicazione_id:
-            raise UserError(_("Communication not found!"))
-            
-        if not self.comunicazione_id.company_id:
-            raise UserError(_("Please select a company in the communication!"))
-        
-        # Verifica che ci siano fatture nel database
-        invoice_count = self.env['account.move'].search_count([
-            ('company_id', '=', self.comunicazione_id.company_id.id),
-            ('state', '=', 'posted')
-        ])
-        
-        if invoice_count == 0:
-            return {
-                'type': 'ir.actions.client',
-                'tag': 'display_notification',
-                'params': {
-                    'title': _('Warning!'),
-                    'message': _('No posted invoices found for company %s. Please post some invoices first.') % self.comunicazione_id.company_id.name,
-                    'type': 'warning',
-                }
-            }
-        
+    # Anteprima (nessuna scrittura sui quadri VP finché non si applica)
+    preview_line_ids = fields.One2many(
+        "comunicazione.liquidazione.import.preview", "wizard_id", string="Preview"
+    )
+
+    def _compute_vat_statements_available(self):
+        for wizard in self:
+            wizard.vat_statements_available = (
+                self.env["comunicazione.liquidazione"]._has_vat_statements()
+            )
+
+    def _get_source_totals(self, breakdown=None, tax_breakdown=None):
+        """Valori VP dalla fonte scelta: ({chiave periodo: valori}, [scartati])"""
+        self.ensure_one()
+        comunicazione = self.comunicazione_id
+        if self.import_source == "statements":
+            return comunicazione._get_statement_vat_totals(
+                self.period_type, tax_breakdown
+            )
+        return (
+            comunicazione._get_invoice_vat_totals(
+                self.period_type, breakdown, tax_breakdown
+            ),
+            [],
+        )
+
+    def _get_selected_periods(self):
+        """Periodi selezionati nel wizard, come dizionari di valori VP"""
+        self.ensure_one()
         periods_to_create = []
-        
+
         if self.create_all_periods:
             # Crea tutti i periodi dell'anno
             if self.period_type == "month":
@@ -113,83 +143,256 @@ class ComunicazioneLiquidazioneImportWizard(models.TransientModel):
                             'quarter': quarter_num,
                             'month': False
                         })
-        
-        if not periods_to_create:
+
+        return periods_to_create
+
+    def _reopen(self):
+        return {
+            'name': _('Import VAT Data from Invoices'),
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
+
+    def action_preview(self):
+        """CALCOLA I PERIODI SELEZIONATI SENZA SCRIVERE I QUADRI VP"""
+        self.ensure_one()
+        comunicazione = self.comunicazione_id
+        if not comunicazione.company_id:
+            raise UserError(_("Please select a company in the communication!"))
+        periods = self._get_selected_periods()
+        if not periods:
             raise UserError(_("Please select at least one period!"))
+
+        # Un solo passaggio di aggregazione per tutti i periodi
+        totals, __ = self._get_source_totals()
+        current = {
+            comunicazione._get_vp_period_key(vp.period_type, vp.month, vp.quarter): vp
+            for vp in comunicazione.quadri_vp_ids
+        }
+        preview_vals = []
+        for period_data in periods:
+            key = comunicazione._get_vp_period_key(
+                period_data['period_type'], period_data['month'], period_data['quarter']
+            )
+            new_vals = totals.get(key, {})
+            vp = current.get(key)
+            line_vals = {
+                'wizard_id': self.id,
+                'period_type': period_data['period_type'],
+                'month': period_data['month'],
+                'quarter': period_data['quarter'],
+                'vp_id': vp.id if vp else False,
+            }
+            line_vals['new_invoice_snapshot'] = new_vals.get('invoice_snapshot', False)
+            line_vals['new_invoice_snapshot_count'] = new_vals.get(
+                'invoice_snapshot_count', 0
+            )
+            for field_name in PREVIEW_FIELDS:
+                line_vals['new_' + field_name] = new_vals.get(field_name, 0.0)
+                line_vals['current_' + field_name] = vp[field_name] if vp else 0.0
+            for field_name in STATEMENT_PREVIEW_FIELDS:
+                line_vals['new_' + field_name] = new_vals.get(field_name, 0.0)
+            preview_vals.append(line_vals)
+
+        self.preview_line_ids.unlink()
+        lines = self.env['comunicazione.liquidazione.import.preview'].create(preview_vals)
+        for line in lines:
+            line.to_apply = line.is_different
+        return self._reopen()
+
+    def action_scan_anomalies(self):
+        """CONTROLLA LE FATTURE DEI PERIODI SELEZIONATI PRIMA DELL'IMPORTAZIONE"""
+        self.ensure_one()
+        periods = self._get_selected_periods()
+        if not periods:
+            raise UserError(_("Please select at least one period!"))
+        dates = [
+            settlement.period_dates(
+                self.year,
+                period['period_type'],
+                period['month'] if period['period_type'] == 'month' else period['quarter'],
+            )
+            for period in periods
+        ]
+        return self.comunicazione_id._open_anomaly_scan(
+            min(start for start, end in dates), max(end for start, end in dates)
+        )
+
+    def action_apply_preview(self):
+        """APPLICA SOLO I PERIODI ACCETTATI E DIVERSI DAI VALORI ATTUALI"""
+        self.ensure_one()
+        lines = self.preview_line_ids.filtered('to_apply').filtered('is_different')
+        if not lines:
+            raise UserError(_("No period to apply: the selected periods are unchanged."))
+
+        comunicazione = self.comunicazione_id
+        if not comunicazione._lock_for_import():
+            return comunicazione._import_running_notification()
+        comunicazione._record_import_snapshot()
+
+        # Totali e dettagli da un'unica aggregazione, sullo stesso snapshot:
+        # se la fonte è cambiata dopo l'anteprima non si applicano valori
+        # diversi da quelli mostrati
+        breakdown, tax_breakdown = {}, {}
+        totals, __ = self._get_source_totals(breakdown, tax_breakdown)
+        currency = comunicazione.company_id.currency_id
+        desired = {}
+        for line in lines:
+            key = comunicazione._get_vp_period_key(
+                line.period_type, line.month, line.quarter
+            )
+            new_vals = totals.get(key, {})
+            vals = line._get_new_values()
+            if any(
+                not currency.is_zero(vals[f] - new_vals.get(f, 0.0))
+                for f in line._get_compared_fields()
+            ):
+                raise UserError(
+                    _(
+                        "The VAT data of period %s changed after the preview. "
+                        "Please run the preview again."
+                    )
+                    % line.name
+                )
+            vals["invoice_snapshot"] = new_vals.get("invoice_snapshot", False)
+            vals["invoice_snapshot_count"] = new_vals.get("invoice_snapshot_count", 0)
+            vals["import_source"] = self.import_source
+            desired[key] = vals
+        comunicazione._sync_vp_rows(desired, unlink_obsolete=False)
+        comunicazione._sync_vp_breakdowns(desired, breakdown, tax_breakdown)
+
+        comunicazione.message_post(
+            body=_("VAT data applied from preview for periods: %s")
+            % ", ".join(lines.mapped('name'))
+        )
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Import Completed!'),
+                'message': _('%s periods updated') % len(lines),
+                'type': 'success',
+                'next': {'type': 'ir.actions.act_window_close'},
+            }
+        }
+
+    def action_import_data(self):
+        """ESEGUE L'IMPORTAZIONE PER I PERIODI SELEZIONATI - VERSIONE MIGLIORATA"""
         
-        # Rimuovi periodi esistenti se richiesto
-        if self.force_overwrite:
-            existing_vp = self.comunicazione_id.quadri_vp_ids
-            if existing_vp:
-                existing_vp.unlink()
+        if not self.comunicazione_id:
+            raise UserError(_("Communication not found!"))
+            
+        if not self.comunicazione_id.company_id:
+            raise UserError(_("Please select a company in the communication!"))
         
-        created_count = 0
-        imported_count = 0
-        skipped_count = 0
-        errors = []
+        # Un'importazione alla volta per comunicazione: le richieste
+        # sovrapposte non riscrivono gli stessi quadri VP
+        if not self.comunicazione_id._lock_for_import():
+            return self.comunicazione_id._import_running_notification()
+
+        # Verifica che ci siano fatture nel database
+        invoice_count = self.env['account.move'].search_count([
+            ('company_id', 'in', self.comunicazione_id._get_vat_company_ids()),
+            ('state', '=', 'posted')
+        ])
         
-        # Crea e importa dati per ogni periodo
-        for period_data in periods_to_create:
-            try:
-                # Controlla se esiste già
-                if not self.force_overwrite:
-                    existing = self.comunicazione_id.quadri_vp_ids.filtered(
-                        lambda vp: vp.period_type == period_data['period_type'] and
-                                  vp.month == period_data['month'] and
-                                  vp.quarter == period_data['quarter']
-                    )
-                    if existing:
-                        skipped_count += 1
-                        continue
-                
-                # Crea il quadro VP
-                vp_vals = {
-                    'comunicazione_id': self.comunicazione_id.id,
-                    'period_type': period_data['period_type'],
-                    'month': period_data['month'],
-                    'quarter': period_data['quarter'],
+        if invoice_count == 0 and self.import_source == 'invoices':
+            return {
+                'type': 'ir.actions.client',
+                'tag': 'display_notification',
+                'params': {
+                    'title': _('Warning!'),
+                    'message': _('No posted invoices found for company %s. Please post some invoices first.') % self.comunicazione_id.company_id.name,
+                    'type': 'warning',
                 }
-                
-                vp_record = self.env['comunicazione.liquidazione.vp'].create(vp_vals)
-                created_count += 1
-                
-                # Importa automaticamente i dati
-                vp_record.action_import_from_invoices_single()
-                
-                # Controlla se escludere periodi con importi zero
-                if self.exclude_zero_amounts:
-                    if (vp_record.imponibile_operazioni_attive == 0 and 
-                        vp_record.imponibile_operazioni_passive == 0 and
-                        vp_record.iva_esigibile == 0 and 
-                        vp_record.iva_detratta == 0):
-                        vp_record.unlink()
-                        created_count -= 1
-                        skipped_count += 1
-                        continue
-                
-                imported_count += 1
-                
-            except Exception as e:
-                error_msg = _("Error importing period %s: %s") % (
-                    f"{period_data['month'] or period_data['quarter']}", str(e)
-                )
-                errors.append(error_msg)
-                
-                # Log dell'errore
-                self.comunicazione_id.message_post(body=error_msg)
+            }
         
+        periods_to_create = self._get_selected_periods()
+        
+        if not periods_to_create:
+            raise UserError(_("Please select at least one period!"))
+        
+        # Tutte le letture dell'importazione (conteggi e aggregazioni di
+        # ogni periodo) avvengono sullo stesso snapshot del database, che
+        # viene registrato solo quando l'aggregazione viene eseguita
+        snapshot = self.comunicazione_id._record_import_snapshot()
+
+        # Valori desiderati di tutti i periodi, in un solo passaggio
+        comunicazione = self.comunicazione_id
+        breakdown, tax_breakdown = {}, {}
+        totals, discarded = self._get_source_totals(breakdown, tax_breakdown)
+        if self.import_source == 'statements' and not totals:
+            return {
+                'type': 'ir.actions.client',
+                'tag': 'display_notification',
+                'params': {
+                    'title': _('Warning!'),
+                    'message': _(
+                        'No VAT period end statement linked to %s periods of %s found.'
+                    ) % (self.period_type, self.year),
+                    'type': 'warning',
+                }
+            }
+        reset_values = self.env['comunicazione.liquidazione.vp']._get_reset_values()
+        desired = {}
+        skipped_count = 0
+        for period_data in periods_to_create:
+            key = comunicazione._get_vp_period_key(
+                period_data['period_type'], period_data['month'], period_data['quarter']
+            )
+            vals = dict(reset_values, **totals.get(key, {}))
+            vals['import_source'] = self.import_source
+            # Controlla se escludere periodi con importi zero
+            if self.exclude_zero_amounts and not any(
+                vals[field_name] for field_name in PREVIEW_FIELDS
+            ):
+                skipped_count += 1
+                continue
+            desired[key] = vals
+
+        existing_keys = {
+            comunicazione._get_vp_period_key(vp.period_type, vp.month, vp.quarter)
+            for vp in comunicazione.quadri_vp_ids
+        }
+        # Aggiorna in place, crea i mancanti ed elimina solo gli obsoleti
+        result = comunicazione._sync_vp_rows(
+            desired,
+            overwrite=self.force_overwrite,
+            unlink_obsolete=self.force_overwrite,
+        )
+        # Dettaglio per imposta (e per società se di gruppo) dei periodi scritti
+        comunicazione._sync_vp_breakdowns(
+            [
+                key
+                for key in desired
+                if self.force_overwrite or key not in existing_keys
+            ],
+            breakdown,
+            tax_breakdown,
+        )
+        created_count = result['created']
+        imported_count = result['created'] + result['updated'] + result['unchanged']
+        skipped_count += result['skipped']
+
         # Messaggio di completamento
         message_parts = [
             _('✅ Import process completed!'),
             _('📊 Created: %s periods') % created_count,
             _('📈 Imported data: %s periods') % imported_count,
+            _('✏️ Updated: %s periods') % result['updated'],
+            _('🗑️ Deleted: %s periods') % result['deleted'],
         ]
         
         if skipped_count > 0:
             message_parts.append(_('⏭️ Skipped: %s periods') % skipped_count)
-            
-        if errors:
-            message_parts.append(_('❌ Errors: %s') % len(errors))
+        if discarded:
+            message_parts.append(
+                _('⚠️ Statements not matching a %s period: %s')
+                % (self.period_type, ', '.join(discarded))
+            )
         
         message_parts.append(_('💾 Total invoices in database: %s') % invoice_count)
         
@@ -202,20 +405,29 @@ class ComunicazioneLiquidazioneImportWizard(models.TransientModel):
                     <li>Company: %s</li>
                     <li>Year: %s</li>
                     <li>Period type: %s</li>
+                    <li>Source: %s</li>
                     <li>Periods created: %s</li>
+                    <li>Periods updated: %s</li>
+                    <li>Periods deleted: %s</li>
                     <li>Data imported: %s</li>
                     <li>Skipped: %s</li>
-                    <li>Errors: %s</li>
+                    <li>Database snapshot: %s (%s UTC)</li>
                 </ul>
             </div>
             """) % (
                 self.comunicazione_id.company_id.name,
                 self.year,
                 self.period_type,
+                dict(self._fields['import_source']._description_selection(self.env))[
+                    self.import_source
+                ],
                 created_count,
+                result['updated'],
+                result['deleted'],
                 imported_count,
                 skipped_count,
-                len(errors)
+                snapshot,
+                self.comunicazione_id.import_snapshot_date,
             )
         )
         
@@ -225,6 +437,75 @@ class ComunicazioneLiquidazioneImportWizard(models.TransientModel):
             'params': {
                 'title': _('Import Completed!'),
                 'message': '\n'.join(message_parts),
-                'type': 'success' if not errors else 'warning',
+                'type': 'success',
             }
-        }
\ No newline at end of file
+        }
+
+
+class ComunicazioneLiquidazioneImportPreview(models.TransientModel):
+    _name = "comunicazione.liquidazione.import.preview"
+    _description = "Import VAT data preview line"
+    _order = "period_type, month, quarter"
+
+    wizard_id = fields.Many2one(
+        "comunicazione.liquidazione.import.wizard", required=True, ondelete="cascade"
+    )
+    vp_id = fields.Many2one("comunicazione.liquidazione.vp", string="Current VP table")
+    name = fields.Char(string="Period", compute="_compute_name")
+    period_type = fields.Selection(
+        [("month", "Monthly"), ("quarter", "Quarterly")], string="Period type"
+    )
+    month = fields.Integer()
+    quarter = fields.Integer()
+    to_apply = fields.Boolean(string="Apply")
+    is_different = fields.Boolean(string="Changed", compute="_compute_is_different")
+
+    new_imponibile_operazioni_attive = fields.Float(string="Active operations")
+    new_imponibile_operazioni_passive = fields.Float(string="Passive operations")
+    new_iva_esigibile = fields.Float(string="Due VAT")
+    new_iva_detratta = fields.Float(string="Deducted VAT")
+    current_imponibile_operazioni_attive = fields.Float(string="Current active operations")
+    current_imponibile_operazioni_passive = fields.Float(string="Current passive operations")
+    current_iva_esigibile = fields.Float(string="Current due VAT")
+    current_iva_detratta = fields.Float(string="Current deducted VAT")
+    new_debito_periodo_precedente = fields.Float(string="Previous period debit")
+    new_credito_periodo_precedente = fields.Float(string="Previous period credit")
+    new_interessi_dovuti = fields.Float(string="Due interests")
+    new_accounto_dovuto = fields.Float(string="Down payment due")
+    new_invoice_snapshot = fields.Binary(attachment=False)
+    new_invoice_snapshot_count = fields.Integer(string="Invoices")
+
+    @api.depends("period_type", "month", "quarter")
+    def _compute_name(self):
+        for line in self:
+            if line.period_type == "month":
+                line.name = _("Month %s") % line.month
+            else:
+                line.name = _("Quarter %s") % line.quarter
+
+    def _get_compared_fields(self):
+        """Campi scritti dall'applicazione dell'anteprima"""
+        if self.wizard_id.import_source == "statements":
+            return PREVIEW_FIELDS + STATEMENT_PREVIEW_FIELDS
+        return PREVIEW_FIELDS
+
+    @api.depends(
+        "vp_id",
+        "wizard_id.import_source",
+        *["new_" + f for f in PREVIEW_FIELDS + STATEMENT_PREVIEW_FIELDS],
+        *["current_" + f for f in PREVIEW_FIELDS],
+    )
+    def _compute_is_different(self):
+        for line in self:
+            currency = line.wizard_id.comunicazione_id.company_id.currency_id
+            line.is_different = not line.vp_id or any(
+                not currency.is_zero(line["new_" + f] - line.vp_id[f])
+                for f in line._get_compared_fields()
+            )
+
+    def _get_new_values(self):
+        self.ensure_one()
+        vals = {f: self["new_" + f] for f in self._get_compared_fields()}
+        vals["invoice_snapshot"] = self.new_invoice_snapshot
+        vals["invoice_snapshot_count"] = self.new_invoice_snapshot_count
+        return vals
@@ -0,0 +1,53 @@
+from markupsafe import Markup, escape
+
+from flectra import _, fields, models
+
+
+class ComunicazioneLiquidazionePreflight(models.TransientModel):
+    _name = "comunicazione.liquidazione.preflight"
+    _description = "VAT statement communication pre-flight check"
+
+    comunicazione_ids = fields.Many2many(
+        "comunicazione.liquidazione", string="Communications"
+    )
+    error_count = fields.Integer(string="Errors", readonly=True)
+    report = fields.Html(readonly=True, sanitize=False)
+
+    def action_run(self):
+        for wizard in self:
+            results = wizard.comunicazione_ids.get_preflight_errors()
+            rows = []
+            for comunicazione in wizard.comunicazione_ids:
+                errors = results[comunicazione.id]
+                if not errors:
+                    continue
+                rows.append(
+                    Markup("<tr><td>%s</td><td><ul>%s</ul></td></tr>")
+                    % (
+                        comunicazione.display_name,
+                        Markup("").join(
+                            Markup("<li>%s</li>") % escape(error) for error in errors
+                        ),
+                    )
+                )
+            wizard.error_count = sum(len(errors) for errors in results.values())
+            if rows:
+                wizard.report = Markup(
+                    '<table class="table table-sm"><tr><th>%s</th><th>%s</th></tr>%s</table>'
+                ) % (_("Communication"), _("Problems"), Markup("").join(rows))
+            else:
+                wizard.report = Markup(
+                    '<div class="alert alert-success">%s</div>'
+                ) % _("All selected communications passed the checks.")
+        return True
+
+    def action_rescan(self):
+        self.action_run()
+        return {
+            "name": _("Pre-flight check"),
+            "type": "ir.actions.act_window",
+            "res_model": self._name,
+            "res_id": self.id,
+            "view_mode": "form",
+            "target": "new",
+        }